@@ -0,0 +1,419 @@
+# Asset cache of the advanced feedback
+# The models in models/ are text .egg files, which take seconds to parse. The asset cache converts each model once to
+# the binary .bam format (with its textures embedded) and loads the .bam file afterwards (see AssetCache.load).
+# The cached models are flattened (see flatten_model), so each part of an exo has as few nodes and geoms as possible.
+# A cached model is rebuilt when its .egg file, the version of Panda3D or the version of the cache changes.
+# The models can also be loaded in the background (see AssetCache.load_async and PrototypePool.request), so that the
+# render loop does not wait for them.
+# The cache also holds simplified levels of detail of the exo models (see advlod.py and AssetCache.build_lods), which are
+# only built in advance.
+# The materials of the exos are shared by all exos that look the same (see MaterialCache).
+# Usage: python advassets.py [--force] [--no-lod]   (converts all models in advance, e.g. when the program is installed)
+# The loading functions use the global loader of Panda3D, i.e. ShowBase has to be started first.
+
+# ### Imports ### #
+import argparse
+import collections
+import hashlib
+import json
+import os
+import time
+from functools import partial
+
+from panda3d.core import Filename, BamFile, BamEnums, PandaSystem, NodePath, Material
+
+from advlog import get_logger
+from advlod import simplify_model, make_lod, count_triangles, LOD_RESOLUTIONS
+
+# ### Begin ### #
+
+log = get_logger('assets')
+
+# Directory of the models (relative to the program) and of the cached models (relative to the models)
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
+CACHE_DIR = 'cache'
+# File in the cache directory that describes the source of each cached model
+MANIFEST_NAME = 'manifest.json'
+# Version of the cached models. The cache is rebuilt when it has been built by another version (e.g. before the models were flattened).
+CACHE_VERSION = 2
+
+# Models of the exos (all handednesses) and of the mats, which are preloaded by the program (see PrototypePool)
+EXO_MODEL_NAMES = ('exo3_base','exo3_arm_rest',
+                   'exo3_prono_left','exo3_findex_left','exo3_fgroup_left','exo3_fthumb_left',
+                   'exo3_prono_right','exo3_findex_right','exo3_fgroup_right','exo3_fthumb_right')
+MAT_MODEL_NAMES = ('mat_left','mat_right')
+
+# Material properties of the parts of the exos by role (see MaterialCache): "exo" is the base, "arm" are the parts of the arm
+# The transparency of an exo is set by its color scale (see advclasses.Logic.toggleTransparencyTask), so the materials are the same for opaque and transparent exos
+MATERIAL_ROLES = {'exo': {'shininess': 5.0, 'diffuse': (0.25,0.25,0.25,1)},
+                  'arm': {'shininess': 12.0, 'diffuse': (0.3,0.3,0.3,1)}}
+# Ambient color (i.e. the color) of the exos that have not been colored
+DEFAULT_AMBIENT = (0.6,0.6,0.6,1)
+
+def flatten_model(model):
+    ''' Merges the nodes and geoms of MODEL (NodePath) as far as possible: the transforms of the nodes are applied to the vertices and the geoms with the same state are combined (flattenStrong). The model nodes of the loaded files are removed first, as they would keep their children apart. '''
+    model.clearModelNodes()
+    model.flattenStrong()
+    return model
+
+def write_bam(model,path):
+    ''' Writes MODEL (NodePath) to the .bam file PATH with its textures embedded. The file is replaced at once, so an interrupted write does not leave a broken file. '''
+    temp = path + '.tmp'
+    bam = BamFile()
+    if not(bam.openWrite(Filename.fromOsSpecific(temp))):
+        raise IOError('Cannot write ' + temp + '.')
+    bam.getWriter().setFileTextureMode(BamEnums.BTM_rawdata)
+    written = bam.writeObject(model.node())
+    bam.close()
+    if not(written):
+        os.remove(temp)
+        raise IOError('Cannot write ' + model.getName() + ' to ' + path + '.')
+    os.replace(temp,path)
+
+def file_hash(path):
+    ''' Returns the SHA-1 hash of a file as hex string. '''
+    sha1 = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1048576),b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class AssetCache(object):
+    ''' Cache of the models in MODEL_DIR converted to .bam files in MODEL_DIR/CACHE_DIR.
+    A cached model is current if the modification time and size of its .egg file are those recorded in the manifest. If only the modification time differs (e.g. after a checkout), the hash of the file decides and the manifest is updated without converting the model again. '''
+
+    def __init__(self,model_dir=MODEL_DIR,cache_dir=None):
+        self.model_dir = model_dir
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(model_dir,CACHE_DIR)
+        self.manifest_path = os.path.join(self.cache_dir,MANIFEST_NAME)
+        self.manifest = self.read_manifest()
+        # Number of models loaded from the cache and converted, and number of models whose levels of detail have been built
+        self.stats = {'hits': 0, 'builds': 0, 'build_time': 0.0, 'lod_builds': 0}
+
+    def read_manifest(self):
+        ''' Returns the manifest, or an empty one if it does not exist or was written by another version of Panda3D or of the cache. '''
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError,ValueError):
+            return {'panda3d': PandaSystem.getVersionString(), 'version': CACHE_VERSION, 'models': {}}
+        if manifest.get('panda3d') != PandaSystem.getVersionString() or manifest.get('version') != CACHE_VERSION:
+            return {'panda3d': PandaSystem.getVersionString(), 'version': CACHE_VERSION, 'models': {}}
+        return manifest
+
+    def write_manifest(self):
+        ''' Writes the manifest. It is replaced at once, so an interrupted write does not leave a broken manifest. '''
+        temp = self.manifest_path + '.tmp'
+        with open(temp,'w') as f:
+            json.dump(self.manifest,f,indent=1,sort_keys=True)
+        os.replace(temp,self.manifest_path)
+
+    def source_path(self,name):
+        ''' Returns the path of the .egg file of the model NAME (e.g. "exo3_base"). '''
+        return os.path.join(self.model_dir,name + '.egg')
+
+    def bam_path(self,name):
+        ''' Returns the path of the cached .bam file of the model NAME. '''
+        return os.path.join(self.cache_dir,name + '.bam')
+
+    def lod_path(self,name,level):
+        ''' Returns the path of the .bam file of the simplified level LEVEL (starting with 1) of the model NAME. '''
+        return os.path.join(self.cache_dir,name + '.lod' + str(level) + '.bam')
+
+    def is_current(self,name):
+        ''' Returns True if the cached model NAME exists and has been built from the current .egg file. '''
+        entry = self.manifest['models'].get(name)
+        if entry is None or not(os.path.exists(self.bam_path(name))):
+            return False
+        source = os.stat(self.source_path(name))
+        if source.st_size != entry['size']:
+            return False
+        if source.st_mtime == entry['mtime']:
+            return True
+        if file_hash(self.source_path(name)) != entry['sha1']:
+            return False
+        entry['mtime'] = source.st_mtime
+        self.write_manifest()
+        return True
+
+    def has_lods(self,name,resolutions=LOD_RESOLUTIONS):
+        ''' Returns True if the simplified levels of the model NAME have been built with RESOLUTIONS (see advlod.simplify_model) from the current .egg file. '''
+        if not(self.is_current(name)):
+            return False
+        if self.manifest['models'][name].get('lods') != list(resolutions):
+            return False
+        return all(os.path.exists(self.lod_path(name,level+1)) for level in range(len(resolutions)))
+
+    def build(self,name):
+        ''' Converts the model NAME to a .bam file. The textures are embedded, so they need not be read and decoded when the model is loaded. '''
+        start = time.perf_counter()
+        source = self.source_path(name)
+        stat = os.stat(source)
+        model = loader.loadModel(Filename.fromOsSpecific(source),noCache=True)
+        self.write(name,model,stat)
+        self.stats['builds'] += 1
+        self.stats['build_time'] += time.perf_counter() - start
+
+    def write(self,name,model,stat):
+        ''' Flattens MODEL, loaded from the .egg file of the model NAME whose os.stat was STAT, and writes it to the cache. The simplified levels of the model are outdated afterwards. '''
+        source = self.source_path(name)
+        os.makedirs(self.cache_dir,exist_ok=True)
+        write_bam(flatten_model(model),self.bam_path(name))
+
+        self.manifest['models'][name] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': file_hash(source)}
+        self.write_manifest()
+
+    def build_lods(self,name,resolutions=LOD_RESOLUTIONS):
+        ''' Builds the simplified (and flattened) levels of the model NAME, one for each resolution of RESOLUTIONS (see advlod.simplify_model). Returns the number of triangles of each level, starting with the model itself. '''
+        model = self.load(name)
+        triangles = [count_triangles(model)]
+        for level, resolution in enumerate(resolutions):
+            simplified = flatten_model(simplify_model(model,resolution))
+            triangles.append(count_triangles(simplified))
+            write_bam(simplified,self.lod_path(name,level+1))
+        self.manifest['models'][name]['lods'] = list(resolutions)
+        self.write_manifest()
+        self.stats['lod_builds'] += 1
+        return triangles
+
+    def build_all(self,force=False,lod_names=EXO_MODEL_NAMES):
+        ''' Converts all models in the model directory whose cached version is not current (all models if FORCE is True) and builds the simplified levels of the models LOD_NAMES that are not current. Returns the names of the converted models. '''
+        built = []
+        for filename in sorted(os.listdir(self.model_dir)):
+            name, extension = os.path.splitext(filename)
+            if extension == '.egg' and (force or not(self.is_current(name))):
+                self.build(name)
+                built.append(name)
+        for name in lod_names:
+            if force or not(self.has_lods(name)):
+                self.build_lods(name)
+        return built
+
+    def load(self,name,lod_distances=None):
+        ''' Loads the model NAME from the cache. The model is converted first if the cached version is not current. The loaded models are kept in memory by Panda3D (ModelPool), so loading a model again only copies it.
+        If LOD_DISTANCES is given and the simplified levels of the model have been built, an LOD node with all levels is returned (see advlod.make_lod). '''
+        if not(self.is_current(name)):
+            self.build(name)
+        else:
+            self.stats['hits'] += 1
+        if lod_distances is not None and self.has_lods(name):
+            return make_lod(name,[loader.loadModel(Filename.fromOsSpecific(path)) for path in self.level_paths(name)],lod_distances)
+        return loader.loadModel(Filename.fromOsSpecific(self.bam_path(name)))
+
+    def level_paths(self,name):
+        ''' Returns the paths of the .bam files of the model NAME and of its simplified levels. '''
+        return [self.bam_path(name)] + [self.lod_path(name,level+1) for level in range(len(self.manifest['models'][name]['lods']))]
+
+    def load_async(self,name,callback,lod_distances=None):
+        ''' Loads the model NAME from the cache in the background (by the asynchronous loader of Panda3D) and calls CALLBACK with the model in the render thread (see load for LOD_DISTANCES). CALLBACK gets None if the model could not be loaded.
+        If the cached version is not current, the .egg file is loaded in the background and the model is written to the cache when it has been loaded. '''
+        if self.is_current(name):
+            self.stats['hits'] += 1
+            if lod_distances is not None and self.has_lods(name):
+                loader.loadModel([Filename.fromOsSpecific(path) for path in self.level_paths(name)],callback=lambda levels: callback(make_lod(name,levels,lod_distances) if None not in levels else None))
+            else:
+                loader.loadModel(Filename.fromOsSpecific(self.bam_path(name)),callback=callback)
+            return
+        start = time.perf_counter()
+        stat = os.stat(self.source_path(name))
+        def loaded(model):
+            if model is None:
+                callback(None)
+                return
+            # The model is used even if it cannot be written to the cache (it is then converted again next time)
+            try:
+                self.write(name,model,stat)
+            except OSError:
+                pass
+            else:
+                self.stats['builds'] += 1
+                self.stats['build_time'] += time.perf_counter() - start
+            callback(model)
+        loader.loadModel(Filename.fromOsSpecific(self.source_path(name)),noCache=True,callback=loaded)
+
+class PrototypePool(object):
+    ''' Models that are loaded once (e.g. at startup, see preload) and copied for each exo. Copying a prototype does not read any file. Only the nodes are copied, the vertex data and the textures are shared, so a copy takes microseconds.
+    LOAD is the function that loads a model by name (e.g. AssetCache.load). Models that have not been preloaded are loaded when they are first copied.
+    LOAD_ASYNC is the function that loads a model by name in the background and calls a callback with it (e.g. AssetCache.load_async). If it is given, request loads the missing models in the background. '''
+
+    def __init__(self,load,load_async=None):
+        self.load = load
+        self.load_async = load_async
+        self.prototypes = {}
+        # Models being loaded in the background -> functions waiting for them (see request)
+        self.loading = {}
+        # Models loaded when they were first copied, and time spent loading the models (in the render thread). Models loaded in the background are counted separately.
+        self.stats = {'copies': 0, 'misses': 0, 'load_time': 0.0, 'async_loads': 0}
+
+    def preload(self,names):
+        ''' Loads the models NAMES (that have not been loaded yet). '''
+        for name in names:
+            if name not in self.prototypes:
+                self.add(name)
+
+    def add(self,name):
+        ''' Loads the model NAME as prototype and returns it. '''
+        start = time.perf_counter()
+        self.prototypes[name] = self.load(name)
+        self.stats['load_time'] += time.perf_counter() - start
+        return self.prototypes[name]
+
+    def request(self,names,callback,failed=None):
+        ''' Calls CALLBACK (without arguments) as soon as the models NAMES have been loaded. The missing models are loaded in the background if LOAD_ASYNC was given, otherwise at once. CALLBACK is called before request returns if no model has to be loaded in the background.
+        If one of the models cannot be loaded (see loaded), FAILED (without arguments) is called instead of CALLBACK. '''
+        missing = [name for name in names if name not in self.prototypes]
+        if not(missing):
+            callback()
+            return
+        if self.load_async is None:
+            self.preload(missing)
+            callback()
+            return
+
+        # Number of models that are still being loaded, or None if one of them could not be loaded
+        waiting = [len(missing)]
+        def ready(ok):
+            if waiting[0] is None:
+                return
+            if not(ok):
+                waiting[0] = None
+                if failed is not None:
+                    failed()
+                return
+            waiting[0] -= 1
+            if waiting[0] == 0:
+                callback()
+        for name in missing:
+            if name in self.loading:
+                self.loading[name].append(ready)
+            else:
+                self.loading[name] = [ready]
+                self.stats['async_loads'] += 1
+                self.load_async(name,partial(self.loaded,name))
+
+    def loaded(self,name,model):
+        ''' Adds the model NAME that has been loaded in the background and calls the functions waiting for it. If the model could not be loaded in the background (None), it is loaded again at once. If that fails as well, the waiting functions are told so and the model is not added (the next request tries to load it again). '''
+        if model is None:
+            log.warning('The model %s could not be loaded in the background, loading it again.',name)
+            try:
+                model = self.add(name)
+            except OSError as error:
+                log.error('The model %s could not be loaded (%s).',name,error)
+                for callback in self.loading.pop(name,()):
+                    callback(False)
+                return
+        self.prototypes[name] = model
+        for callback in self.loading.pop(name,()):
+            callback(True)
+
+    def copy(self,name):
+        ''' Returns a copy of the model NAME (a new NodePath without parent). '''
+        prototype = self.prototypes.get(name)
+        if prototype is None:
+            self.stats['misses'] += 1
+            prototype = self.add(name)
+        self.stats['copies'] += 1
+        return prototype.copyTo(NodePath())
+
+class RecyclingPool(object):
+    ''' Free lists of model hierarchies that are not displayed any more (e.g. of deleted exos) by KEY (e.g. ("exo","left")), so that they can be reused instead of being copied again. The caller resets a hierarchy it acquires.
+    At most MAX_SIZE hierarchies are kept per key, further released hierarchies are removed. A hierarchy released in a frame is only reused in a later frame, as tasks of that frame may still refer to it (e.g. a color command sent before the exo was deleted). '''
+
+    def __init__(self,max_size=32):
+        self.max_size = max_size
+        # Key -> deque of tuples (frame released, root node, models), oldest first
+        self.free = {}
+        # Hierarchies reused (hits) and not available (misses), released and removed because the free list was full
+        self.stats = {'hits': 0, 'misses': 0, 'released': 0, 'discarded': 0}
+
+    def acquire(self,key,frame):
+        ''' Returns the models of a hierarchy with the key KEY released before the frame FRAME, or None if there is none. '''
+        free = self.free.get(key)
+        if not(free) or free[0][0] >= frame:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return free.popleft()[2]
+
+    def release(self,key,root,models,frame):
+        ''' Detaches the hierarchy with the root node ROOT and keeps MODELS (e.g. a dict of its parts) for reuse after the frame FRAME. '''
+        free = self.free.setdefault(key,collections.deque())
+        if len(free) >= self.max_size:
+            root.removeNode()
+            self.stats['discarded'] += 1
+            return
+        root.detachNode()
+        free.append((frame,root,models))
+        self.stats['released'] += 1
+
+    def clear(self):
+        ''' Removes all kept hierarchies. '''
+        for free in self.free.values():
+            for frame, root, models in free:
+                root.removeNode()
+        self.free.clear()
+
+    def held(self):
+        ''' Returns the number of kept hierarchies by key and in total, and the number of their nodes. The nodes are what the kept hierarchies hold in memory, the vertex data and the textures are shared with the prototypes (see PrototypePool). '''
+        held = {'hierarchies': 0, 'nodes': 0, 'keys': {}}
+        for key, free in self.free.items():
+            held['keys'][key] = len(free)
+            held['hierarchies'] += len(free)
+            held['nodes'] += sum(root.countNumDescendants() + 1 for frame, root, models in free)
+        return held
+
+class MaterialCache(object):
+    ''' Shared materials of the exos by role (see MATERIAL_ROLES) and ambient color. Exos that look the same use the same materials and thus the same render states, which Panda3D caches, and coloring an exo only looks up a material.
+    The materials are shared, so they must not be changed. Colors that differ by less than 1e-4 are the same. At most MAX_SIZE materials are kept (the least recently used are dropped, the exos that use them keep them).
+    If SHARED is False, a new material is made each time (as before the materials were shared, for comparison). '''
+
+    def __init__(self,shared=True,max_size=1024):
+        self.shared = shared
+        self.max_size = max_size
+        # (role, ambient color) -> material, least recently used first
+        self.materials = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self,role,ambient=DEFAULT_AMBIENT):
+        ''' Returns the material of the ROLE ("exo" or "arm") with the AMBIENT color (the alpha is ignored). '''
+        ambient = (round(ambient[0],4),round(ambient[1],4),round(ambient[2],4),1.0)
+        key = (role,ambient)
+        material = self.materials.get(key) if self.shared else None
+        if material is not None:
+            self.materials.move_to_end(key)
+            self.stats['hits'] += 1
+            return material
+
+        self.stats['misses'] += 1
+        properties = MATERIAL_ROLES[role]
+        material = Material()
+        material.setShininess(properties['shininess'])
+        material.setAmbient(ambient)
+        material.setDiffuse(properties['diffuse'])
+        if self.shared:
+            self.materials[key] = material
+            if len(self.materials) > self.max_size:
+                self.materials.popitem(last=False)
+        return material
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts the models of the advanced feedback to .bam files (see advassets.AssetCache).')
+    parser.add_argument('--force',action='store_true',help='Convert all models, even if the cached version is current')
+    parser.add_argument('--no-lod',action='store_true',help='Do not build the simplified levels of detail of the exo models')
+    args = parser.parse_args()
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('','window-type none\naudio-library-name null')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    cache = AssetCache()
+    built = cache.build_all(args.force,() if args.no_lod else EXO_MODEL_NAMES)
+    for name in built:
+        print('MESSAGE: Converted ' + name + '.')
+    if cache.stats['lod_builds']:
+        print('MESSAGE: Levels of detail of {0} model(s) built.'.format(cache.stats['lod_builds']))
+    print('MESSAGE: {0} of the models converted in {1:.1f} s, cache: {2}'.format(len(built),cache.stats['build_time'],cache.cache_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,781 @@
+# Benchmarks for the advanced feedback
+# Usage: python advbenchmark.py BENCHMARK [OPTIONS]
+# Run "python advbenchmark.py -h" for the list of benchmarks.
+# The benchmarks run Panda3D without a window.
+
+# ### Imports ### #
+import argparse
+import contextlib
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from panda3d.core import loadPrcFileData, Filename, NetDatagram
+
+# ### Begin ### #
+
+def start_program(port,threaded=False,window_type='none',shared_memory=False):
+    ''' Starts Panda3D without a window and returns the program logic. If THREADED is True the connections are read by a network thread (see ProgramLogic.network_thread), with SHARED_MEMORY the samples are also read from the shared-memory ring buffer (see ProgramLogic.shm_enabled).
+    With the WINDOW_TYPE 'offscreen' the scene is rendered into an offscreen buffer (with the graphics driver of the machine). '''
+    # The models are found relative to the directory of this file
+    program_dir = Filename.fromOsSpecific(os.path.dirname(os.path.abspath(__file__)))
+    loadPrcFileData('', 'window-type ' + window_type + '\naudio-library-name null\nwin-size 1280 720\nsync-video false\nmodel-path ' + program_dir.getFullpath())
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+    
+    import advclasses
+    with silenced():
+        # A separate port is used in order not to interfere with a running visualisation
+        pl = advclasses.ProgramLogic(base.render,port_address=port,network_thread=threaded,shm_enabled=shared_memory)
+    return pl
+    
+@contextlib.contextmanager
+def silenced():
+    ''' Context manager that discards everything that is printed or logged. '''
+    stdout = sys.stdout
+    with open(os.devnull,'w') as devnull:
+        sys.stdout = devnull
+        logging.disable(logging.CRITICAL)
+        try:
+            yield
+        finally:
+            logging.disable(logging.NOTSET)
+            sys.stdout = stdout
+            
+def add_network_tasks(pl,frame_work):
+    ''' Adds the network tasks like advmain.py does and a task that simulates the rendering by sleeping FRAME_WORK milliseconds per frame. '''
+    from direct.task import Task
+    import advclasses
+    
+    if pl.networkThread is not None:
+        taskMgr.add(pl.tskActionPolling, "tcp_actions")
+    else:
+        taskMgr.add(pl.tskListenerPolling, "tcp_establish")
+        taskMgr.add(pl.tskReaderPolling, "tcp_poll")
+    
+    taskMgr.add(pl.tskSharedMemoryPolling, "shm_poll")
+    taskMgr.add(pl.tskSendReplies, "tcp_replies", sort = advclasses.REPLY_TASK_SORT)
+    
+    def render_task(task):
+        time.sleep(frame_work/1000.0)
+        return Task.cont
+    taskMgr.add(render_task,'render',sort=50)
+    
+def make_datagram(message):
+    ''' Returns a datagram as it is received by the reader (raw mode). '''
+    datagram = NetDatagram()
+    datagram.appendData(message.encode())
+    return datagram
+
+@contextlib.contextmanager
+def tasks_disabled():
+    ''' Context manager that discards all tasks that are added to the task manager, so that only the code that schedules them is measured. '''
+    taskMgr.add = lambda *args, **kwargs: None
+    taskMgr.doMethodLater = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        del taskMgr.add
+        del taskMgr.doMethodLater
+
+# ### Benchmarks ### #
+
+def benchmark_parse(args):
+    ''' Measures the time needed to parse and dispatch a command (including the reassembly of the command stream). The tasks scheduled by the commands are discarded. '''
+    pl = start_program(args.port)
+    
+    with silenced():
+        for i in range(4):
+            pl.addExoTask(('realtime','left'),[0,0,0,0,0,0,0])
+    ids = list(pl.exo_ids_in_order)
+    
+    commands = {
+        'ADDEXO': 'ADDEXO EXOSTATIC LEFT 12.5,-3.25,90,10,20,30,40',
+        'DATA': 'DATA '+ids[0]+' 12.5,-3.25,90,10,20,30,40',
+        'DATABATCH (4 exos)': 'DATABATCH '+' '.join(id+' 12.5,-3.25,90,10,20,30,40' for id in ids),
+        'SETCOLORBASE': 'SETCOLORBASE '+ids[0]+' ARMREST 0.5,0.25,1',
+        'ROTATECAMERA': 'ROTATECAMERA 45',
+        'TOGGLEMAT': 'TOGGLEMAT LEFT',
+        'invalid command': 'NOSUCHCOMMAND 1',
+    }
+    
+    print('Commands per datagram: ' + str(args.batch) + ', repetitions: ' + str(args.repetitions) + ', best of ' + str(args.runs) + ' runs')
+    for name in commands:
+        datagram = make_datagram((commands[name]+'::')*args.batch)
+        durations = []
+        with silenced(), tasks_disabled():
+            for run in range(args.runs):
+                start = time.perf_counter()
+                for i in range(args.repetitions):
+                    pl.parse_commands(datagram)
+                durations.append(time.perf_counter() - start)
+        
+        per_command = min(durations) / (args.repetitions*args.batch)
+        print('{0:<20s} {1:8.2f} us per command'.format(name,per_command*1e6))
+
+def benchmark_network(args):
+    ''' Measures the frame time and the input latency while a client streams DATA commands at a fixed rate. The input latency is the time from sending a command until the end of the frame in which the command (or a newer sample of the exo) has been applied.
+    The rendering is simulated by sleeping FRAME_WORK milliseconds per frame. With SHARED_MEMORY the samples are written to the shared-memory ring buffer instead of being sent (see advsharedmemory.py). '''
+    pl = start_program(args.port,args.threaded,shared_memory=args.shared_memory)
+    add_network_tasks(pl,args.frame_work)
+    if args.shared_memory:
+        from advsharedmemory import PoseWriter
+        writer = PoseWriter(pl.shm_path)
+    
+    with silenced():
+        pl.addExoTask(('realtime','left'),[0,0,0,0,0,0,0])
+    id = pl.exo_ids_in_order[-1]
+    
+    # The client sends the commands from a separate thread with a fixed schedule. The sequence number identifies the command.
+    num_commands = int(args.rate*args.duration)
+    send_times = [0.0]*(num_commands+1)
+    def send_commands():
+        start = time.perf_counter()
+        for sequence in range(1,num_commands+1):
+            delay = start + sequence/args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send_times[sequence] = time.perf_counter()
+            if args.shared_memory:
+                writer.write(id,(12.5,-3.25,90,10,20,30,40))
+            else:
+                client.sendall(('DATA '+id+' 12.5,-3.25,90,10,20,30,40 '+str(sequence)+'::').encode())
+    sender = threading.Thread(target=send_commands)
+    
+    frame_times = []
+    latencies = []
+    last_sequence = 0
+    with silenced():
+        client = socket.create_connection(('127.0.0.1',args.port))
+        client.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        sender.start()
+        end = time.perf_counter() + args.duration + 1.0
+        while last_sequence < num_commands and time.perf_counter() < end:
+            frame_start = time.perf_counter()
+            taskMgr.step()
+            frame_end = time.perf_counter()
+            frame_times.append(frame_end - frame_start)
+            # The samples in the shared memory have no sequence numbers, but they are read in order
+            if args.shared_memory:
+                sequence = pl.shm_stats['samples']
+            else:
+                sequence = pl.dataSequences.get(id,0)
+            for applied in range(last_sequence+1,sequence+1):
+                latencies.append(frame_end - send_times[applied])
+            last_sequence = sequence
+        sender.join()
+        client.close()
+        if pl.networkThread is not None:
+            pl.networkThread.stop()
+        if args.shared_memory:
+            writer.close()
+            pl.poseBuffer.close()
+    
+    latencies.sort()
+    if args.shared_memory:
+        mode = 'shared memory'
+    else:
+        mode = 'network thread' if args.threaded else 'task manager'
+    print('Mode: ' + mode + ', ' + str(args.rate) + ' commands/s, simulated rendering: ' + str(args.frame_work) + ' ms per frame')
+    print('Frame time:     mean {0:6.2f} ms, max. {1:6.2f} ms ({2} frames)'.format(1000*sum(frame_times)/len(frame_times),1000*max(frame_times),len(frame_times)))
+    if latencies:
+        print('Input latency:  mean {0:6.2f} ms, 95% {1:6.2f} ms, max. {2:6.2f} ms ({3} of {4} commands applied)'.format(
+            1000*sum(latencies)/len(latencies),1000*latencies[int(0.95*(len(latencies)-1))],1000*latencies[-1],len(latencies),num_commands))
+
+def benchmark_session(args):
+    ''' Measures the time needed to set up a session, i.e. to add a number of static exos. The client either waits for the reply (the id of the exo) after each ADDEXO command or sends all commands at once and matches the replies by their tokens. '''
+    pl = start_program(args.port,args.threaded)
+    add_network_tasks(pl,args.frame_work)
+    
+    replies = {}
+    result = {}
+    
+    def run_client():
+        client = socket.create_connection(('127.0.0.1',args.port))
+        received = b''
+        start = time.perf_counter()
+        for i in range(args.exos):
+            client.sendall(('ADDEXO EXOSTATIC LEFT '+str(i)+',0,0,0,0,0,0 @'+str(i)+'::').encode())
+            if args.pipelined and i < args.exos-1:
+                continue
+            # Wait for the replies of all commands sent so far
+            while len(replies) <= i:
+                received += client.recv(4096)
+                *complete, received = received.split(b'::')
+                for reply in complete:
+                    id, token = reply.decode().lstrip(':').split(' ')
+                    replies[token] = id
+        result['duration'] = time.perf_counter() - start
+        client.close()
+    client = threading.Thread(target=run_client)
+    
+    with silenced():
+        client.start()
+        end = time.perf_counter() + 60
+        while client.is_alive() and time.perf_counter() < end:
+            taskMgr.step()
+        if pl.networkThread is not None:
+            pl.networkThread.stop()
+    
+    print('Mode: ' + ('network thread' if args.threaded else 'task manager') + ', ' + ('pipelined' if args.pipelined else 'waiting for each reply') + ', simulated rendering: ' + str(args.frame_work) + ' ms per frame')
+    if 'duration' not in result:
+        print('Session setup did not finish.')
+        return
+    correct = all(replies.get('@'+str(i)) in pl.exos for i in range(args.exos))
+    print('{0} exos added in {1:.1f} ms, replies {2}'.format(args.exos,result['duration']*1000,'correct' if correct else 'WRONG'))
+
+# Ways of sending the commands compared by benchmark_client
+BENCHMARK_CLIENT_MODES = ('send per command','advclient','advclient (binary)')
+
+def run_benchmark_client(port,id,commands,results):
+    ''' Client process of benchmark_client. '''
+    from advclient import CommandClient, build_data
+    
+    dofs = [12.5,-3.25,90,10,20,30,40]
+    result = {}
+    client = CommandClient('127.0.0.1',port)
+    for mode in BENCHMARK_CLIENT_MODES:
+        start = time.perf_counter()
+        if mode == 'advclient':
+            for i in range(commands):
+                client.data(id,dofs)
+            client.flush()
+        elif mode == 'advclient (binary)':
+            for i in range(commands):
+                client.data_binary(id,dofs)
+            client.flush()
+        else:
+            for i in range(commands):
+                client.sock.send((build_data(id,dofs)+'::').encode())
+        sent = time.perf_counter()
+        client.wait(client.request(build_data(id,dofs)),timeout=60)
+        result[mode] = (sent - start, time.perf_counter() - start)
+    client.close()
+    results.put(result)
+    
+def benchmark_client(args):
+    ''' Measures the throughput of the client library (advclient.py): the client sends DATA commands to a realtime exo and finally waits for the acknowledgement of a command with request number. Reported are the rate at which the client sends the commands and the rate at which the program has executed them.
+    For comparison, the same is measured with one send call per command (like advtcp_commandclient.py did before). The client runs in a separate process. '''
+    pl = start_program(args.port,args.threaded)
+    add_network_tasks(pl,args.frame_work)
+    with silenced():
+        pl.addExoTask(('realtime','left'),[0,0,0,0,0,0,0])
+    
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    client = context.Process(target=run_benchmark_client,args=(args.port,pl.exo_ids_in_order[-1],args.commands,results))
+    
+    with silenced():
+        client.start()
+        end = time.perf_counter() + 120
+        while client.is_alive() and time.perf_counter() < end:
+            taskMgr.step()
+        if pl.networkThread is not None:
+            pl.networkThread.stop()
+    result = results.get(timeout=1) if not(results.empty()) else {}
+    
+    print('Mode: ' + ('network thread' if args.threaded else 'task manager') + ', ' + str(args.commands) + ' DATA commands, simulated rendering: ' + str(args.frame_work) + ' ms per frame')
+    for mode in BENCHMARK_CLIENT_MODES:
+        if mode in result:
+            sent, executed = result[mode]
+            print('{0:<20s} sent: {1:9.0f} commands/s, executed: {2:9.0f} commands/s'.format(mode,args.commands/sent,args.commands/executed))
+
+def run_flood_client(port,id,duration):
+    ''' Client process of benchmark_fairness that sends DATA commands as fast as it can. '''
+    payload = ('DATA '+id+' 12.5,-3.25,90,10,20,30,40::').encode()*100
+    client = socket.create_connection(('127.0.0.1',port))
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        client.sendall(payload)
+    client.close()
+
+def benchmark_fairness(args):
+    ''' Measures how long a control client waits for the acknowledgement of its commands while another client (in a separate process) floods the program with DATA commands. Without per-connection queues the commands of the control client wait behind all DATA commands received before them. '''
+    pl = start_program(args.port,args.threaded)
+    add_network_tasks(pl,args.frame_work)
+    pl.reader_time_budget = args.budget/1000.0
+    with silenced():
+        pl.addExoTask(('realtime','left'),[0,0,0,0,0,0,0])
+    id = pl.exo_ids_in_order[-1]
+    
+    context = multiprocessing.get_context('spawn')
+    flood = context.Process(target=run_flood_client,args=(args.port,id,args.duration))
+    
+    latencies = []
+    def run_control_client():
+        from advclient import CommandClient
+        # Give the flood client time to fill the queues
+        time.sleep(1.0)
+        client = CommandClient('127.0.0.1',args.port)
+        end = time.perf_counter() + args.duration - 2.0
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            try:
+                client.wait(client.request('SETCOLORBASE '+id+' BASE 1,0,0'),timeout=30)
+            except TimeoutError:
+                break
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.05)
+        client.close()
+    control = threading.Thread(target=run_control_client)
+    
+    with silenced():
+        flood.start()
+        control.start()
+        end = time.perf_counter() + args.duration + 30
+        while (control.is_alive() or flood.is_alive()) and time.perf_counter() < end:
+            taskMgr.step()
+        if pl.networkThread is not None:
+            paused = pl.networkThread.stats['paused']
+            pl.networkThread.stop()
+    
+    print('Mode: ' + ('network thread' if args.threaded else 'task manager') + ', reader time budget: ' + str(args.budget) + ' ms, simulated rendering: ' + str(args.frame_work) + ' ms per frame')
+    print('DATA commands executed: {0:.0f}/s'.format(pl.get_data_stats()['received']/args.duration))
+    if pl.networkThread is not None:
+        print('Flood client paused {0} times'.format(paused))
+    if latencies:
+        latencies.sort()
+        print('Control command round trip: mean {0:.2f} ms, 95% {1:.2f} ms, max. {2:.2f} ms ({3} commands)'.format(
+            1000*sum(latencies)/len(latencies),1000*latencies[int(0.95*(len(latencies)-1))],1000*latencies[-1],len(latencies)))
+    else:
+        print('No control command has been acknowledged.')
+
+# Ways of loading the models compared by benchmark_startup
+BENCHMARK_STARTUP_MODES = ('.egg files','.egg files, Panda3D model cache','asset cache (.bam files)','preloaded prototypes',
+                           'asynchronous loading (.egg files)','asynchronous loading (asset cache)')
+
+def run_startup(port,mode,results):
+    ''' Process of benchmark_startup that starts the program and adds the first exos and mat in the given mode. Except for the mode 'preloaded prototypes' the preloaded models are discarded, so that they are loaded when the first exos are added (in the background in the asynchronous modes). '''
+    from panda3d.core import loadPrcFileData
+    from advassets import PrototypePool
+    if mode != '.egg files, Panda3D model cache':
+        loadPrcFileData('','model-cache-dir')
+    
+    result = {}
+    start = time.perf_counter()
+    pl = start_program(port)
+    result['startup'] = time.perf_counter() - start
+    result['preloading'] = pl.modelPrototypes.stats['load_time']
+    if mode != 'preloaded prototypes':
+        if mode not in ('asset cache (.bam files)','asynchronous loading (asset cache)'):
+            pl.assetCache = None
+        if mode.startswith('asynchronous'):
+            pl.modelPrototypes = PrototypePool(pl.load_model,pl.load_model_async)
+        else:
+            pl.modelPrototypes = PrototypePool(pl.load_model)
+    
+    with silenced():
+        for name, add in (('first ADDEXO LEFT',lambda: pl.addExoTask(('static','left'),[0,0,0,0,0,0,0])),
+                          ('first ADDEXO RIGHT',lambda: pl.addExoTask(('static','right'),[0,0,0,0,0,0,0])),
+                          ('first ADDBASE',lambda: pl.addBaseTask('static',[0,0,0])),
+                          ('first TOGGLEMAT',lambda: pl.toggleMatTask('LEFT')),
+                          ('second ADDEXO LEFT',lambda: pl.addExoTask(('static','left'),[0,0,0,0,0,0,0]))):
+            start = time.perf_counter()
+            add()
+            result[name] = time.perf_counter() - start
+        # Time until all exos and the mat are shown and longest frame until then
+        start = time.perf_counter()
+        longest = 0.0
+        while not(pl.mat) or not(all(pl.exos[id].exo.hasParent() for id in pl.exo_ids_in_order)):
+            frame_start = time.perf_counter()
+            taskMgr.step()
+            longest = max(longest,time.perf_counter() - frame_start)
+        result['all shown after'] = time.perf_counter() - start
+        result['longest frame until then'] = longest
+        # Longest time needed to add an exo
+        durations = []
+        for i in range(100):
+            start = time.perf_counter()
+            pl.addExoTask(('static',('left','right')[i % 2]),[0,0,0,0,0,0,0])
+            durations.append(time.perf_counter() - start)
+        result['max. of 100 more ADDEXO'] = max(durations)
+    results.put(result)
+
+def benchmark_startup(args):
+    ''' Measures the startup time and the time needed to add the first exos and the first mat (which load the models, unless they have been preloaded) with and without the asset cache (see advassets.py). Each mode runs in a new process, so the models have not been loaded before. The asset cache is built first.
+    The startup time includes preloading the models (from the asset cache) in all modes. '''
+    from advassets import AssetCache
+    
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    
+    start_program(args.port)
+    cache = AssetCache()
+    with silenced():
+        built = cache.build_all()
+    print('Asset cache: {0} model(s) converted in {1:.2f} s'.format(len(built),cache.stats['build_time']))
+    
+    for mode in BENCHMARK_STARTUP_MODES:
+        durations = {}
+        for run in range(args.runs):
+            process = context.Process(target=run_startup,args=(args.port+1+run,mode,results))
+            process.start()
+            result = results.get(timeout=300)
+            process.join()
+            for name in result:
+                durations.setdefault(name,[]).append(result[name])
+        print(mode + ' (best of ' + str(args.runs) + ' runs): ' + ', '.join('{0} {1:.1f} ms'.format(name,1000*min(values)) for name, values in durations.items()))
+
+def resident_memory():
+    ''' Returns the resident memory of the process in bytes (Linux only, otherwise 0). '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError):
+        return 0
+
+def benchmark_trials(args):
+    ''' Adds and deletes exos like an experiment that shows new target exos in every trial, with and without recycling the models of the deleted exos (see ProgramLogic.recycle_exos). '''
+    pl = start_program(args.port)
+    
+    for recycle in (False,True):
+        pl.recycle_exos = recycle
+        pl.exoRecycler.clear()
+        pl.exoRecycler.stats.update(hits=0,misses=0,released=0,discarded=0)
+        add_durations = []
+        remove_durations = []
+        memory = resident_memory()
+        with silenced():
+            for trial in range(args.trials):
+                for i in range(args.exos):
+                    start = time.perf_counter()
+                    pl.addExoTask(('static',('left','right')[i % 2]),[0,0,0,0,0,0,0])
+                    add_durations.append(time.perf_counter() - start)
+                taskMgr.step()
+                for id in list(pl.exo_ids_in_order):
+                    start = time.perf_counter()
+                    pl.removeExoTask(id)
+                    remove_durations.append(time.perf_counter() - start)
+                taskMgr.step()
+        stats = pl.get_recycling_stats()
+        print('{0}: ADDEXO mean {1:.3f} ms, max. {2:.3f} ms; DELETE mean {3:.3f} ms; hit rate {4:.1%}; {5} models kept ({6} nodes); resident memory {7:+.1f} MB'.format(
+            'Recycling' if recycle else 'No recycling',1000*sum(add_durations)/len(add_durations),1000*max(add_durations),1000*sum(remove_durations)/len(remove_durations),
+            stats['hit_rate'],stats['hierarchies'],stats['nodes'],(resident_memory() - memory)/1e6))
+
+def build_scene():
+    ''' Sets up the lights and the camera like advmain.py does. '''
+    from panda3d.core import AmbientLight, PointLight
+    from advlod import DEFAULT_CAMERA_POS
+    alight = base.render.attachNewNode(AmbientLight('alight1'))
+    plight = base.render.attachNewNode(PointLight('plight'))
+    plight.setPos(0,0,10)
+    base.render.setLight(alight)
+    base.render.setLight(plight)
+    base.camera.setPos(*DEFAULT_CAMERA_POS)
+    base.camera.setHpr(0,-30,0)
+
+def open_multisample_buffer(samples):
+    ''' Opens an offscreen buffer with SAMPLES samples per pixel that shows the view of the main camera instead of the offscreen buffer opened by start_program (which is not multisampled with every driver, even if it is configured so). Returns the buffer or None. '''
+    from panda3d.core import AntialiasAttrib, FrameBufferProperties, GraphicsPipe, WindowProperties
+    properties = FrameBufferProperties()
+    properties.setRgbColor(True)
+    properties.setDepthBits(24)
+    properties.setMultisamples(samples)
+    buffer = base.graphicsEngine.makeOutput(base.pipe,'multisample',-2,properties,WindowProperties.size(1280,720),GraphicsPipe.BFRefuseWindow,base.win.getGsg(),base.win)
+    if buffer is None:
+        return None
+    buffer.setClearColor(base.win.getClearColor())
+    base.makeCamera(buffer,lens=base.camLens).reparentTo(base.camera)
+    base.camNode.setActive(False)
+    base.render.setAntialias(AntialiasAttrib.MMultisample)
+    return buffer
+
+def measure_frames(frames):
+    ''' Renders FRAMES frames and returns the mean frame time in seconds. '''
+    for i in range(3):
+        taskMgr.step()
+    start = time.perf_counter()
+    for i in range(frames):
+        taskMgr.step()
+    return (time.perf_counter() - start)/frames
+
+def benchmark_lod(args):
+    ''' Renders a scene with many static exos into an offscreen buffer and measures the frame time and the number of triangles with each level of detail (see advlod.py) and with the levels chosen by the distance from the camera. '''
+    from advassets import EXO_MODEL_NAMES
+    from advlod import count_triangles
+    
+    pl = start_program(args.port,window_type='offscreen')
+    if base.win is None:
+        print('No offscreen buffer could be opened.')
+        return
+    with silenced():
+        pl.assetCache.build_all()
+    if not(all(pl.assetCache.has_lods(name) for name in EXO_MODEL_NAMES)) or not(pl.use_lod):
+        print('The levels of detail are not available.')
+        return
+    pl.instance_static_exos = False
+    build_scene()
+    print('Renderer: ' + base.win.getGsg().getDriverRenderer())
+    
+    # The exos stand in a grid on and behind the mat
+    with silenced():
+        for i in range(args.exos):
+            pl.addExoTask(('static',('left','right')[i % 2]),[2.0*(i % 6),2.0*(i // 6),0,0,0,0,0])
+    lods = base.render.findAllMatches('**/+LODNode')
+    camera = base.camera.getPos(base.render)
+    
+    for level in range(lods[0].node().getNumSwitches()):
+        for lod in lods:
+            lod.node().forceSwitch(level)
+        triangles = sum(count_triangles(lod.getChild(level)) for lod in lods)
+        print('Level {0}: {1} triangles per exo, frame time {2:.2f} ms'.format(level,triangles//args.exos,1000*measure_frames(args.frames)))
+    
+    # Levels chosen by the distance from the camera
+    levels = [0]*lods[0].node().getNumSwitches()
+    triangles = 0
+    for lod in lods:
+        lod.node().clearForceSwitch()
+        distance = (lod.getPos(base.render) - camera).length()
+        level = sum(1 for d in pl.lod_distances if distance > d)
+        levels[level] += 1
+        triangles += count_triangles(lod.getChild(level))
+    print('By distance: {0} triangles in total (exo parts per level: {1}), frame time {2:.2f} ms'.format(triangles,', '.join(str(count) for count in levels),1000*measure_frames(args.frames)))
+
+def benchmark_flatten(args):
+    ''' Renders a scene with many static exos and the mat into an offscreen buffer and measures the number of geoms (about the number of draw calls) and nodes and the frame time with and without merging the parts of the static exos (see ProgramLogic.tskFlattenExo). With REALTIME the exos are real-time exos, of which only the base and the armrest are merged. '''
+    pl = start_program(args.port,window_type='offscreen')
+    if base.win is None:
+        print('No offscreen buffer could be opened.')
+        return
+    pl.instance_static_exos = False
+    build_scene()
+    # Flattening does not merge geoms beyond the number of vertices the renderer accepts per geom
+    print('Renderer: ' + base.win.getGsg().getDriverRenderer() + ' (max. ' + str(base.win.getGsg().getMaxVerticesPerArray()) + ' vertices per geom)')
+    with silenced():
+        pl.toggleMatTask('left')
+    
+    exotype = 'realtime' if args.realtime else 'static'
+    for flatten in (False,True):
+        pl.flatten_static_exos = flatten
+        pl.flatten_moving_exos = flatten
+        with silenced():
+            for i in range(args.exos):
+                pl.addExoTask((exotype,('left','right')[i % 2]),[2.0*(i % 6),2.0*(i // 6),0,0,0,0,0])
+            # Wait until the exos have been merged (one level of detail per frame)
+            start = time.perf_counter()
+            frames = 0
+            while flatten and not(all(pl.exos[id].modeldata['flat'] is not None for id in pl.exo_ids_in_order)):
+                taskMgr.step()
+                frames += 1
+            merge_time = time.perf_counter() - start
+        stats = pl.get_draw_stats()
+        print('{0}: {1} geoms, {2} nodes, frame time {3:.2f} ms'.format('Merged' if flatten else 'Separate parts',stats['geoms'],stats['nodes'],1000*measure_frames(args.frames))
+              + (' (merged in {0} frames, {1:.0f} ms)'.format(frames,1000*merge_time) if flatten else ''))
+        with silenced():
+            for id in list(pl.exo_ids_in_order):
+                pl.removeExoTask(id)
+            taskMgr.step()
+
+def benchmark_instancing(args):
+    ''' Renders many static exos into an offscreen buffer as separate (merged) models and with hardware instancing (see advinstancing.py) and measures the number of geoms (about the number of draw calls), the time needed to add the exos and the frame time, compared to a single exo. All exos are shown at the same level of detail. '''
+    pl = start_program(args.port,window_type='offscreen')
+    if base.win is None:
+        print('No offscreen buffer could be opened.')
+        return
+    build_scene()
+    # All exos are in view (the instances are not culled one by one)
+    base.camera.setPos(19,-32,40)
+    base.camera.lookAt(19,9,0)
+    print('Renderer: ' + base.win.getGsg().getDriverRenderer())
+    if not(pl.use_instancing()):
+        print('Hardware instancing is not supported by the renderer.')
+        return
+    pl.instance_lod_level = args.level
+    
+    for instanced, count in ((False,1),(False,args.exos),(True,1),(True,args.exos)):
+        pl.instance_static_exos = instanced
+        with silenced():
+            start = time.perf_counter()
+            for i in range(count):
+                pl.addExoTask(('static',('left','right')[i % 2]),[2.0*(i % 20),2.0*(i // 20),0,0,0,0,0])
+            add_time = time.perf_counter() - start
+            # Wait until the instances have been uploaded and the separate exos have been merged
+            taskMgr.step()
+            while not(all(pl.exos[id].modeldata['flat'] is not None or 'instances' in pl.exos[id].modeldata for id in pl.exo_ids_in_order)):
+                taskMgr.step()
+        for lod in base.render.findAllMatches('**/+LODNode'):
+            lod.node().forceSwitch(min(args.level,lod.node().getNumSwitches() - 1))
+        stats = pl.get_draw_stats()
+        print('{0}, {1} exo(s): {2} geoms, {3} nodes, added in {4:.1f} ms, frame time {5:.2f} ms'.format(
+            'Instanced' if instanced else 'Separate models',count,stats['geoms'],stats['nodes'],1000*add_time,1000*measure_frames(args.frames)))
+        with silenced():
+            for id in list(pl.exo_ids_in_order):
+                pl.removeExoTask(id)
+            taskMgr.step()
+
+def benchmark_states(args):
+    ''' Renders exos whose parts are colored from a small palette into an offscreen buffer, with shared materials (see advassets.MaterialCache) and with a new material per color change, and measures the number of render states and materials in the scene, the time per color change and the frame time. '''
+    import random
+    
+    pl = start_program(args.port,window_type='offscreen')
+    if base.win is None:
+        print('No offscreen buffer could be opened.')
+        return
+    build_scene()
+    palette = [(random.random(),random.random(),random.random()) for i in range(args.colors)]
+    
+    for shared in (False,True):
+        pl.materialCache.shared = shared
+        with silenced():
+            for i in range(args.exos):
+                pl.addExoTask(('realtime',('left','right')[i % 2]),[20.0*(i % 6),20.0*(i // 6),0,0,0,0,0])
+            taskMgr.step()
+        exos = [pl.exos[id] for id in pl.exo_ids_in_order]
+        tasks = [exo.setColorBaseTask for exo in exos] + [exo.setColorArmRestTask for exo in exos] + [exo.setColorPronoTask for exo in exos] + [exo.setColorIndexTask for exo in exos]
+        random.seed(1)
+        start = time.perf_counter()
+        for i in range(args.changes):
+            random.choice(tasks)(random.choice(palette))
+        change_time = (time.perf_counter() - start)/args.changes
+        stats = pl.get_state_stats()
+        print('{0}: {1} render states and {2} materials in the scene ({3} render states in total), color change {4:.1f} us, frame time {5:.2f} ms'.format(
+            'Shared materials' if shared else 'Material per change',stats['states'],stats['materials'],stats['render_states'],1e6*change_time,1000*measure_frames(args.frames)))
+        with silenced():
+            for id in list(pl.exo_ids_in_order):
+                pl.removeExoTask(id)
+            taskMgr.step()
+
+def benchmark_transparency(args):
+    ''' Renders overlapping transparent exos into an offscreen buffer in each transparency mode (see advclasses.TRANSPARENCY_MODES) and measures the time needed to toggle the transparency and the frame time, compared to opaque exos. '''
+    from advclasses import TRANSPARENCY_MODES
+    
+    pl = start_program(args.port,window_type='offscreen')
+    if base.win is None:
+        print('No offscreen buffer could be opened.')
+        return
+    build_scene()
+    # The mode MULTISAMPLE needs a multisample buffer
+    samples = 0
+    if args.multisamples:
+        buffer = open_multisample_buffer(args.multisamples)
+        samples = buffer.getFbProperties().getMultisamples() if buffer is not None else 0
+    print('Renderer: ' + base.win.getGsg().getDriverRenderer() + ' (' + str(samples) + ' samples per pixel)')
+    
+    # The exos stand close together, so that the transparent exos overlap
+    with silenced():
+        for i in range(args.exos):
+            pl.addExoTask(('realtime',('left','right')[i % 2]),[5.0*(i % 4),5.0*(i // 4),0,0,0,0,0])
+        taskMgr.step()
+    exos = [pl.exos[id] for id in pl.exo_ids_in_order]
+    print('Opaque: frame time {0:.2f} ms'.format(1000*measure_frames(args.frames)))
+    
+    for mode in TRANSPARENCY_MODES:
+        start = time.perf_counter()
+        for exo in exos:
+            exo.toggleTransparencyTask(mode)
+        toggle_time = (time.perf_counter() - start)/len(exos)
+        stats = pl.get_state_stats()
+        print('{0}: toggled in {1:.1f} us per exo, {2} render states in the scene, frame time {3:.2f} ms'.format(mode,1e6*toggle_time,stats['states'],1000*measure_frames(args.frames)))
+        for exo in exos:
+            exo.toggleTransparencyTask()
+
+def benchmark_replay(args):
+    ''' Replays a recorded session (see advrecorder.py) as fast as possible, i.e. one recorded frame per frame without rendering, and measures the throughput. '''
+    from advrecorder import SessionReplay
+    
+    pl = start_program(args.port)
+    replay = SessionReplay(pl,args.session,realtime=False)
+    
+    with silenced():
+        start = time.perf_counter()
+        while replay.feed_frame():
+            taskMgr.step()
+        duration = time.perf_counter() - start
+    
+    stats = replay.stats
+    print('{0} records ({1} bytes) in {2} frames replayed in {3:.3f} s: {4:.0f} records/s, {5:.2f} MB/s, {6:.0f} frames/s'.format(
+        stats['records'],stats['bytes'],stats['frames'],duration,stats['records']/duration,stats['bytes']/duration/1e6,stats['frames']/duration))
+    print('Exos after the replay: ' + ', '.join(pl.exo_ids_in_order))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the advanced feedback.')
+    parser.add_argument('--port',type=int,default=9950,help='TCP port used by the benchmark (default: 9950)')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    
+    parser_parse = subparsers.add_parser('parse',help='Parse and dispatch cost per command')
+    parser_parse.add_argument('--batch',type=int,default=100,help='Commands per datagram (default: 100)')
+    parser_parse.add_argument('--repetitions',type=int,default=200,help='Datagrams per command and run (default: 200)')
+    parser_parse.add_argument('--runs',type=int,default=5,help='Number of runs, the fastest run is reported (default: 5)')
+    parser_parse.set_defaults(function=benchmark_parse)
+    
+    parser_network = subparsers.add_parser('network',help='Frame time and input latency while DATA commands are streamed')
+    parser_network.add_argument('--threaded',action='store_true',help='Read the connections with the network thread')
+    parser_network.add_argument('--shared-memory',action='store_true',help='Write the samples to the shared-memory ring buffer instead of sending them')
+    parser_network.add_argument('--rate',type=int,default=1000,help='Commands per second (default: 1000)')
+    parser_network.add_argument('--duration',type=float,default=5.0,help='Duration in seconds (default: 5)')
+    parser_network.add_argument('--frame-work',type=float,default=10.0,help='Simulated rendering time per frame in milliseconds (default: 10)')
+    parser_network.set_defaults(function=benchmark_network)
+    
+    parser_session = subparsers.add_parser('session',help='Time needed to add a number of exos')
+    parser_session.add_argument('--threaded',action='store_true',help='Read the connections with the network thread')
+    parser_session.add_argument('--exos',type=int,default=12,help='Number of exos (default: 12)')
+    parser_session.add_argument('--pipelined',action='store_true',help='Send all ADDEXO commands without waiting for the replies')
+    parser_session.add_argument('--frame-work',type=float,default=10.0,help='Simulated rendering time per frame in milliseconds (default: 10)')
+    parser_session.set_defaults(function=benchmark_session)
+    
+    parser_client = subparsers.add_parser('client',help='Throughput of the client library')
+    parser_client.add_argument('--threaded',action='store_true',help='Read the connections with the network thread')
+    parser_client.add_argument('--commands',type=int,default=100000,help='Number of DATA commands (default: 100000)')
+    parser_client.add_argument('--frame-work',type=float,default=10.0,help='Simulated rendering time per frame in milliseconds (default: 10)')
+    parser_client.set_defaults(function=benchmark_client)
+    
+    parser_fairness = subparsers.add_parser('fairness',help='Round trip of control commands while another client floods the program with DATA commands')
+    parser_fairness.add_argument('--threaded',action='store_true',help='Read the connections with the network thread')
+    parser_fairness.add_argument('--duration',type=float,default=5.0,help='Duration in seconds (default: 5)')
+    parser_fairness.add_argument('--budget',type=float,default=5.0,help='Time budget of the reader per frame in milliseconds (default: 5)')
+    parser_fairness.add_argument('--frame-work',type=float,default=10.0,help='Simulated rendering time per frame in milliseconds (default: 10)')
+    parser_fairness.set_defaults(function=benchmark_fairness)
+    
+    parser_startup = subparsers.add_parser('startup',help='Startup time and time needed to add the first exos with and without the asset cache')
+    parser_startup.add_argument('--runs',type=int,default=3,help='Number of runs, the fastest run is reported (default: 3)')
+    parser_startup.set_defaults(function=benchmark_startup)
+    
+    parser_trials = subparsers.add_parser('trials',help='Time needed to add and delete exos in every trial with and without recycling their models')
+    parser_trials.add_argument('--trials',type=int,default=500,help='Number of trials (default: 500)')
+    parser_trials.add_argument('--exos',type=int,default=4,help='Exos added and deleted per trial (default: 4)')
+    parser_trials.set_defaults(function=benchmark_trials)
+    
+    parser_lod = subparsers.add_parser('lod',help='Frame time and triangles with each level of detail of the exo models (renders offscreen)')
+    parser_lod.add_argument('--exos',type=int,default=24,help='Number of exos (default: 24)')
+    parser_lod.add_argument('--frames',type=int,default=50,help='Frames per measurement (default: 50)')
+    parser_lod.set_defaults(function=benchmark_lod)
+    
+    parser_flatten = subparsers.add_parser('flatten',help='Draw calls and frame time with and without merging the parts of static exos (renders offscreen)')
+    parser_flatten.add_argument('--exos',type=int,default=24,help='Number of exos (default: 24)')
+    parser_flatten.add_argument('--frames',type=int,default=50,help='Frames per measurement (default: 50)')
+    parser_flatten.add_argument('--realtime',action='store_true',help='Real-time exos instead of static exos (only the base and the armrest are merged)')
+    parser_flatten.set_defaults(function=benchmark_flatten)
+    
+    parser_instancing = subparsers.add_parser('instancing',help='Draw calls and frame time of many static exos with and without hardware instancing (renders offscreen)')
+    parser_instancing.add_argument('--exos',type=int,default=200,help='Number of exos (default: 200)')
+    parser_instancing.add_argument('--level',type=int,default=2,help='Level of detail of the exos (default: 2, the simplest)')
+    parser_instancing.add_argument('--frames',type=int,default=50,help='Frames per measurement (default: 50)')
+    parser_instancing.set_defaults(function=benchmark_instancing)
+    
+    parser_states = subparsers.add_parser('states',help='Render states, materials and frame time of colored exos with and without shared materials (renders offscreen)')
+    parser_states.add_argument('--exos',type=int,default=24,help='Number of exos (default: 24)')
+    parser_states.add_argument('--colors',type=int,default=4,help='Number of colors of the palette (default: 4)')
+    parser_states.add_argument('--changes',type=int,default=5000,help='Number of color changes (default: 5000)')
+    parser_states.add_argument('--frames',type=int,default=50,help='Frames per measurement (default: 50)')
+    parser_states.set_defaults(function=benchmark_states)
+    
+    parser_transparency = subparsers.add_parser('transparency',help='Frame time of overlapping transparent exos in each transparency mode (renders offscreen)')
+    parser_transparency.add_argument('--exos',type=int,default=12,help='Number of transparent exos (default: 12)')
+    parser_transparency.add_argument('--multisamples',type=int,default=4,help='Samples per pixel of the offscreen buffer, 0 for none (the mode MULTISAMPLE is then opaque, default: 4)')
+    parser_transparency.add_argument('--frames',type=int,default=50,help='Frames per measurement (default: 50)')
+    parser_transparency.set_defaults(function=benchmark_transparency)
+    
+    parser_replay = subparsers.add_parser('replay',help='Throughput of the replay of a recorded session')
+    parser_replay.add_argument('session',help='Session log (see advrecorder.py)')
+    parser_replay.set_defaults(function=benchmark_replay)
+    
+    args = parser.parse_args()
+    args.function(args)
+    
+if __name__ == '__main__':
+    main()
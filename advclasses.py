@@ -6,14 +6,53 @@ from math import pi, sin, cos, sqrt
 from panda3d.core import *
 from direct.task import Task
 
+from advprotocol import CommandStreamBuffer, CommandRegistry, CommandSpec, is_newer_sequence, is_restarted_sequence
+from advprotocol import parse_string, parse_int, parse_float, parse_choice, parse_floats, parse_color, parse_token, split_request, format_reply, pack_binary_data
+from advnetwork import NetworkThread, ConnectionStatistics
+from advrecorder import SessionRecorder, SessionReplay, RECORD_TCP, RECORD_UDP
+from advlog import get_logger, setup_logging, MessageCounter
+from advsharedmemory import PoseRingBuffer, DEFAULT_POSE_BUFFER_PATH
+from advassets import AssetCache, PrototypePool, RecyclingPool, MaterialCache, flatten_model, EXO_MODEL_NAMES, MAT_MODEL_NAMES
+from advlod import LOD_DISTANCES, select_level, make_lod
+from advinstancing import InstancedModel, supports_instancing
+
+from collections import deque
+from functools import partial
+
+import logging
 import random
 import string
 import sys
+import time
 #import yaml
 #import numpy
 
 # ### Begin ### #
 
+# Sort of the tasks that move the exos. They run after the network tasks (sort 0), so all samples received in a frame are rendered in the same frame.
+MOVE_TASK_SORT = 10
+# Sort of the task that updates the instanced static exos (see ProgramLogic.tskUpdateInstances). It runs after the tasks that move and color the exos.
+INSTANCE_TASK_SORT = 15
+# Sort of the task that sends the replies. It runs after the tasks that are added by the commands (e.g. addExoTask), so that all replies of a frame are sent together.
+REPLY_TASK_SORT = 20
+
+# Transparency modes of the exos (see Logic.toggleTransparencyTask). The render state of the mode is composed with the state of the root of a transparent exo.
+# ALPHA: blended after the opaque objects (sorted back to front by exo) without writing the depth. One pass, but the parts of an exo may be blended in the wrong order.
+# DUAL: the opaque pixels are drawn with the opaque objects, the others are blended in a second pass. The most correct and most expensive mode (the default).
+# MULTISAMPLE: alpha to coverage, drawn with the opaque objects in any order. Needs a multisample framebuffer (framebuffer-multisample and multisamples in the Panda3D configuration), otherwise the exo is drawn opaque.
+# BINARY: alpha test, drawn with the opaque objects. The cheapest mode, but the exo is drawn opaque as its alpha (TRANSPARENT_ALPHA) is above the threshold of 0.5.
+# Instanced static exos (see ProgramLogic.tskUpdateInstances) are always drawn with the mode DUAL when they are transparent.
+TRANSPARENCY_MODES = ('ALPHA','DUAL','MULTISAMPLE','BINARY')
+TRANSPARENT_ALPHA = 0.65
+TRANSPARENCY_STATES = {'ALPHA': RenderState.make(TransparencyAttrib.make(TransparencyAttrib.MAlpha),ColorScaleAttrib.make((1,1,1,TRANSPARENT_ALPHA)),DepthWriteAttrib.make(DepthWriteAttrib.MOff),CullBinAttrib.make('transparent',0)),
+                       'DUAL': RenderState.make(TransparencyAttrib.make(TransparencyAttrib.MDual),ColorScaleAttrib.make((1,1,1,TRANSPARENT_ALPHA)),DepthWriteAttrib.make(DepthWriteAttrib.MOn),CullBinAttrib.make('',0)),
+                       'MULTISAMPLE': RenderState.make(TransparencyAttrib.make(TransparencyAttrib.MMultisample),ColorScaleAttrib.make((1,1,1,TRANSPARENT_ALPHA)),DepthWriteAttrib.make(DepthWriteAttrib.MOn),CullBinAttrib.make('opaque',0)),
+                       'BINARY': RenderState.make(TransparencyAttrib.make(TransparencyAttrib.MBinary),ColorScaleAttrib.make((1,1,1,TRANSPARENT_ALPHA)),DepthWriteAttrib.make(DepthWriteAttrib.MOn),CullBinAttrib.make('opaque',0))}
+# Render state of an opaque exo (overrides the attributes of the transparency modes)
+OPAQUE_STATE = RenderState.make(TransparencyAttrib.make(TransparencyAttrib.MNone),ColorScaleAttrib.makeOff(),DepthWriteAttrib.make(DepthWriteAttrib.MOn),CullBinAttrib.make('',0))
+
+log = get_logger('logic')
+
 # ### Logic controllers ### #
 
 class Logic(object):
@@ -26,41 +65,53 @@ class Logic(object):
         self.dc = dataController
         
         self.modelTransparencySet = False
+        # Mode in which the exo is drawn while it is transparent (see TRANSPARENCY_MODES). Set by the program logic.
+        self.transparencyMode = 'DUAL'
+        
+        # Models of the exo as created by the program logic (see ProgramLogic.create_exo_model), the task that moves it and the shared materials (see advassets.MaterialCache). Set by the program logic.
+        self.modeldata = None
+        self.moveTask = None
+        self.materials = None
+        
+    def articulate(self):
+        ''' Shows the parts of the exo as separate nodes again if they have been merged (see ProgramLogic.tskFlattenExo), so that they can be changed individually. The exo is not merged again. '''
+        data = self.modeldata
+        if data is None:
+            return
+        data['articulated'] = True
+        if data.get('flat') is not None:
+            data['flat'].removeNode()
+            data['flat'] = None
+            for part in data.pop('flat_parts',()):
+                part.unstash()
         
     def setColorBaseTask(self,color):
         ''' This task sets to color (lighting) of the base model. '''
         
-        material = self.exo.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.exo.setMaterial(material)
+        self.exo.setMaterial(self.materials.get('exo',color))
         
         return Task.done
         
     def setColorArmRestTask(self,color):
         ''' This task sets to color (lighting) of the base model. '''
-        material = self.armrest.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.armrest.setMaterial(material)
+        self.articulate()
+        self.armrest.setMaterial(self.materials.get('arm',color))
         
         return Task.done
     
-    def toggleTransparencyTask(self,task):
-        ''' This task toggles the transparency of the exo model. '''
+    def toggleTransparencyTask(self,mode=None):
+        ''' This task toggles the transparency of the exo model. If a MODE (see TRANSPARENCY_MODES) is given, the exo is drawn in that mode from now on; a transparent exo in another mode stays transparent and only changes its mode.
+        The render states of the modes are precomputed, so toggling only composes them with the state of the exo (which Panda3D caches) and changes no material. '''
         
-        self.modelTransparencySet = not self.modelTransparencySet
-        
-        if self.modelTransparencySet:
-            self.exo.setColorScale((1,1,1,0.65))
-            self.exo.setTransparency(TransparencyAttrib.MDual)
-            tmpMat = self.exo.getMaterial()
-            tmpMat.setDiffuse((0.25,0.25,0.25,1))
-            self.exo.setMaterial(tmpMat)
+        if mode is not None and mode != self.transparencyMode and self.modelTransparencySet:
+            self.transparencyMode = mode
         else:
-            self.exo.setColorScaleOff()
-            self.exo.setTransparency(TransparencyAttrib.MNone)        
-            tmpMat = self.exo.getMaterial()
-            tmpMat.setDiffuse((0.25,0.25,0.25,.25))
-            self.exo.setMaterial(tmpMat)
+            if mode is not None:
+                self.transparencyMode = mode
+            self.modelTransparencySet = not self.modelTransparencySet
+        
+        state = TRANSPARENCY_STATES[self.transparencyMode] if self.modelTransparencySet else OPAQUE_STATE
+        self.exo.setState(self.exo.getState().compose(state))
         
         return Task.done
 
@@ -99,36 +150,32 @@ class ExoLogic(Logic):
     def setColorPronoTask(self,color):
         ''' This task sets the color (lighting) of the pronation module. '''
         
-        material = self.prono.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.prono.setMaterial(material)
+        self.articulate()
+        self.prono.setMaterial(self.materials.get('arm',color))
         
         return Task.done
     
     def setColorIndexTask(self,color):
         ''' This task sets the color (lighting) of the index finger. '''
         
-        material = self.findex.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.findex.setMaterial(material)
+        self.articulate()
+        self.findex.setMaterial(self.materials.get('arm',color))
         
         return Task.done
 
     def setColorFingerGroupTask(self,color):
         ''' This task sets the color (lighting) of the finger group. '''
         
-        material = self.fgroup.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.fgroup.setMaterial(material)
+        self.articulate()
+        self.fgroup.setMaterial(self.materials.get('arm',color))
         
         return Task.done
 
     def setColorThumbTask(self,color):
         ''' This task sets the color (lighting) of the thumb. '''
         
-        material = self.fthumb.getMaterial()
-        material.setAmbient((color[0],color[1],color[2],1))
-        self.fthumb.setMaterial(material)
+        self.articulate()
+        self.fthumb.setMaterial(self.materials.get('arm',color))
         
         return Task.done
     
@@ -460,14 +507,41 @@ class ExoDataControllerStatic():
         
         return (self.robot,self.prono,self.findex,self.fgroup,self.fthumb)
         
-# class DataControllerPlayback():
-# Playback predefined trajectory at the correct speed
-#FIXME This is not necessary! Instead a DataControllerRealTime should be created and the client should read a file and send it via TCP
+# Playback of predefined trajectories at the correct speed is done by a client that reads the file and sends it to a realtime exo via TCP (see advstreamer.py)
+
+class DataControllerRealTime(object):
+    ''' Superclass of the DataControllers that receive their kinematics data through the network. 
+    The samples are collected in a mailbox that only keeps the newest sample. The sample is applied when the exo logic retrieves the data (once per frame), so samples that are superseded within a frame are not calibrated and applied.
+    The samples are converted and checked when their command is parsed, so only valid samples reach the mailbox. '''
+    
+    def __init__(self):
+        # Newest sample (floats, x and y already divided by 10) that has not been applied yet
+        self.pending = None
+        # Monitoring counters
+        self.samples_received = 0
+        self.samples_coalesced = 0
+        
+    def post_data(self,exoparams):
+        ''' Puts a new sample into the mailbox. A sample that has not been applied yet is replaced. '''
+        if self.pending is not None:
+            self.samples_coalesced += 1
+        self.pending = exoparams
+        self.samples_received += 1
+        
+    def apply_data(self):
+        ''' Sets the sample in the mailbox as the current kinematics. '''
+        exoparams = self.pending
+        if exoparams is None:
+            return
+        self.pending = None
+        
+        self.set_data(exoparams)
 
-class ExoDataControllerRealTime():
+class ExoDataControllerRealTime(DataControllerRealTime):
     ''' A DataController that holds the kinematics data which it has received through TCP. '''
     
     def __init__(self, id, calibration, handedness):
+        super(ExoDataControllerRealTime, self).__init__()
     
         self.id = id
         self.calibration = calibration
@@ -498,12 +572,13 @@ class ExoDataControllerRealTime():
         
     def get_data(self,exo_state):
         ''' Function that returns the position data to the exo logic object '''
+        self.apply_data()
         
         return (self.robot,self.prono,self.findex,self.fgroup,self.fthumb)
         
-        def setconfig(self,calibration):
-            ''' Sets the given cfgprofile as calibration profile.'''
-            self.calibration = calibration
+    def setconfig(self,calibration):
+        ''' Sets the given cfgprofile as calibration profile.'''
+        self.calibration = calibration
         
 class BaseDataControllerKeyboard():
     ''' A DataController that is used to control the kinematics of an exo that has only a base and no arm position according to the keyboard input. '''
@@ -646,10 +721,11 @@ class BaseDataControllerStatic():
         
         return (self.robot)
         
-class BaseDataControllerRealTime():
+class BaseDataControllerRealTime(DataControllerRealTime):
     ''' A DataController that is used to control an exo that has only a base and no arm. It receives the kinematics data through TCP. '''
     
     def __init__(self, id, calibration):
+        super(BaseDataControllerRealTime, self).__init__()
     
         self.id = id
         self.calibration = calibration
@@ -667,28 +743,73 @@ class BaseDataControllerRealTime():
         
     def get_data(self,exo_state):
         ''' Function that returns the position data to the exo logic object '''
+        self.apply_data()
         
         return (self.robot)
         
-        def setconfig(self,calibration):
-            ''' Sets the given cfgprofile as calibration profile.'''
-            self.calibration = calibration
+    def setconfig(self,calibration):
+        ''' Sets the given cfgprofile as calibration profile.'''
+        self.calibration = calibration
         
         
 
 # ### Program logic ### #
 class ProgramLogic():
-    ''' ProgramLogic that controls creating and removing exos and their corresponding data controllers '''
+    ''' ProgramLogic that controls creating and removing exos and their corresponding data controllers. The optional channels of the command interface are enabled by the keyword arguments (see the attributes of the same names below). '''
     
-    def __init__(self,render):
+    def __init__(self,render,port_address=9900,network_thread=False,record_file=None,udp_enabled=False,udp_port_address=9900,shm_enabled=False,shm_path=DEFAULT_POSE_BUFFER_PATH,shm_slots=1024):
+        # Logging (see advlog.py): messages below LOG_LEVEL are discarded, at most LOG_RATE_LIMIT messages of the same type are written per second and the messages are also written to LOG_FILE (if not None)
+        self.log_level = logging.INFO
+        self.log_rate_limit = 10
+        self.log_file = None
+        setup_logging(self.log_level,self.log_file,self.log_rate_limit)
+        # Interval in seconds in which the number of received commands (by command) is logged (0: never). Each single command is logged at the level DEBUG.
+        self.command_log_interval = 1.0
+        self.command_counter = MessageCounter(log)
+        
         # Dict that contains all exos (Using a dict to be able to use hashmap-like random ids. Better for adding and removing exos.)
         self.exos = {}
         # This list contains all the ids of the exos in the order they were added to the program
         self.exo_ids_in_order = []
-        # This is the mat of the scene
+        # This is the mat of the scene and the mat requested last (which replaces the mat when its model has been loaded)
         self.mat = []
+        self.requestedMat = None
         # This is referring to the root of the rendering tree
         self.rootNode = render
+        # If True the models are loaded from .bam files that are converted from the .egg files once (see advassets.py)
+        self.use_asset_cache = True
+        self.assetCache = AssetCache() if self.use_asset_cache else None
+        # If USE_LOD is True, the exo models show simplified levels of detail beyond LOD_DISTANCES from the camera (see advlod.py). The levels are built by "python advassets.py".
+        self.use_lod = True
+        self.lod_distances = LOD_DISTANCES
+        if self.use_lod and self.assetCache is not None and not(all(self.assetCache.has_lods(name) for name in EXO_MODEL_NAMES)):
+            log.warning('The levels of detail of the exo models have not been built ("python advassets.py"). The exos are shown at full detail.')
+        # The exos and mats are copied from prototypes (see advassets.PrototypePool). If PRELOAD_MODELS is True, all prototypes are loaded at startup, so adding an exo does not read any file.
+        # If ASYNC_LOADING is True, prototypes that have not been loaded yet are loaded in the background. The exo is added (and its id returned) at once and shown as soon as its models have been loaded.
+        self.preload_models = True
+        self.async_loading = True
+        self.modelPrototypes = PrototypePool(self.load_model,self.load_model_async if self.async_loading else None)
+        if self.preload_models:
+            self.modelPrototypes.preload(EXO_MODEL_NAMES + MAT_MODEL_NAMES)
+            log.info('Models preloaded in %.0f ms.',self.modelPrototypes.stats['load_time']*1000)
+        # If RECYCLE_EXOS is True, the models of deleted exos are kept (at most RECYCLE_MAX_EXOS per type and handedness) and reused by the next exos of the same type (see advassets.RecyclingPool)
+        self.recycle_exos = True
+        self.recycle_max_exos = 32
+        self.exoRecycler = RecyclingPool(self.recycle_max_exos)
+        # If FLATTEN_STATIC_EXOS is True, the parts of static exos and bases, which never move, are merged into as few geoms as possible (see tskFlattenExo) in the frames after they have been added. The parts are separated again when one of them is colored.
+        self.flatten_static_exos = True
+        # If FLATTEN_MOVING_EXOS is True, the models of the base and the armrest of real-time and keyboard exos and bases, which never move relative to each other, are merged as well. The exo moves as a whole and its arm keeps moving.
+        self.flatten_moving_exos = True
+        # The exos that look the same share their materials (see advassets.MaterialCache)
+        self.materialCache = MaterialCache()
+        # Mode in which transparent exos are drawn unless TOGGLETRANSPARENCY selects another one (see TRANSPARENCY_MODES)
+        self.transparency_mode = 'DUAL'
+        # If INSTANCE_STATIC_EXOS is True and the graphics card supports it, static exos and bases are drawn with hardware instancing (see advinstancing.py): all static exos share the models of their parts and cost a few draw calls, however many there are. The models are shown at the level of detail INSTANCE_LOD_LEVEL (0: full detail).
+        self.instance_static_exos = True
+        self.instance_lod_level = 0
+        # Instanced models by model name (None: not created yet, False: instancing is not supported) and the exos whose instances have to be updated
+        self.instancedModels = None
+        self.instanceUpdates = []
         # Representation of a configuration profile (calibration file)
         tmp_profile = self.loadconfig('default')
 
@@ -698,26 +819,110 @@ class ProgramLogic():
         else:
             self.cfgprofile = tmp_profile
         
+        # Table of the commands of the command interface
+        self.register_commands()
+        
+        # If RECORD_FILE is not None, all data received through the network is recorded to this session log (see advrecorder.py), which can be replayed with start_replay
+        self.record_file = record_file
+        self.recorder = None
+        if self.record_file is not None:
+            self.recorder = SessionRecorder(self.record_file)
+            log.info('Recording session to %s.',self.recorder.filename)
+        # Replay of a session log (see start_replay) and the recorded ids of the exos, which are assigned to the exos of the replay
+        self.replay = None
+        self.replay_ids = deque()
+        
         # Setup network protocol for the command interface
         self.cManager = QueuedConnectionManager()
         self.cListener = QueuedConnectionListener(self.cManager, 0)
         self.cReader = QueuedConnectionReader(self.cManager, 0)
         self.cReader.setRawMode(True)
         self.cWriter = ConnectionWriter(self.cManager, 0)
+        self.cWriter.setRawMode(True)
         
         # Network protocol configuration for the command interface
         self.activeConnections = []
-        self.port_address=9900
-        self.backlog = 2
-        self.tcpSocket = self.cManager.openTCPServerRendezvous(self.port_address,self.backlog)
+        # Receive buffers of the connections (the commands of a connection arrive as a stream)
+        self.receiveBuffers = {}
+        # Bytes and commands received per connection (the network thread keeps them with its connections)
+        self.connectionStats = {}
+        # Replies of the current frame by connection (see tskSendReplies)
+        self.pendingReplies = {}
+        # Request number of the command that is executed (see advprotocol.split_request)
+        self.request = None
+        self.port_address = port_address
+        # Number of connection requests that may wait to be accepted (e.g. several clients that connect at the same time)
+        self.backlog = 16
+        # If True the connections are accepted, read and parsed by a separate thread (see advnetwork.NetworkThread). Only the parsed commands are handed to the render loop (tskActionPolling).
+        # The commands of the connections are then queued separately and executed round-robin, so a client that streams DATA samples cannot starve a client that sends control commands.
+        self.network_thread = network_thread
+        # Maximum number of bytes of commands of a connection that have been received but not executed yet (network thread only). A connection that exceeds it is not read until the render loop has caught up.
+        self.connection_max_bytes = 262144
+        
+        if self.network_thread:
+            self.tcpSocket = None
+            self.networkThread = NetworkThread(self.port_address,self.backlog,self.commands.parse,self.connection_max_bytes,recorder=self.recorder)
+        else:
+            self.networkThread = None
+            self.tcpSocket = self.cManager.openTCPServerRendezvous(self.port_address,self.backlog)
+        
+        # Reader configuration. In 'drain' mode all datagrams that are available are read in one frame (within the budgets below), in 'single' mode at most one datagram is read per frame.
+        self.reader_mode = 'drain'
+        # Maximum number of datagrams read per frame (0: no limit)
+        self.reader_max_datagrams = 0
+        # Maximum time in seconds spent reading datagrams per frame (0: no limit)
+        self.reader_time_budget = 0.005
+        # Interval in seconds in which the reader statistics are printed (0: never)
+        self.reader_stats_interval = 0
+        # Statistics of the reader. The 'interval' values are reset each time the statistics are printed.
+        self.reader_stats = {'frames': 0, 'datagrams': 0, 'bytes': 0,
+                             'datagrams_last_frame': 0, 'datagrams_peak': 0, 'datagrams_peak_interval': 0,
+                             'backlog_peak': 0, 'backlog_peak_interval': 0,
+                             'frames_truncated': 0, 'overflow': False}
+        # Frame time and input latency (time from receiving a command until it is executed, network thread only). The values are summed up and reset each time the statistics are printed.
+        self.timing_stats = {'frames': 0, 'frame_time': 0.0, 'frame_time_peak': 0.0,
+                             'commands': 0, 'latency': 0.0, 'latency_peak': 0.0}
         
         # Startup network protocol for the command interface
-        self.cListener.addConnection(self.tcpSocket)
-        
-        print('MESSAGE: Ready to accept connections.')
+        if self.networkThread is not None:
+            self.networkThread.start()
+        else:
+            self.cListener.addConnection(self.tcpSocket)
+        
+        # Optional UDP channel that only accepts DATA samples (same port number as the TCP rendezvous)
+        self.udp_enabled = udp_enabled
+        self.udp_port_address = udp_port_address
+        self.udpSocket = None
+        # Last accepted sequence number of the DATA samples of each exo
+        self.dataSequences = {}
+        self.sequence_stats = {'accepted': 0, 'stale': 0}
+        self.udp_stats = {'datagrams': 0, 'rejected': 0}
+        # Only apply the newest DATA sample of each real-time exo per frame (see DataControllerRealTime)
+        self.coalesce_data = True
+        self.udpBuffer = CommandStreamBuffer()
+        
+        if self.udp_enabled:
+            self.udpSocket = self.cManager.openUDPConnection(self.udp_port_address)
+            self.udpReader = QueuedConnectionReader(self.cManager, 0)
+            self.udpReader.setRawMode(True)
+            self.udpReader.addConnection(self.udpSocket)
+            log.info('Ready to accept DATA samples through UDP.')
+        
+        # Optional shared-memory ring buffer for the DATA samples of a controller on the same machine (see advsharedmemory.py)
+        self.shm_enabled = shm_enabled
+        self.shm_path = shm_path
+        self.shm_slots = shm_slots
+        self.poseBuffer = None
+        self.shm_stats = {'samples': 0, 'rejected': 0}
+        
+        if self.shm_enabled:
+            self.poseBuffer = PoseRingBuffer(self.shm_path,self.shm_slots)
+            log.info('Ready to accept DATA samples through shared memory (%s).',self.shm_path)
+        
+        log.info('Ready to accept connections.')
             
     def tskListenerPolling(self,task):
-        ''' The task the polls the TCP port for new connections. Runs indefinitely. '''
+        ''' The task the polls the TCP port for new connections and removes the connections that have been closed by the clients. Runs indefinitely. '''
         if self.cListener.newConnectionAvailable():
             rendezvous = PointerToConnection()
             netAddress = NetAddress()
@@ -726,19 +931,265 @@ class ProgramLogic():
             if self.cListener.getNewConnection(rendezvous,netAddress,newConnection):
               newConnection = newConnection.p()
               self.activeConnections.append(newConnection) # Remember connection
+              self.receiveBuffers[newConnection] = CommandStreamBuffer()
+              self.connectionStats[newConnection] = ConnectionStatistics(netAddress.getIpString() + ':' + str(netAddress.getPort()))
               self.cReader.addConnection(newConnection)     # Begin reading connection
-              print('MESSAGE: Client connected.')
+              log.info('Client connected (%s).',self.connectionStats[newConnection].name)
+        
+        while self.cManager.resetConnectionAvailable():
+            connection = PointerToConnection()
+            if self.cManager.getResetConnection(connection):
+                self.remove_connection(connection.p())
           
         return Task.cont
         
+    def remove_connection(self,connection):
+        ''' Closes a client connection and removes its receive buffer, statistics and pending replies. '''
+        if connection in self.activeConnections:
+            self.activeConnections.remove(connection)
+        self.cReader.removeConnection(connection)
+        self.cManager.closeConnection(connection)
+        self.receiveBuffers.pop(connection,None)
+        self.pendingReplies.pop(connection,None)
+        stats = self.connectionStats.pop(connection,None)
+        if stats is not None:
+            log.info('Client disconnected (%s).',stats.name)
+        
     def tskReaderPolling(self,task):
-        ''' The task the continuously reads new data. '''
-        if self.cReader.dataAvailable():
+        ''' The task the continuously reads new data. Depending on the reader mode either all available datagrams (within the per-frame budget) or a single datagram are read. '''
+        self.record_frame_time()
+        stats = self.reader_stats
+        stats['frames'] += 1
+        
+        if self.reader_mode == 'single':
+            max_datagrams = 1
+        else:
+            max_datagrams = self.reader_max_datagrams
+        
+        if self.reader_time_budget > 0:
+            deadline = time.perf_counter() + self.reader_time_budget
+        else:
+            deadline = None
+        
+        processed = 0
+        backlog = 0
+        debug = log.isEnabledFor(logging.DEBUG)
+        # dataAvailable() polls the sockets, i.e. the queue is refilled on every call as long as the clients send data
+        while self.cReader.dataAvailable():
+            backlog = max(backlog,self.cReader.getCurrentQueueSize())
+            
+            # Stop if the budget of this frame is used up. The remaining datagrams are read in the next frame.
+            if (max_datagrams and processed >= max_datagrams) or (deadline is not None and processed and time.perf_counter() >= deadline):
+                stats['frames_truncated'] += 1
+                break
+            
             datagram=NetDatagram()
-            if self.cReader.getData(datagram):
-                print("MESSAGE: Data received.")
-                # Call function that parses the data received
-                self.parse_commands(datagram)
+            if not self.cReader.getData(datagram):
+                break
+            
+            if debug:
+                log.debug('Data received.')
+            stats['bytes'] += datagram.getLength()
+            processed += 1
+            # Call function that parses the data received
+            self.parse_commands(datagram)
+        
+        # Update statistics
+        stats['datagrams'] += processed
+        stats['datagrams_last_frame'] = processed
+        stats['datagrams_peak'] = max(stats['datagrams_peak'],processed)
+        stats['datagrams_peak_interval'] = max(stats['datagrams_peak_interval'],processed)
+        stats['backlog_peak'] = max(stats['backlog_peak'],backlog)
+        stats['backlog_peak_interval'] = max(stats['backlog_peak_interval'],backlog)
+        if self.cReader.getOverflowFlag():
+            stats['overflow'] = True
+            self.cReader.resetOverflowFlag()
+        
+        return Task.cont
+        
+    def tskActionPolling(self,task):
+        ''' The task that executes the commands that have been parsed by the network thread (only used if network_thread is True). The commands of the connections are executed round-robin (see advnetwork.NetworkThread.drain). All waiting commands are executed, unless the time budget of the reader (reader_time_budget) is used up. '''
+        self.record_frame_time()
+        stats = self.reader_stats
+        stats['frames'] += 1
+        timing = self.timing_stats
+        
+        if self.reader_time_budget > 0:
+            deadline = time.perf_counter() + self.reader_time_budget
+        else:
+            deadline = None
+        
+        processed = 0
+        debug = log.isEnabledFor(logging.DEBUG)
+        counter = self.command_counter
+        for received, connection, command, spec, values, request, size in self.networkThread.drain():
+            processed += 1
+            try:
+                # Binary DATA frame (exo id, degrees of freedom, sequence number)
+                if command is None:
+                    if counter.enabled:
+                        counter.count('binary DATA')
+                    self.set_data_binary(values[0],values[1],values[2])
+                # Command that could not be parsed (the values are the error message)
+                elif spec is None:
+                    if debug:
+                        log.debug("Command '%s' received.",command)
+                    self.report_error(values,connection,request)
+                else:
+                    if debug:
+                        log.debug("Command '%s' received.",command)
+                    if counter.enabled:
+                        counter.count(spec.name)
+                    if request is None:
+                        spec.handler(connection,*values)
+                    else:
+                        self.request = request
+                        try:
+                            replied = spec.handler(connection,*values)
+                        finally:
+                            self.request = None
+                        if not(replied):
+                            self.send_message('OK '+str(request),connection)
+                    
+            except TypeError as t:
+                self.report_error(str(t),connection,request)
+            except ValueError as v:
+                self.report_error(str(v),connection,request)
+            except KeyError as k:
+                self.report_error(str(k),connection,request)
+            except IndexError:
+                self.report_error('Not enough command parameters supplied.',connection,request)
+            
+            now = time.perf_counter()
+            latency = now - received
+            timing['commands'] += 1
+            timing['latency'] += latency
+            if latency > timing['latency_peak']:
+                timing['latency_peak'] = latency
+            
+            # Stop if the budget of this frame is used up. The remaining commands are executed in the next frame.
+            if deadline is not None and now >= deadline:
+                if any(connection.actions for connection in self.networkThread.connections):
+                    stats['frames_truncated'] += 1
+                break
+        
+        stats['datagrams_last_frame'] = processed
+        stats['datagrams_peak'] = max(stats['datagrams_peak'],processed)
+        stats['datagrams_peak_interval'] = max(stats['datagrams_peak_interval'],processed)
+        
+        return Task.cont
+        
+    def record_frame_time(self):
+        ''' Adds the duration of the last frame to the timing statistics. Called once per frame by the polling task. '''
+        frame_time = globalClock.getDt()
+        if self.recorder is not None:
+            self.recorder.frame = globalClock.getFrameCount()
+        timing = self.timing_stats
+        timing['frames'] += 1
+        timing['frame_time'] += frame_time
+        if frame_time > timing['frame_time_peak']:
+            timing['frame_time_peak'] = frame_time
+        
+    def tskReaderStatistics(self,task):
+        ''' The task that periodically prints the statistics of the reader. Is started with doMethodLater using the interval reader_stats_interval. '''
+        stats = self.reader_stats
+        if self.networkThread is not None:
+            thread_stats = self.networkThread.stats
+            log.info('Network thread statistics: %d datagrams (%d bytes), %d commands (%d invalid); peak queue length: %d (overall %d); '
+                     'connections paused: %d times; max. commands per frame: %d (overall %d); truncated frames: %d.',
+                     thread_stats['datagrams'],thread_stats['bytes'],thread_stats['commands'],thread_stats['errors'],thread_stats['queue_peak_interval'],thread_stats['queue_peak'],
+                     thread_stats['paused'],stats['datagrams_peak_interval'],stats['datagrams_peak'],stats['frames_truncated'])
+            thread_stats['queue_peak_interval'] = 0
+        else:
+            log.info('Reader statistics: %d datagrams (%d bytes) in %d frames; max. datagrams per frame: %d (overall %d); peak backlog: %d (overall %d); truncated frames: %d.',
+                     stats['datagrams'],stats['bytes'],stats['frames'],stats['datagrams_peak_interval'],stats['datagrams_peak'],
+                     stats['backlog_peak_interval'],stats['backlog_peak'],stats['frames_truncated'])
+        
+        timing = self.get_timing_stats()
+        if timing['commands']:
+            log.info('Frame time: mean %.2f ms, max. %.2f ms (%d frames); input latency: mean %.2f ms, max. %.2f ms (%d commands).',
+                     timing['frame_time_mean']*1000,timing['frame_time_peak']*1000,timing['frames'],timing['latency_mean']*1000,timing['latency_peak']*1000,timing['commands'])
+        else:
+            log.info('Frame time: mean %.2f ms, max. %.2f ms (%d frames).',timing['frame_time_mean']*1000,timing['frame_time_peak']*1000,timing['frames'])
+        for connection in self.get_connection_stats():
+            log.info('Connection %(name)s: %(commands_per_second).1f commands/s, %(bytes_per_second).0f bytes/s, %(bytes_in_flight)d bytes in flight, paused %(paused)d times.',connection)
+        for key in self.timing_stats:
+            self.timing_stats[key] = 0
+        
+        if stats['overflow']:
+            log.error('The reader queue overflowed, datagrams have been dropped.')
+            stats['overflow'] = False
+        
+        stats['datagrams_peak_interval'] = 0
+        stats['backlog_peak_interval'] = 0
+        
+        return Task.again
+        
+    def tskCommandLog(self,task):
+        ''' The task that periodically logs the number of received commands (see command_counter). Is started with doMethodLater using the interval command_log_interval. '''
+        self.command_counter.report()
+        return Task.again
+        
+    def get_reader_stats(self):
+        ''' Returns a copy of the statistics of the reader. '''
+        return dict(self.reader_stats)
+        
+    def get_connection_stats(self):
+        ''' Returns the statistics of the client connections as a list of dicts: name, bytes and commands received (in total and per second since the last call), bytes in flight (received but not executed) and the number of times the connection has been paused (both network thread only). '''
+        if self.networkThread is not None:
+            connections = [(connection.stats,connection.bytes_in_flight()) for connection in self.networkThread.connections if not(connection.closed)]
+        else:
+            connections = [(stats,0) for stats in self.connectionStats.values()]
+        
+        result = []
+        for stats, in_flight in connections:
+            bytes_per_second, commands_per_second = stats.rates()
+            result.append({'name': stats.name, 'bytes': stats.bytes, 'commands': stats.commands,
+                           'bytes_per_second': bytes_per_second, 'commands_per_second': commands_per_second,
+                           'bytes_in_flight': in_flight, 'paused': stats.paused})
+        return result
+        
+    def get_timing_stats(self):
+        ''' Returns a copy of the timing statistics (since they were printed last) including the mean frame time and the mean input latency in seconds. '''
+        timing = dict(self.timing_stats)
+        timing['frame_time_mean'] = timing['frame_time'] / timing['frames'] if timing['frames'] else 0.0
+        timing['latency_mean'] = timing['latency'] / timing['commands'] if timing['commands'] else 0.0
+        return timing
+        
+    def tskUdpPolling(self,task):
+        ''' The task that reads all DATA samples received through the UDP channel. '''
+        if self.udpSocket is None:
+            return Task.cont
+        
+        while self.udpReader.dataAvailable():
+            datagram=NetDatagram()
+            if not self.udpReader.getData(datagram):
+                break
+            self.parse_udp_datagram(datagram.getMessage())
+        
+        return Task.cont
+        
+    def tskSharedMemoryPolling(self,task):
+        ''' The task that reads the DATA samples written to the shared-memory ring buffer since the last frame. '''
+        if self.poseBuffer is None:
+            return Task.cont
+        
+        samples = self.poseBuffer.read()
+        self.shm_stats['samples'] += len(samples)
+        for id, dofs in samples:
+            if self.recorder is not None:
+                self.recorder.record(RECORD_UDP,None,pack_binary_data(id,dofs))
+            try:
+                self.set_data_binary(id,dofs)
+            except TypeError as t:
+                self.shm_stats['rejected'] += 1
+                log.error('%s',t)
+            except ValueError as v:
+                self.shm_stats['rejected'] += 1
+                log.error('%s',v)
+            except KeyError as k:
+                self.shm_stats['rejected'] += 1
+                log.error('%s',k)
         
         return Task.cont
         
@@ -751,7 +1202,24 @@ class ProgramLogic():
             
         if connections_exist:
             self.activeConnections = []
+            self.receiveBuffers = {}
+            self.connectionStats = {}
             self.cManager.closeConnection(self.tcpSocket)
+            
+        if self.networkThread is not None:
+            self.networkThread.stop()
+            
+        if self.udpSocket is not None:
+            self.udpReader.removeConnection(self.udpSocket)
+            self.cManager.closeConnection(self.udpSocket)
+            self.udpSocket = None
+            
+        if self.poseBuffer is not None:
+            self.poseBuffer.close()
+            self.poseBuffer = None
+            
+        if self.recorder is not None:
+            self.recorder.close()
         
         return Task.done
             
@@ -760,437 +1228,512 @@ class ProgramLogic():
         1. If an exo is added the id is written back.
         2. If an exo has been removed successfully.
         
-        The command series is first split into single commands. These commands are then parsed and executed.'''
+        The data is appended to the receive buffer of the connection, which returns the complete commands. Incomplete commands are kept in the buffer until the rest of the command arrives. The commands are then parsed and executed.'''
         # Extract message from the data
-        commands = datagram.getMessage()
-        connection = datagram.getConnection()
-        
-        commands_split = commands.split("::")
-        
-        for command in commands_split:
-        
-            if command != '':
-        
-                print("MESSAGE: Command '"+command+"' received.")
-
-                # Process command
-                comm_parts = command.split(" ")
+        self.receive_data(datagram.getConnection(),datagram.getMessage())
+        
+    def receive_data(self,connection,data):
+        ''' Appends DATA (bytes) received from CONNECTION to the receive buffer of the connection and executes the complete commands (see parse_commands). Is also used to replay a recorded session. '''
+        if self.recorder is not None:
+            self.recorder.record(RECORD_TCP,connection,data)
+        buffer = self.get_receive_buffer(connection)
+        
+        commands_split = buffer.feed(data)
+        
+        connection_stats = self.get_connection_statistics(connection)
+        connection_stats.bytes += len(data)
+        connection_stats.commands += len(commands_split)
+        
+        if buffer.overflows:
+            log.error('No command separator received within %d bytes. Data discarded.',buffer.max_size)
+            buffer.overflows = 0
+        
+        if buffer.invalid_frames:
+            log.error('%d binary DATA frame(s) with invalid number of degrees of freedom received.',buffer.invalid_frames)
+            buffer.invalid_frames = 0
+        
+        self.execute_commands(commands_split,connection)
+        
+    def execute_commands(self,commands,connection):
+        ''' Executes a list of commands received from CONNECTION. Text commands are looked up in the command table, their arguments are parsed and their handlers are called. Binary DATA frames (tuples) are passed to set_data_binary. Errors are printed. '''
+        dispatch = self.commands.dispatch
+        debug = log.isEnabledFor(logging.DEBUG)
+        counter = self.command_counter
+        
+        for command in commands:
+            request = None
+            try:
+                # Binary DATA frame (exo id, degrees of freedom, sequence number)
+                if isinstance(command,tuple):
+                    if counter.enabled:
+                        counter.count('binary DATA')
+                    self.set_data_binary(command[0],command[1],command[2])
                 
-                # Check which command is being send
-                try:
-                    # "ADDEXO" command
-                    if comm_parts[0] == 'ADDEXO':
-                        exotype = comm_parts[1]
-                        # Check which type of exo should be added
-                        if exotype == 'EXOSTATIC':
-                            if len(comm_parts) < 4:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:
-                                exoparams = comm_parts[3].split(",")
-                                if len(exoparams) != 7:
-                                    raise TypeError('Wrong number of kinematics parameters supplied.')
-                                else:
-                                    # Check handedness
-                                    handedness = comm_parts[2]
-                                    print(handedness)
-                                    if not(handedness == 'RIGHT' or handedness == 'LEFT'):
-                                        raise ValueError('Handedness '+handedness+' not recognised. Please use either "left" or "right".')
-
-                                    # Convert input strings to floats
-                                    try:
-                                        exoparams_num = [ float(x) for x in exoparams ]
-                                        # Divide x and y paramters by 10
-                                        exoparams_num[0] /= 10
-                                        exoparams_num[1] /= 10
-                                    except TypeError:
-                                        raise
-                                    
-                                    print('MESSAGE: Adding exo of type ' + exotype + '(' + handedness + ').')
-                                    
-                                    # Add exo
-                                    taskMgr.add(self.addExoTask, "addExoTask",extraArgs = [("static",handedness.lower()),exoparams_num])
-                                    # Send ID of the last added exo back to the client
-                                    taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                                    
-                        elif exotype == 'EXOREALTIME':
-                            if len(comm_parts) < 4:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:
-                                exoparams = comm_parts[3].split(",")
-                                if len(exoparams) != 7:
-                                    raise TypeError('Wrong number of kinematics parameters supplied.')
-                                else:
-                                    # Check handedness
-                                    handedness = comm_parts[2]
-                                    print(handedness)
-                                    if not(handedness == 'RIGHT' or handedness == 'LEFT'):
-                                        raise ValueError('Handedness '+handedness+' not recognised. Please use either "left" or "right".')
-
-                                    # Convert input strings to floats
-                                    try:
-                                        exoparams_num = [ float(x) for x in exoparams ]
-                                        # Divide x and y paramters by 10
-                                        exoparams_num[0] /= 10
-                                        exoparams_num[1] /= 10
-                                    except TypeError:
-                                        raise
-                                    
-                                    print('MESSAGE: Adding exo of type ' + exotype + '(' + handedness + ').')
-                                    
-                                    # Add exo
-                                    taskMgr.add(self.addExoTask, "addExoTask",extraArgs = [("realtime",handedness.lower()),exoparams_num])
-                                    # Send ID of the last added exo back to the client
-                                    taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                        
-                        elif exotype == 'EXOKEYBOARD':
-                            if len(comm_parts) < 3:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:
-                                # Check handedness
-                                handedness = comm_parts[2]
-                                print(handedness)
-                                if not(handedness == 'RIGHT' or handedness == 'LEFT'):
-                                    raise ValueError('Handedness '+handedness+' not recognised. Please use either "left" or "right".')
-                                    
-                                print('MESSAGE: Adding exo of type ' + exotype + '(' + handedness + ').')
-                                    
-                                # Add exo
-                                taskMgr.add(self.addExoTask, "addExoTask",extraArgs = [("keyboard",handedness.lower()),""])
-                                # Send ID of the last added exo back to the client
-                                taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                                    
-                        else:
-                            raise ValueError('"'+exotype+'"'+' is an exo unknown type.')
-                                    
-                    # "DELETE" command
-                    elif comm_parts[0] == 'DELETE':
-                        # Get the id of the exo
-                        id = comm_parts[1]
-                        if id in self.exos:
-                            print('MESSAGE: Deleting exo: '+id)
-                            taskMgr.add(self.removeExoTask, "removeExoTask", extraArgs = [id])
-                        else:
-                            print("MESSAGE: ID " + id + " not found.")
-                        
-                    # "ADDBASE" command
-                    elif comm_parts[0] == 'ADDBASE':
-                        exotype = comm_parts[1]
-                        # Check which type of exo should be added
-                        if exotype == 'EXOSTATIC':
-                            if len(comm_parts) < 3:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:
-                                exoparams = comm_parts[2].split(",")
-                                if len(exoparams) != 3:
-                                    raise TypeError('Wrong number of kinematics parameters supplied.')
-                                else:
-                                    # Convert input strings to floats
-                                    try:
-                                        exoparams_num = [ float(x) for x in exoparams ]
-                                        # Divide x and y paramters by 10
-                                        exoparams_num[0] /= 10
-                                        exoparams_num[1] /= 10
-                                    except TypeError:
-                                        raise
-                                    
-                                    print('MESSAGE: Adding exo (base only) of type ' + exotype +'.')
-                                    
-                                    # Add exo
-                                    taskMgr.add(self.addBaseTask, "addBaseTask",extraArgs = ["static",exoparams_num])
-                                    # Send ID of the last added exo back to the client
-                                    taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                                    
-                        elif exotype == 'EXOREALTIME':
-                            if len(comm_parts) < 3:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:
-                                exoparams = comm_parts[2].split(",")
-                                if len(exoparams) != 3:
-                                    raise TypeError('Wrong number of kinematics parameters supplied.')
-                                else:
-                                    # Convert input strings to floats
-                                    try:
-                                        exoparams_num = [ float(x) for x in exoparams ]
-                                        # Divide x and y paramters by 10
-                                        exoparams_num[0] /= 10
-                                        exoparams_num[1] /= 10
-                                    except TypeError:
-                                        raise
-                                    
-                                    print('MESSAGE: Adding exo (base only) of type ' + exotype + '.')
-                                    
-                                    # Add exo
-                                    taskMgr.add(self.addBaseTask, "addBaseTask",extraArgs = ["realtime",exoparams_num])
-                                    # Send ID of the last added exo back to the client
-                                    taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                        
-                        elif exotype == 'EXOKEYBOARD':
-                            if len(comm_parts) < 2:
-                                raise TypeError('Not enough command parameters supplied.')
-                            else:                                    
-                                print('MESSAGE: Adding exo (base only) of type ' + exotype + '.')
-                                    
-                                # Add exo
-                                taskMgr.add(self.addBaseTask, "addBaseTask",extraArgs = ["keyboard",""])
-                                # Send ID of the last added exo back to the client
-                                taskMgr.doMethodLater(0.5,self.send_latest_id,'Send_Latest_Exo_id',extraArgs = [connection])
-                                    
-                        else:
-                            raise ValueError('"'+exotype+'"'+' is an exo unknown type.')
-                                
-                    # "DATA" command
-                    elif comm_parts[0] == 'DATA':
-                        # Get the id of the exo. If the id does not exist a KeyError is raised and caught.
-                        id = comm_parts[1]
-                        exoparams = comm_parts[2].split(",")
-                        if len(exoparams) != 7:
-                            raise TypeError('Wrong number of kinematics parameters supplied.')
-                        else:
-                            # Convert input strings to floats
-                            try:
-                                exoparams_num = [ float(x) for x in exoparams ]
-                                # Divide x and y paramters by 10
-                                exoparams_num[0] /= 10
-                                exoparams_num[1] /= 10
-                            except TypeError:
-                                raise
-
-                            if not(id in self.exos):
-                                raise KeyError('Id '+id+' of Exo not found.')
-                            else:
-                                if (isinstance(self.exos[id].dc,ExoDataControllerRealTime) or isinstance(self.exos[id].dc, BaseDataControllerRealTime)):
-                                    self.exos[id].dc.set_data(exoparams_num)
-                                else:
-                                    raise TypeError('Cannot send data to static or keyboard-controlled exo.')
-
-                    # "LOADCONFIG" command
-                    elif comm_parts[0] == 'LOADCONFIG':
-                        # Get the filename
-                        fname = comm_parts[1]
-
-                        taskMgr.add(self.loadConfigTask, "loadConfigTask",extraArgs = [fname])
-
-                    # "SETCONFIG" command
-                    elif comm_parts[0] == 'SETCONFIG': 
-                        # Get the id of the exo. If the id does not exist a KeyError is raised and caught.
-                        exo_id = comm_parts[1]
-                               
-                        if not(exo_id in self.exos):
-                            raise KeyError('Id '+exo_id+' of Exo not found.')
-                        else:
-                            taskMgr.add(self.setConfigTask, "setConfigTask",extraArgs = [exo_id])
-
-                    # "SETCOLORBASE" command
-                    elif comm_parts[0] == 'SETCOLORBASE':
-                        # Get the id of the exo. If the id does not exist a KeyError is raised and caught.
-                        id = comm_parts[1]
-                        # Get the target part of the exo to be coloured.
-                        target = comm_parts[2]
-                        # Get the rgb colour information
-                        colors = comm_parts[3].split(",")
-                        if len(colors) != 3:
-                            raise TypeError('Not enough color parameters supplied.')
-                        else:
-                            # Convert input strings to floats
-                            try:
-                                colors_num = [ float(x) for x in colors ]
-                            except TypeError:
-                                raise
-                                
-                            for number in colors_num:
-                                if number < 0 or number > 1:
-                                    raise ValueError('RGB values are only allowed between 0 and 1');
-
-                            if not(id in self.exos):
-                                raise KeyError('Id '+id+' of Exo not found.')
-                            else:
-                                if target == 'BASE':
-                                    taskMgr.add(self.exos[id].setColorBaseTask, "setColorBaseTask",extraArgs = [colors_num])
-                                elif target == 'ARMREST':
-                                    taskMgr.add(self.exos[id].setColorArmRestTask,"setColorArmRestTask",extraArgs = [colors_num])
-                                else:
-                                    raise ValueError('Target "' + target +'" unknown.')
-                    
-                    # "SETCOLORHAND" command
-                    elif comm_parts[0] == 'SETCOLORHAND':
-                        # Get the id of the exo. If the id does not exist a KeyError is raised and caught.
-                        id = comm_parts[1]
-                        # Get the target part of the exo to be coloured.
-                        target = comm_parts[2]
-                        # Get the rgb colour information
-                        colors = comm_parts[3].split(",")
-                        if len(colors) != 3:
-                            raise TypeError('Not enough color parameters supplied.')
-                        else:
-                            # Convert input strings to floats
-                            try:
-                                colors_num = [ float(x) for x in colors ]
-                            except TypeError:
-                                raise
-                                
-                            for number in colors_num:
-                                if number < 0 or number > 1:
-                                    raise ValueError('RGB values are only allowed between 0 and 1');
-
-                            if not(id in self.exos):
-                                raise KeyError('Id '+id+' of Exo not found.')
-                            # Catch colour commands for the hand from being send to the base
-                            elif(isinstance(self.exos[id],BaseLogic)):
-                                raise TypeError('Cannot set color of hand module for EXOBASE object.')
-                            
-                            else:
-                                if target == 'SUPPRO':
-                                    taskMgr.add(self.exos[id].setColorPronoTask, "setColorPronoTask",extraArgs = [colors_num])
-                                elif target == 'INDEX':
-                                    taskMgr.add(self.exos[id].setColorIndexTask, "setColorIndexTask",extraArgs = [colors_num])    
-                                elif target == 'FINGERGROUP':
-                                    taskMgr.add(self.exos[id].setColorFingerGroupTask, "setColorFingerGroupTask",extraArgs = [colors_num])
-                                elif target == 'THUMB':
-                                    taskMgr.add(self.exos[id].setColorThumbTask, "setColorThumbTask",extraArgs = [colors_num])
-                                else:
-                                    raise ValueError('Target "'+target+'" unknown.')
-                                
-                    # "SETBGCOLOR" command
-                    elif comm_parts[0] == 'SETBGCOLOR':
-                        # Get the colors
-                        colors = comm_parts[1].split(",")
-                        if len(colors) != 3:
-                            raise TypeError('Wrong number of parameters supplied.')
-                        else:
-                            # Convert input strings to floats
-                            try:
-                                colors_num = [ float (x) for x in colors ]
-                            except TypeError:
-                                raise
-                            
-                            for number in colors_num:
-                                if number < 0 or number > 1:
-                                    raise ValueError('RGB values are only allowed between 0 and 1');
-                            
-                            taskMgr.add(self.changeBgColorTask,"setBgColorTask",extraArgs = [colors_num])
-                            
-                    # "SETCAMERA" command
-                    elif comm_parts[0] == 'SETCAMERA':
-                        # Get the coordinates
-                        coord_vector = comm_parts[1].split(",")
-                        if len(coord_vector) != 6:
-                            raise TypeError('Wrong number of parameters supplied.')
-                        else:
-                            # Convert input strings to floats
-                            try:
-                                coord_vector_num = [ float (x) for x in coord_vector ]
-                            except TypeError:
-                                raise
-                            
-                            taskMgr.add(self.setCameraOrientationPositionTask,"setCameraOrientationPositionTask",extraArgs = [coord_vector_num])
-                            
-                    # "ROTATECAMERA" command
-                    elif comm_parts[0] == 'ROTATECAMERA':
-                        # Get the angle
-                        angle = comm_parts[1]
-                        print(angle)
-                        # Convert input strings to floats
+                elif command != '':
+                    if debug:
+                        log.debug("Command '%s' received.",command)
+                    if command[0] != '#':
+                        if counter.enabled:
+                            counter.count(command.partition(' ')[0])
+                        dispatch(command,connection)
+                    else:
+                        # The command is acknowledged (see adv_command_structure.txt)
+                        request, command = split_request(command)
+                        if counter.enabled:
+                            counter.count(command.partition(' ')[0])
+                        self.request = request
                         try:
-                            angle_num = float(angle)
-                        except TypeError:
-                            raise
-                                
-                        taskMgr.add(self.rotateCameraTask,"rotateCameraTask",extraArgs = [angle_num])
+                            replied = dispatch(command,connection)
+                        finally:
+                            self.request = None
+                        if not(replied):
+                            self.send_message('OK '+str(request),connection)
                     
-                    # "TOGGLETRANSPARENCY" command
-                    elif comm_parts[0] == 'TOGGLETRANSPARENCY':
-                        # Get the id of the exo. If the id does not exist a KeyError is raised and caught.
-                        id = comm_parts[1]
-                        
-                        if not(id in self.exos):
-                            raise KeyError('Id '+id+' of Exo not found.')
-                        else:
-                            taskMgr.add(self.exos[id].toggleTransparencyTask, "toggleTransparencyTask")
-                            
-                    # "TOGGLEMAT" command
-                    elif comm_parts[0] == 'TOGGLEMAT':
-                        side = comm_parts[1]
-                        
-                        if side in ('LEFT','RIGHT'):
-                            taskMgr.add(self.toggleMatTask,"toggleMatTask",extraArgs = [side])
-                        else:
-                            raise ValueError('Value for type of the mat not understood. Please use "LEFT" or "RIGHT".')
+            except TypeError as t:
+                self.report_error(str(t),connection,request)
+            except ValueError as v:
+                self.report_error(str(v),connection,request)
+            except KeyError as k:
+                self.report_error(str(k),connection,request)
+            except IndexError:
+                self.report_error('Not enough command parameters supplied.',connection,request)
                 
-                    # "EXIT" command
-                    elif comm_parts[0] == 'EXIT':
-                        taskMgr.add(self.tskTerminateConnections, "tcp_disconnect")
-                        print('Good bye!')
-                        sys.exit()
-                    
-                    # Invalid command
-                    else:
-                        raise TypeError('Invalid command '+command+'.')
-                
-                except TypeError as t:
-                    print('ERROR: ' + str(t))
-                except ValueError as v:
-                    print('ERROR: ' + str(v))
-                except KeyError as k:
-                    print('ERROR: ' + str(k))
-                except IndexError:
-                    print('ERROR: Not enough command parameters supplied.')
-            
-    def send_latest_id(self,connection):
-        ''' This functions responds to the client and sends the ID of the exo that has been added last. '''
-        self.cWriter.send(":"+self.exo_ids_in_order[-1],connection)
-        return Task.done
+    def report_error(self,message,connection,request=None):
+        ''' Logs the error of a command. If the command has a request number, the error is sent back to the client as well. '''
+        log.error('%s',message)
+        if request is not None:
+            self.send_message('ERR '+str(request)+' '+message,connection)
+            
+    def register_command(self,name,handler,arguments=(),optional_arguments=(),rest=None,subcommand=None):
+        ''' Adds a command to the command table (or replaces it). HANDLER is called with the connection and the values returned by the parsers in ARGUMENTS and OPTIONAL_ARGUMENTS (see advprotocol.CommandSpec). '''
+        self.commands.register(CommandSpec(name,handler,arguments,optional_arguments,rest),subcommand)
+        
+    def register_commands(self):
+        ''' Creates the command table with the commands described in adv_command_structure.txt. '''
+        self.commands = CommandRegistry()
+        
+        # Parsers of the arguments
+        handedness = parse_choice(('RIGHT','LEFT'),'Handedness {0} not recognised. Please use either "left" or "right".')
+        kinematics_exo = parse_floats(7,'Wrong number of kinematics parameters supplied.',scale_xy=True)
+        kinematics_base = parse_floats(3,'Wrong number of kinematics parameters supplied.',scale_xy=True)
+        color = parse_color('Not enough color parameters supplied.')
+        
+        self.register_command('ADDEXO',partial(self.command_addexo,'static'),[handedness,kinematics_exo],[parse_token],subcommand='EXOSTATIC')
+        self.register_command('ADDEXO',partial(self.command_addexo,'realtime'),[handedness,kinematics_exo],[parse_token],subcommand='EXOREALTIME')
+        self.register_command('ADDEXO',self.command_addexo_keyboard,[handedness],[parse_token],subcommand='EXOKEYBOARD')
+        self.register_command('ADDBASE',partial(self.command_addbase,'static'),[kinematics_base],[parse_token],subcommand='EXOSTATIC')
+        self.register_command('ADDBASE',partial(self.command_addbase,'realtime'),[kinematics_base],[parse_token],subcommand='EXOREALTIME')
+        self.register_command('ADDBASE',self.command_addbase_keyboard,[],[parse_token],subcommand='EXOKEYBOARD')
+        self.register_command('DELETE',self.command_delete,[parse_string])
+        self.register_command('DATA',self.command_data,[parse_string,kinematics_exo],[parse_int])
+        self.register_command('DATABATCH',self.command_databatch,rest=partial(self.parse_data_batch,kinematics_exo))
+        self.register_command('RESETSEQUENCE',self.command_resetsequence,[parse_string])
+        self.register_command('LOADCONFIG',self.command_loadconfig,[parse_string])
+        self.register_command('SETCONFIG',self.command_setconfig,[parse_string])
+        self.register_command('SETCOLORBASE',self.command_setcolorbase,[parse_string,parse_choice(('BASE','ARMREST'),'Target "{0}" unknown.'),color])
+        self.register_command('SETCOLORHAND',self.command_setcolorhand,[parse_string,parse_choice(('SUPPRO','INDEX','FINGERGROUP','THUMB'),'Target "{0}" unknown.'),color])
+        self.register_command('SETBGCOLOR',self.command_setbgcolor,[parse_color('Wrong number of parameters supplied.')])
+        self.register_command('SETCAMERA',self.command_setcamera,[parse_floats(6,'Wrong number of parameters supplied.')])
+        self.register_command('ROTATECAMERA',self.command_rotatecamera,[parse_float])
+        self.register_command('TOGGLETRANSPARENCY',self.command_toggletransparency,[parse_string],[parse_choice(TRANSPARENCY_MODES,'Transparency mode "{0}" unknown.')])
+        self.register_command('TOGGLEMAT',self.command_togglemat,[parse_choice(('LEFT','RIGHT'),'Value for type of the mat not understood. Please use "LEFT" or "RIGHT".')])
+        self.register_command('EXIT',self.command_exit)
+        
+    # ### Command handlers ### #
+    # The handlers are called with the connection the command was received from and the parsed arguments (see register_commands).
+    # If a command has a request number, it is acknowledged after the handler has returned. Handlers that send the reply themselves (later) return True.
+    # Checks that depend on the state of the scene (e.g. if an exo exists) are done by the handlers.
+    
+    def command_addexo(self,type,connection,handedness,exoparams_num,token=None):
+        ''' "ADDEXO" command. The id of the new exo (and TOKEN) is sent back by addExoTask. '''
+        log.info('Adding exo of type %s(%s).',type,handedness)
+        # Add exo
+        taskMgr.add(self.addExoTask, "addExoTask",extraArgs = [(type,handedness.lower()),exoparams_num,connection,token,self.request])
+        return True
+        
+    def command_addexo_keyboard(self,connection,handedness,token=None):
+        ''' "ADDEXO EXOKEYBOARD" command '''
+        return self.command_addexo('keyboard',connection,handedness,"",token)
+        
+    def command_addbase(self,type,connection,exoparams_num,token=None):
+        ''' "ADDBASE" command. The id of the new exo (and TOKEN) is sent back by addBaseTask. '''
+        log.info('Adding exo (base only) of type %s.',type)
+        # Add exo
+        taskMgr.add(self.addBaseTask, "addBaseTask",extraArgs = [type,exoparams_num,connection,token,self.request])
+        return True
+        
+    def command_addbase_keyboard(self,connection,token=None):
+        ''' "ADDBASE EXOKEYBOARD" command '''
+        return self.command_addbase('keyboard',connection,"",token)
+        
+    def command_delete(self,connection,id):
+        ''' "DELETE" command '''
+        if id in self.exos:
+            log.info('Deleting exo: %s',id)
+            taskMgr.add(self.removeExoTask, "removeExoTask", extraArgs = [id])
+        else:
+            log.info('ID %s not found.',id)
+            
+    def command_loadconfig(self,connection,fname):
+        ''' "LOADCONFIG" command '''
+        taskMgr.add(self.loadConfigTask, "loadConfigTask",extraArgs = [fname])
+        
+    def command_setconfig(self,connection,exo_id):
+        ''' "SETCONFIG" command '''
+        if not(exo_id in self.exos):
+            raise KeyError('Id '+exo_id+' of Exo not found.')
+        taskMgr.add(self.setConfigTask, "setConfigTask",extraArgs = [exo_id])
+        
+    def command_setcolorbase(self,connection,id,target,colors_num):
+        ''' "SETCOLORBASE" command '''
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        if target == 'BASE':
+            taskMgr.add(self.exos[id].setColorBaseTask, "setColorBaseTask",extraArgs = [colors_num])
+        else:
+            taskMgr.add(self.exos[id].setColorArmRestTask,"setColorArmRestTask",extraArgs = [colors_num])
+        self.update_instances(self.exos[id].modeldata)
+            
+    def command_setcolorhand(self,connection,id,target,colors_num):
+        ''' "SETCOLORHAND" command '''
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        # Catch colour commands for the hand from being send to the base
+        if isinstance(self.exos[id],BaseLogic):
+            raise TypeError('Cannot set color of hand module for EXOBASE object.')
+        if target == 'SUPPRO':
+            taskMgr.add(self.exos[id].setColorPronoTask, "setColorPronoTask",extraArgs = [colors_num])
+        elif target == 'INDEX':
+            taskMgr.add(self.exos[id].setColorIndexTask, "setColorIndexTask",extraArgs = [colors_num])
+        elif target == 'FINGERGROUP':
+            taskMgr.add(self.exos[id].setColorFingerGroupTask, "setColorFingerGroupTask",extraArgs = [colors_num])
+        else:
+            taskMgr.add(self.exos[id].setColorThumbTask, "setColorThumbTask",extraArgs = [colors_num])
+        self.update_instances(self.exos[id].modeldata)
+            
+    def command_setbgcolor(self,connection,colors_num):
+        ''' "SETBGCOLOR" command '''
+        taskMgr.add(self.changeBgColorTask,"setBgColorTask",extraArgs = [colors_num])
+        
+    def command_setcamera(self,connection,coord_vector_num):
+        ''' "SETCAMERA" command '''
+        taskMgr.add(self.setCameraOrientationPositionTask,"setCameraOrientationPositionTask",extraArgs = [coord_vector_num])
+        
+    def command_rotatecamera(self,connection,angle_num):
+        ''' "ROTATECAMERA" command '''
+        taskMgr.add(self.rotateCameraTask,"rotateCameraTask",extraArgs = [angle_num])
+        
+    def command_toggletransparency(self,connection,id,mode=None):
+        ''' "TOGGLETRANSPARENCY" command '''
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        if mode == 'MULTISAMPLE' and base.win is not None and base.win.getFbProperties().getMultisamples() == 0:
+            log.warning('The window has no multisample buffer. Exos in the transparency mode MULTISAMPLE are drawn opaque.')
+        taskMgr.add(self.exos[id].toggleTransparencyTask, "toggleTransparencyTask", extraArgs = [mode])
+        self.update_instances(self.exos[id].modeldata)
+        
+    def command_togglemat(self,connection,side):
+        ''' "TOGGLEMAT" command '''
+        taskMgr.add(self.toggleMatTask,"toggleMatTask",extraArgs = [side])
+        
+    def command_exit(self,connection):
+        ''' "EXIT" command '''
+        taskMgr.add(self.tskTerminateConnections, "tcp_disconnect")
+        log.info('Good bye!')
+        sys.exit()
+        
+    # ### DATA handling ### #
+    
+    def command_data(self,connection,id,exoparams,sequence=None):
+        ''' "DATA" command. Sets the degrees of freedom of a real-time exo. EXOPARAMS are the parameters as converted by the parser (x and y divided by 10). If SEQUENCE is given, the sample is discarded if it is older than the last accepted sample of the exo (see accept_sequence). '''
+        # If the id does not exist a KeyError is raised and caught.
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        else:
+            dc = self.exos[id].dc
+            if isinstance(dc,DataControllerRealTime):
+                if sequence is not None and not(self.accept_sequence(id,sequence)):
+                    self.report_stale_sequence(id,sequence)
+                    return
+                dc.post_data(exoparams)
+                if not(self.coalesce_data):
+                    dc.apply_data()
+            else:
+                raise TypeError('Cannot send data to static or keyboard-controlled exo.')
+        
+    def parse_data_batch(self,kinematics,args):
+        ''' Parses the arguments of a DATABATCH command: pairs of exo id and parameters, optionally followed by a sequence number that applies to all exos of the batch. The parameters are converted by KINEMATICS, the parser of the parameters of the DATA command. Returns the list of (id, parameters) and the sequence number (or None). '''
+        if len(args) % 2 == 1:
+            sequence = parse_int(args[-1])
+            num_entries = (len(args) - 1) // 2
+        else:
+            sequence = None
+            num_entries = len(args) // 2
+        if num_entries < 1:
+            raise TypeError('Not enough command parameters supplied.')
+        
+        entries = []
+        for i in range(0,2*num_entries,2):
+            entries.append((args[i],kinematics(args[i+1])))
+        
+        return entries, sequence
+        
+    def command_databatch(self,connection,batch):
+        ''' "DATABATCH" command. Sets the degrees of freedom of several exos (see parse_data_batch).
+        The values are converted when the command is parsed and all exos of the batch (and the sequence number) are checked before any sample is set. Thus either all exos of the batch are updated (in the same frame) or none. '''
+        entries, sequence = batch
+        
+        # Validate all entries
+        dcs = []
+        for id, exoparams in entries:
+            if not(id in self.exos):
+                raise KeyError('Id '+id+' of Exo not found.')
+            dc = self.exos[id].dc
+            if not(isinstance(dc,DataControllerRealTime)):
+                raise TypeError('Cannot send data to static or keyboard-controlled exo '+id+'.')
+            dcs.append(dc)
+        
+        # A batch that is not newer than the last accepted sample of one of its exos is discarded as a whole
+        if sequence is not None:
+            stale = [id for id, exoparams in entries if self.is_stale_sequence(id,sequence)]
+            if stale:
+                self.sequence_stats['stale'] += 1
+                self.report_stale_sequence(stale[0],sequence)
+                return
+            for id, exoparams in entries:
+                self.dataSequences[id] = sequence
+            self.sequence_stats['accepted'] += len(entries)
+        
+        # Set the samples
+        for (id, exoparams), dc in zip(entries,dcs):
+            dc.post_data(exoparams)
+            if not(self.coalesce_data):
+                dc.apply_data()
+        
+    def set_data_binary(self,id,dofs,sequence=None):
+        ''' Sets the degrees of freedom received in a binary DATA frame. The values are floats already, only x and y are divided by 10. '''
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        
+        dc = self.exos[id].dc
+        if isinstance(dc,ExoDataControllerRealTime):
+            if len(dofs) != 7:
+                raise TypeError('Wrong number of kinematics parameters supplied.')
+        elif not(isinstance(dc,BaseDataControllerRealTime)):
+            raise TypeError('Cannot send data to static or keyboard-controlled exo.')
+        
+        if sequence is not None and not(self.accept_sequence(id,sequence)):
+            return
+        
+        exoparams = list(dofs)
+        # Divide x and y paramters by 10
+        exoparams[0] /= 10
+        exoparams[1] /= 10
+        dc.post_data(exoparams)
+        if not(self.coalesce_data):
+            dc.apply_data()
+        
+    def get_data_stats(self):
+        ''' Returns the number of DATA samples received and coalesced (received but superseded before they were rendered) per real-time exo and in total. '''
+        stats = {'received': 0, 'coalesced': 0, 'exos': {}}
+        for id in self.exo_ids_in_order:
+            dc = self.exos[id].dc
+            if isinstance(dc,DataControllerRealTime):
+                stats['exos'][id] = {'received': dc.samples_received, 'coalesced': dc.samples_coalesced}
+                stats['received'] += dc.samples_received
+                stats['coalesced'] += dc.samples_coalesced
+        return stats
+        
+    def is_stale_sequence(self,id,sequence):
+        ''' Returns True if SEQUENCE is older than (or as old as) the sequence number of the last accepted sample of the exo ID. A sample that is much older (see advprotocol.is_restarted_sequence) starts a new stream of a client that has been restarted or reconnected and is not stale. '''
+        last_sequence = self.dataSequences.get(id)
+        return last_sequence is not None and not(is_newer_sequence(sequence,last_sequence)) and not(is_restarted_sequence(sequence,last_sequence))
+        
+    def accept_sequence(self,id,sequence):
+        ''' Checks the sequence number of a DATA sample of an exo. Returns False if the sample is older than (or as old as) the last accepted sample of this exo, i.e. if it arrived out of order and has to be discarded. '''
+        if self.is_stale_sequence(id,sequence):
+            self.sequence_stats['stale'] += 1
+            return False
+        
+        self.dataSequences[id] = sequence
+        self.sequence_stats['accepted'] += 1
+        return True
+        
+    def report_stale_sequence(self,id,sequence):
+        ''' Rejects a sample of the exo ID that has been discarded by its sequence number. A command with a request number is answered with ERR (a ValueError is raised), other samples (e.g. reordered UDP datagrams) are discarded silently. '''
+        if self.request is not None:
+            raise ValueError('Sample '+str(sequence)+' of exo '+id+' is not newer than the last accepted sample '+str(self.dataSequences[id])+' (see RESETSEQUENCE).')
+        
+    def command_resetsequence(self,connection,id):
+        ''' "RESETSEQUENCE" command. Forgets the sequence number of the last accepted sample of the exo ID, so that the next sample is accepted whatever its sequence number (e.g. when a client starts a new stream). '''
+        if not(id in self.exos):
+            raise KeyError('Id '+id+' of Exo not found.')
+        self.dataSequences.pop(id,None)
+        
+    def parse_udp_datagram(self,message):
+        ''' Parses a datagram received through the UDP channel. Only DATA commands and binary DATA frames are accepted. Each datagram is self-contained, incomplete commands are discarded. '''
+        self.udp_stats['datagrams'] += 1
+        if self.recorder is not None:
+            self.recorder.record(RECORD_UDP,None,message)
+        
+        for command in self.udpBuffer.feed(message):
+            try:
+                if isinstance(command,tuple):
+                    self.set_data_binary(command[0],command[1],command[2])
+                else:
+                    if not(command.startswith('DATA ') or command.startswith('DATABATCH ')):
+                        raise TypeError('Only DATA and DATABATCH commands are accepted on the UDP channel.')
+                    self.commands.dispatch(command,None)
+            except TypeError as t:
+                self.udp_stats['rejected'] += 1
+                log.error('%s',t)
+            except ValueError as v:
+                self.udp_stats['rejected'] += 1
+                log.error('%s',v)
+            except KeyError as k:
+                self.udp_stats['rejected'] += 1
+                log.error('%s',k)
+            except IndexError:
+                self.udp_stats['rejected'] += 1
+                log.error('Not enough command parameters supplied.')
+        
+        if self.udpBuffer.pending():
+            self.udp_stats['rejected'] += 1
+            self.udpBuffer.reset()
+        
+    def get_receive_buffer(self,connection):
+        ''' Returns the receive buffer of a connection. A new buffer is created for unknown connections. '''
+        try:
+            return self.receiveBuffers[connection]
+        except KeyError:
+            buffer = CommandStreamBuffer()
+            self.receiveBuffers[connection] = buffer
+            return buffer
+            
+    def get_connection_statistics(self,connection):
+        ''' Returns the statistics of a connection. New statistics are created for unknown connections (e.g. the connections of a replayed session). '''
+        try:
+            return self.connectionStats[connection]
+        except KeyError:
+            stats = ConnectionStatistics('connection ' + str(len(self.connectionStats) + 1))
+            self.connectionStats[connection] = stats
+            return stats
+            
+    def send_exo_id(self,id,connection,token=None,request=None):
+        ''' This functions responds to the client and sends the ID of an exo that has been added (followed by the token of the request if there is one). If the command had a request number, the id is sent as its acknowledgement. '''
+        message = id
+        if request is not None:
+            message = 'OK '+str(request)+' '+message
+        if token is not None:
+            message += ' '+token
+        return self.send_message(message,connection)
         
     def send_message(self,message,connection):
-        ''' This function responds to the client and sends a specified message. '''
-        # self.cWriter.send(":"+message,self.activeConnections[-1])
-        self.cWriter.send(":"+message,connection)
+        ''' This function responds to the client and sends a specified message. The replies are collected and sent at the end of the frame (see tskSendReplies). '''
+        try:
+            self.pendingReplies[connection].append(message)
+        except KeyError:
+            self.pendingReplies[connection] = [message]
         return Task.done
         
-    def addExoTask(self,type,data):
-        ''' Function that adds a new task to the taskmanager. The new task adds a new exo of specified type. '''
+    def tskSendReplies(self,task):
+        ''' The task that sends the replies of the current frame. All replies to a client are sent in one datagram. Replies start with ":" and end with the command separator. '''
+        if self.pendingReplies:
+            for connection, messages in self.pendingReplies.items():
+                data = b''.join([format_reply(message) for message in messages])
+                # Other connections than the Panda3D connections (network thread, replay) send the data themselves
+                if isinstance(connection,Connection):
+                    self.cWriter.send(Datagram(data),connection)
+                else:
+                    connection.send(data)
+            self.pendingReplies = {}
+        return Task.cont
+        
+    def new_exo_id(self):
+        ''' Returns a new id for an exo. If a session is recorded, the id is recorded as well. During the replay of a session the recorded ids are used. '''
+        if self.replay_ids:
+            return self.replay_ids.popleft()
+        
+        rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+        if self.recorder is not None:
+            self.recorder.record_exo_id(rand_id)
+        return rand_id
+        
+    def start_replay(self,filename,realtime=True):
+        ''' Replays a recorded session (see advrecorder.SessionReplay). In realtime mode the data is fed at the recorded times, otherwise one recorded frame is fed per frame. '''
+        self.replay = SessionReplay(self,filename,realtime)
+        log.info('Replaying session %s.',filename)
+        taskMgr.add(self.tskReplay, "replay")
+        
+    def tskReplay(self,task):
+        ''' The task that feeds the recorded session to the program logic. '''
+        if self.replay.feed():
+            return Task.cont
+        stats = self.replay.stats
+        log.info('Replay finished: %d records (%d bytes) in %d frames.',stats['records'],stats['bytes'],stats['frames'])
+        return Task.done
+        
+    def addExoTask(self,type,data,connection=None,token=None,request=None):
+        ''' Function that adds a new task to the taskmanager. The new task adds a new exo of specified type. If CONNECTION is given, the id of the new exo (and TOKEN) is sent back as soon as the exo has been added, as acknowledgement of REQUEST if the command had a request number. '''
         
         if type[0] == 'keyboard':
             # Load, modify and reparent models
             modeldata = self.create_exo_model(type[1])
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
             # Create logic objects
             dc = ExoDataControllerKeyboard(rand_id,type[1])
             exo = ExoLogic(modeldata['exo'],modeldata['armrest'],modeldata['prono'],modeldata['findex'],modeldata['fgroup'],modeldata['fthumb'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+            self.show_exo_model(modeldata)
+            if self.flatten_moving_exos:
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,True], appendTask = True)
             
         elif type[0] == 'static':
             # Load, modify and reparent models
-            modeldata = self.create_exo_model(type[1])
+            instanced = self.use_instancing()
+            modeldata = self.create_instanced_exo_model(('exo',type[1])) if instanced else self.create_exo_model(type[1])
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
-            print(data)
+            log.debug('Initial parameters: %s',data)
             
             # Create logic objects
             dc = ExoDataControllerStatic(rand_id,self.cfgprofile['calibration'],type[1],data[0],data[1],data[2],data[3],data[4],data[5],data[6])
             exo = ExoLogic(modeldata['exo'],modeldata['armrest'],modeldata['prono'],modeldata['findex'],modeldata['fgroup'],modeldata['fthumb'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            if instanced:
+                # The pose of a static exo is only set once
+                exo.getDataTask(None)
+                self.update_instances(modeldata)
+            else:
+                self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+                self.show_exo_model(modeldata)
+            if self.flatten_static_exos and not(instanced):
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,False], appendTask = True)
             
         elif type[0] == 'realtime':
             # Load, modify and reparent models
             modeldata = self.create_exo_model(type[1])
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
             # Create logic objects
             dc = ExoDataControllerRealTime(rand_id,self.cfgprofile['calibration'],type[1])
@@ -1199,59 +1742,82 @@ class ProgramLogic():
             exo = ExoLogic(modeldata['exo'],modeldata['armrest'],modeldata['prono'],modeldata['findex'],modeldata['fgroup'],modeldata['fthumb'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+            self.show_exo_model(modeldata)
+            if self.flatten_moving_exos:
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,True], appendTask = True)
             
-        print("MESSAGE: # Exos in scene: "+ str(len(self.exos)) +"; Last id: "+self.exo_ids_in_order[-1])
+        log.info('# Exos in scene: %d; Last id: %s',len(self.exos),self.exo_ids_in_order[-1])
+        if connection is not None:
+            self.send_exo_id(rand_id,connection,token,request)
         return Task.done
         
-    def addBaseTask(self,type,data):
-        ''' Function that adds a new task to the taskmanager. The new task adds a new base of specified type. '''
+    def addBaseTask(self,type,data,connection=None,token=None,request=None):
+        ''' Function that adds a new task to the taskmanager. The new task adds a new base of specified type. If CONNECTION is given, the id of the new exo (and TOKEN) is sent back as soon as the exo has been added, as acknowledgement of REQUEST if the command had a request number. '''
         
         if type == 'keyboard':
             # Load, modify and reparent models
             modeldata = self.create_exo_model_base()
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
             # Create logic objects
             dc = BaseDataControllerKeyboard(rand_id)
             exo = BaseLogic(modeldata['exo'],modeldata['armrest'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+            self.show_exo_model(modeldata)
+            if self.flatten_moving_exos:
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,True], appendTask = True)
             
         elif type == 'static':
             # Load, modify and reparent models
-            modeldata = self.create_exo_model_base()
+            instanced = self.use_instancing()
+            modeldata = self.create_instanced_exo_model(('base',)) if instanced else self.create_exo_model_base()
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
-            print(data)
+            log.debug('Initial parameters: %s',data)
             
             # Create logic objects
             dc = BaseDataControllerStatic(rand_id,self.cfgprofile['calibration'],data[0],data[1],data[2])
             exo = BaseLogic(modeldata['exo'],modeldata['armrest'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            if instanced:
+                # The pose of a static base is only set once
+                exo.getDataTask(None)
+                self.update_instances(modeldata)
+            else:
+                self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+                self.show_exo_model(modeldata)
+            if self.flatten_static_exos and not(instanced):
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,False], appendTask = True)
             
         elif type == 'realtime':
             # Load, modify and reparent models
             modeldata = self.create_exo_model_base()
             
             # Create unique ID for exo
-            rand_id = ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(5))
+            rand_id = self.new_exo_id()
             
             # Create logic objects
             dc = BaseDataControllerRealTime(rand_id,self.cfgprofile['calibration'])
@@ -1259,12 +1825,19 @@ class ProgramLogic():
             exo = BaseLogic(modeldata['exo'],modeldata['armrest'],dc)
             
             # Add Exo to the program logic
+            exo.modeldata = modeldata
+            exo.materials = self.materialCache
+            exo.transparencyMode = self.transparency_mode
             self.exos[rand_id] = exo
             self.exo_ids_in_order.append(rand_id)
-            taskMgr.add(self.exos[rand_id].getDataTask, "moveTask")
-            self.exos[rand_id].exo.reparentTo(self.rootNode)
+            self.exos[rand_id].moveTask = taskMgr.add(self.exos[rand_id].getDataTask, "moveTask", sort = MOVE_TASK_SORT)
+            self.show_exo_model(modeldata)
+            if self.flatten_moving_exos:
+                taskMgr.add(self.tskFlattenExo, "flattenExoTask", sort = MOVE_TASK_SORT + 1, extraArgs = [exo,True], appendTask = True)
             
-        print("MESSAGE: # Exos in scene: "+ str(len(self.exos)) +"; Last id: "+self.exo_ids_in_order[-1])
+        log.info('# Exos in scene: %d; Last id: %s',len(self.exos),self.exo_ids_in_order[-1])
+        if connection is not None:
+            self.send_exo_id(rand_id,connection,token,request)
         return Task.done
         
     def toggleMatTask(self,side):
@@ -1275,7 +1848,19 @@ class ProgramLogic():
             
         # Create logic objects
         mat = MatLogic(modeldata['mat'],side)
-            
+        
+        # The mat is shown when its model has been loaded
+        self.requestedMat = mat
+        self.modelPrototypes.request([modeldata['name']],partial(self.show_mat,mat,modeldata['name']))
+        
+        return Task.done
+        
+    def show_mat(self,mat,name):
+        ''' Replaces the mat of the scene by MAT once its model NAME has been loaded, unless another mat has been requested in the meantime. '''
+        if mat is not self.requestedMat:
+            return
+        self.modelPrototypes.copy(name).reparentTo(mat.mat)
+        
         # Remove existing mat from the rendering tree if necessary
         if self.mat:
             self.mat.mat.detachNode()
@@ -1284,29 +1869,200 @@ class ProgramLogic():
         self.mat = mat
         self.mat.mat.reparentTo(self.rootNode)
         
-        return Task.done
-        
     def removeExoTask(self,id):
         ''' Removes specific exo from program logic (and secene). '''
         
         if id == 'last' and len(self.exos) > 0:
             # Remove exo model from rendering
-            self.exos[self.exo_ids_in_order[-1]].exo.detachNode()
+            self.release_exo(self.exos[self.exo_ids_in_order[-1]])
             # Remove ExoLogic from ProgramLogic
+            self.dataSequences.pop(self.exo_ids_in_order[-1],None)
             del self.exos[self.exo_ids_in_order[-1]]
             # Remove the id of the Exo from ProgramLogic
             del self.exo_ids_in_order[-1]
         
         elif id in self.exos:
             # Remove exo model from rendering
-            self.exos[id].exo.detachNode()
+            self.release_exo(self.exos[id])
             # Remove ExoLogic from ProgramLogic
+            self.dataSequences.pop(id,None)
             del self.exos[id]
             # Remove the id of the Exo from ProgramLogic
             del self.exo_ids_in_order[self.exo_ids_in_order.index(id)]
             
         return Task.done
     
+    def release_exo(self,exo):
+        ''' Stops moving the exo EXO (ExoLogic or BaseLogic) and removes its models from the scene. The models are kept for the next exo of the same type if recycle_exos is True. '''
+        if exo.moveTask is not None:
+            taskMgr.remove(exo.moveTask)
+            exo.moveTask = None
+        if exo.modeldata is not None:
+            exo.modeldata['parent'] = None
+        if exo.modeldata is not None and 'instances' in exo.modeldata:
+            self.remove_instances(exo.modeldata)
+        elif self.recycle_exos and exo.modeldata is not None and not(exo.modeldata.get('failed')):
+            self.exoRecycler.release(exo.modeldata['key'],exo.exo,exo.modeldata,globalClock.getFrameCount())
+        else:
+            exo.exo.removeNode()
+        exo.modeldata = None
+        
+    def get_recycling_stats(self):
+        ''' Returns the statistics of the recycled exo models: the number of reused (hits) and newly created models (misses), the hit rate, the number of released and of removed models (the pool was full) and the number of kept models (by type and handedness) and of their nodes. '''
+        stats = dict(self.exoRecycler.stats)
+        stats.update(self.exoRecycler.held())
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        return stats
+    
+    def tskFlattenExo(self,exo,rigid_only,task):
+        ''' Task that merges the parts of the exo or base EXO once its models have been loaded and its position has been set. One level of detail is merged per frame (see advlod.select_level), which spreads the work of adding static exos over several frames. The merged exo replaces the parts, which are stashed.
+        All parts of a static exo are merged and the exo is not moved any more. If RIGID_ONLY is True (real-time and keyboard exos), only the base and the armrest are merged (see flatten_parts) and the exo keeps moving. '''
+        data = exo.modeldata
+        # The exo has been deleted or one of its parts has been changed
+        if data is None or data['articulated']:
+            return Task.done
+        if not(data['ready']):
+            return Task.cont
+        
+        levels = data.setdefault('flat_levels',[])
+        lod = data['exo'].find('**/+LODNode')
+        level_count = lod.node().getNumSwitches() if not(lod.isEmpty()) else 1
+        parts = self.flatten_parts(data,rigid_only)
+        if len(levels) < level_count:
+            merged = NodePath('flat')
+            for part in parts:
+                # The parts below the armrest are copied with the transform and the state (materials) of the armrest
+                copy = part.copyTo(merged)
+                copy.setTransform(part.getTransform(data['exo']))
+                copy.setState(part.getState(data['exo']))
+            levels.append(flatten_model(select_level(merged,len(levels))))
+            return Task.cont
+        
+        del data['flat_levels']
+        flat = make_lod('flat',levels,self.lod_distances) if len(levels) > 1 else levels[0]
+        for part in parts:
+            part.stash()
+        data['flat_parts'] = parts
+        flat.reparentTo(data['exo'])
+        data['flat'] = flat
+        if not(rigid_only) and exo.moveTask is not None:
+            taskMgr.remove(exo.moveTask)
+            exo.moveTask = None
+        return Task.done
+        
+    def flatten_parts(self,data,rigid_only):
+        ''' Returns the parts of the exo model DATA that tskFlattenExo merges: all nodes below the root of the exo, or, if RIGID_ONLY is True, only the models of the base and of the armrest, without the arm (prono and fingers), which moves relative to them. '''
+        if not(rigid_only):
+            return list(data['exo'].getChildren())
+        parts = [child for child in data['exo'].getChildren() if child != data['armrest']]
+        parts += [child for child in data['armrest'].getChildren() if not('prono' in data and child == data['prono'])]
+        return parts
+        
+    def get_draw_stats(self):
+        ''' Returns the number of nodes, geoms (about the number of draw calls) and triangles of the scene (at the highest level of detail). Instanced models (see use_instancing) are counted once. '''
+        analyzer = SceneGraphAnalyzer()
+        analyzer.setLodMode(SceneGraphAnalyzer.LM_highest)
+        analyzer.addNode(self.rootNode.node())
+        return {'nodes': analyzer.getNumNodes(), 'geoms': analyzer.getNumGeoms(), 'triangles': analyzer.getNumTris()}
+    
+    def get_state_stats(self):
+        ''' Returns the number of different render states of the geoms in the scene (the geoms are drawn sorted by state, so this is about the number of state changes per frame) and of the different materials in the scene, the number of shared materials (see advassets.MaterialCache) with their hits and misses, and the number of all render states Panda3D keeps. '''
+        states = set()
+        materials = set()
+        for path in self.rootNode.findAllMatches('**/+GeomNode'):
+            net = path.getNetState()
+            node = path.node()
+            for i in range(node.getNumGeoms()):
+                state = net.compose(node.getGeomState(i))
+                states.add(state)
+                if state.hasAttrib(MaterialAttrib) and state.getAttrib(MaterialAttrib).getMaterial() is not None:
+                    materials.add(state.getAttrib(MaterialAttrib).getMaterial())
+        stats = {'states': len(states), 'materials': len(materials), 'shared_materials': len(self.materialCache.materials), 'render_states': RenderState.getNumStates()}
+        stats.update(self.materialCache.stats)
+        return stats
+        
+    def use_instancing(self):
+        ''' Returns True if static exos are drawn with hardware instancing (see instance_static_exos). Whether the graphics card supports it is checked once. '''
+        if not(self.instance_static_exos):
+            return False
+        if self.instancedModels is None:
+            gsg = base.win.getGsg() if base.win is not None else None
+            if supports_instancing(gsg):
+                self.instancedModels = {}
+                taskMgr.add(self.tskUpdateInstances, "instanceUpdateTask", sort = INSTANCE_TASK_SORT)
+            else:
+                self.instancedModels = False
+                log.info('Hardware instancing is not available. Static exos are drawn as separate models.')
+        return self.instancedModels is not False
+        
+    def create_instanced_exo_model(self,key):
+        ''' Creates the models of a static exo or base (KEY as in create_exo_model) that is drawn with hardware instancing. The parts are empty nodes that are not shown: they hold the pose and the materials of the exo (so the exo logic works as with other exos), which tskUpdateInstances copies to the instances of the shared models. '''
+        data = {'key': key, 'ready': False, 'parent': None, 'articulated': False, 'flat': None, 'instances': {}, 'update': False}
+        if key[0] == 'exo':
+            side = 'right' if key[1] == 'right' else 'left'
+            models = {'exo': 'exo3_base', 'armrest': 'exo3_arm_rest',
+                      'prono': 'exo3_prono_' + side, 'findex': 'exo3_findex_' + side, 'fgroup': 'exo3_fgroup_' + side, 'fthumb': 'exo3_fthumb_' + side}
+        else:
+            models = {'exo': 'exo3_base', 'armrest': 'exo3_arm_rest'}
+        for part in models:
+            data[part] = NodePath(part)
+        data['armrest'].reparentTo(data['exo'])
+        if key[0] == 'exo':
+            data['prono'].reparentTo(data['armrest'])
+            data['fthumb'].reparentTo(data['prono'])
+            data['fgroup'].reparentTo(data['prono'])
+            data['findex'].reparentTo(data['prono'])
+        self.reset_exo_model(data)
+        
+        self.modelPrototypes.request(list(models.values()),partial(self.add_instances,data,models),partial(self.fail_exo_model,data))
+        return data
+        
+    def add_instances(self,data,models):
+        ''' Adds an instance of the model of each part of the instanced exo DATA (MODELS: part -> name of the model) once all models have been loaded (see create_instanced_exo_model). '''
+        if data['instances'] is None:
+            # The exo has been deleted in the meantime
+            return
+        for part, name in models.items():
+            if name not in self.instancedModels:
+                model = flatten_model(select_level(self.modelPrototypes.copy(name),self.instance_lod_level))
+                self.instancedModels[name] = InstancedModel(name,model,self.rootNode)
+            data['instances'][part] = (self.instancedModels[name],self.instancedModels[name].add())
+        data['ready'] = True
+        self.update_instances(data)
+        
+    def update_instances(self,data):
+        ''' Marks the instances of the exo models DATA to be updated by tskUpdateInstances (at the end of the frame, after the color tasks have run). Other exos are ignored. '''
+        if data is None or 'instances' not in data or data['update']:
+            return
+        data['update'] = True
+        self.instanceUpdates.append(data)
+        
+    def remove_instances(self,data):
+        ''' Removes the instances of the exo models DATA (see create_instanced_exo_model). '''
+        for model, instance in data['instances'].values():
+            model.remove(instance)
+        data['instances'] = None
+        
+    def tskUpdateInstances(self,task):
+        ''' Task that copies the pose, colors and transparency of the instanced exos that have changed to their instances and uploads the instances of each model that have changed. '''
+        for data in self.instanceUpdates:
+            data['update'] = False
+            if not(data['instances']):
+                continue
+            root = data['exo']
+            scale = root.getColorScale()
+            transparent = root.getTransparency() != TransparencyAttrib.MNone
+            for part, (model, instance) in data['instances'].items():
+                node = data[part]
+                material = node.getMaterial() if node.hasMaterial() else root.getMaterial()
+                model.set_instance(instance,node.getNetTransform().getMat(),material.getAmbient(),material.getDiffuse(),scale,transparent)
+        self.instanceUpdates.clear()
+        
+        for model in self.instancedModels.values():
+            model.flush()
+        return Task.cont
+    
     #TODO: REMOVE Mat
     
     def changeBgColorTask(self,color):
@@ -1332,123 +2088,161 @@ class ProgramLogic():
     
         return Task.done
 
-        def loadConfigTask(self,filename):
-            ''' Loads and initializes config.'''
-            cfg = {}
-            cfg = self.loadconfig(filename)
+    def loadConfigTask(self,filename):
+        ''' Loads and initializes config.'''
+        cfg = {}
+        cfg = self.loadconfig(filename)
 
-            if(cfg):
-                self.initializeconfig(cfg)
+        if(cfg):
+            self.initializeconfig(cfg)
 
-            return Task.done
+        return Task.done
 
-        def setConfigTask(self,exo_id):
-            ''' Sets the current configuration dictionary as calibration profile of the specified exo.'''
-            self.exos[exo_id].dc.setconfig(self.cfgprofile['calibration'])
+    def setConfigTask(self,exo_id):
+        ''' Sets the current configuration dictionary as calibration profile of the specified exo.'''
+        self.exos[exo_id].dc.setconfig(self.cfgprofile['calibration'])
 
-            return Task.done
+        return Task.done
     
-    def create_exo_model(self,handedness):
-        ''' Function that loads an exo model with left or right hand arm. '''
-        # Load models
-        data = {}
-        data['exo'] = loader.loadModel('models/exo3_base')
-        data['armrest'] = loader.loadModel('models/exo3_arm_rest')
-        
-        if handedness == 'right':
-            data['fthumb'] = loader.loadModel('models/exo3_fthumb_right')
-            data['fgroup'] = loader.loadModel('models/exo3_fgroup_right')
-            data['findex'] = loader.loadModel('models/exo3_findex_right')
-            data['prono'] = loader.loadModel('models/exo3_prono_right2')
-            
-            data['prono'].setPos(0.1,1.8,1.5)
-            data['prono'].setP(0)
-            data['fthumb'].setPos(-0.5,0.3,0.5)
-            data['fgroup'].setPos(0.6,0.3,0.3)
-            data['fgroup'].setH(120)
-            data['findex'].setPos(0.6,0.3,1)
-            data['findex'].setH(120)
+    def load_model(self,name):
+        ''' Loads the model NAME (e.g. "exo3_base") from the asset cache (see advassets.py) or, if the cache is disabled or cannot be written, from its .egg file. The exo models are loaded with their levels of detail if use_lod is True and the levels have been built. '''
+        if self.assetCache is not None:
+            try:
+                return self.assetCache.load(name,self.lod_distances if self.use_lod and name in EXO_MODEL_NAMES else None)
+            except OSError as e:
+                log.error('%s The .egg files are loaded instead.',e)
+                self.assetCache = None
+        return flatten_model(loader.loadModel('models/' + name))
+        
+    def load_model_async(self,name,callback):
+        ''' Loads the model NAME like load_model, but in the background, and calls CALLBACK with the model. '''
+        if self.assetCache is not None:
+            self.assetCache.load_async(name,callback,self.lod_distances if self.use_lod and name in EXO_MODEL_NAMES else None)
         else:
-            data['fthumb'] = loader.loadModel('models/exo3_fthumb_left')
-            data['fgroup'] = loader.loadModel('models/exo3_fgroup_left')
-            data['findex'] = loader.loadModel('models/exo3_findex_left')
-            data['prono'] = loader.loadModel('models/exo3_prono_left')
-            
-            data['prono'].setPos(0.1,1.8,1.5)
-            data['prono'].setP(0)
-            data['fthumb'].setPos(0.5,0.3,0.5)
-            data['fgroup'].setPos(-0.6,0.3,0.3)
-            data['fgroup'].setH(120)
-            data['findex'].setPos(-0.6,0.3,1)
-            data['findex'].setH(120)
-    
-        # Define and set materials
-        exoMaterial = Material()
-        exoMaterial.setShininess(5.0)
-        exoMaterial.setAmbient((0.6,0.6,0.6,1))
-        exoMaterial.setDiffuse((0.25,0.25,0.25,.25))
-        
-        armMaterialList = [Material() for i in range(5)]
-        for i in range(5):
-            armMaterialList[i].setShininess(12.0)
-            armMaterialList[i].setAmbient((0.6,0.6,0.6,1))
-            armMaterialList[i].setDiffuse((0.3,0.3,0.3,1))
-        
-        data['exomaterial'] = exoMaterial
-        
-        data['exo'].setMaterial(exoMaterial)
-        data['armrest'].setMaterial(armMaterialList[0])
-        data['prono'].setMaterial(armMaterialList[1])
-        data['fthumb'].setMaterial(armMaterialList[2])
-        data['fgroup'].setMaterial(armMaterialList[3])
-        data['findex'].setMaterial(armMaterialList[4])
-        
-        # Reparent objects        
-        data['armrest'].reparentTo(data['exo'])
-        data['prono'].reparentTo(data['armrest'])
-        data['fthumb'].reparentTo(data['prono'])
-        data['fgroup'].reparentTo(data['prono'])
-        data['findex'].reparentTo(data['prono'])
+            loader.loadModel('models/' + name,callback=lambda model: callback(flatten_model(model) if model is not None else None))
+        
+    def create_exo_model(self,handedness):
+        ''' Function that creates an exo model with left or right hand arm. Each part is an empty node that gets a copy of its model (see fill_exo_model) as soon as the model has been loaded (see async_loading), so the exo can be moved and colored before. The models of a deleted exo are reused if available (see recycle_exos). '''
+        data = self.exoRecycler.acquire(('exo',handedness),globalClock.getFrameCount()) if self.recycle_exos else None
+        if data is not None and data.get('failed'):
+            data['exo'].removeNode()
+            data = None
+        if data is None:
+            data = {'key': ('exo',handedness), 'ready': False, 'parent': None, 'articulated': False, 'flat': None}
+            side = 'right' if handedness == 'right' else 'left'
+            models = {'exo': 'exo3_base', 'armrest': 'exo3_arm_rest',
+                      'prono': 'exo3_prono_' + side, 'findex': 'exo3_findex_' + side, 'fgroup': 'exo3_fgroup_' + side, 'fthumb': 'exo3_fthumb_' + side}
+            for part in models:
+                data[part] = NodePath(part)
+            
+            # Reparent objects        
+            data['armrest'].reparentTo(data['exo'])
+            data['prono'].reparentTo(data['armrest'])
+            data['fthumb'].reparentTo(data['prono'])
+            data['fgroup'].reparentTo(data['prono'])
+            data['findex'].reparentTo(data['prono'])
+            
+            # Load models
+            self.modelPrototypes.request(list(models.values()),partial(self.fill_exo_model,data,models),partial(self.fail_exo_model,data))
         
+        self.reset_exo_model(data)
         return data
         
     def create_exo_model_base(self):
-        ''' Function that loads an exo model without arm. '''
-        # Load models
-        data = {}
-        data['exo'] = loader.loadModel('models/exo3_base')
-        data['armrest'] = loader.loadModel('models/exo3_arm_rest')
-        
-        # Define and set materials
-        exoMaterial = Material()
-        exoMaterial.setShininess(5.0)
-        exoMaterial.setAmbient((0.6,0.6,0.6,1))
-        exoMaterial.setDiffuse((0.25,0.25,0.25,.25))
-        
-        armMaterial = Material()
-        armMaterial.setShininess(12.0)
-        armMaterial.setAmbient((0.6,0.6,0.6,1))
-        armMaterial.setDiffuse((0.3,0.3,0.3,1))
-        
-        data['exomaterial'] = exoMaterial
-        
-        data['exo'].setMaterial(exoMaterial)
-        data['armrest'].setMaterial(armMaterial)
-        
-        # Reparent objects        
-        data['armrest'].reparentTo(data['exo'])
+        ''' Function that creates an exo model without arm (see create_exo_model). '''
+        data = self.exoRecycler.acquire(('base',),globalClock.getFrameCount()) if self.recycle_exos else None
+        if data is not None and data.get('failed'):
+            data['exo'].removeNode()
+            data = None
+        if data is None:
+            data = {'key': ('base',), 'ready': False, 'parent': None, 'articulated': False, 'flat': None}
+            models = {'exo': 'exo3_base', 'armrest': 'exo3_arm_rest'}
+            for part in models:
+                data[part] = NodePath(part)
+            
+            # Reparent objects        
+            data['armrest'].reparentTo(data['exo'])
+            
+            # Load models
+            self.modelPrototypes.request(list(models.values()),partial(self.fill_exo_model,data,models),partial(self.fail_exo_model,data))
         
+        self.reset_exo_model(data)
         return data
         
+    def fill_exo_model(self,data,models):
+        ''' Adds a copy of the model of each part of the exo model DATA (MODELS: part -> name of the model) once all models have been loaded, and shows the exo if it has been added (see show_exo_model). '''
+        # The exo has been deleted and its models removed (not recycled) before its models were loaded (see release_exo)
+        if data['parent'] is None and data['exo'].isEmpty():
+            return
+        for part, name in models.items():
+            self.modelPrototypes.copy(name).reparentTo(data[part])
+        data['ready'] = True
+        if data['parent'] is not None:
+            data['exo'].reparentTo(data['parent'])
+        
+    def fail_exo_model(self,data):
+        ''' Called instead of fill_exo_model (or add_instances) if a model of the exo model DATA could not be loaded. The models are not reused and the exo that has them is removed, so that later commands to it are rejected (the id is not found). '''
+        data['failed'] = True
+        for id in self.exo_ids_in_order:
+            if self.exos[id].modeldata is data:
+                log.error('Exo %s removed, its models could not be loaded.',id)
+                self.removeExoTask(id)
+                break
+        
+    def show_exo_model(self,data):
+        ''' Adds the exo model DATA to the scene, at once if its models have been loaded, otherwise as soon as they have been loaded. '''
+        data['parent'] = self.rootNode
+        if data['ready']:
+            data['exo'].reparentTo(self.rootNode)
+        
+    def reset_exo_model(self,data):
+        ''' Sets the initial position, colors and transparency of the models DATA of an exo or base (see create_exo_model), which may have been used by a deleted exo. '''
+        data['exo'].clearTransform()
+        data['exo'].clearColorScale()
+        data['exo'].clearTransparency()
+        data['exo'].clearDepthWrite()
+        data['exo'].clearBin()
+        
+        # Separate the parts if they have been merged (see tskFlattenExo)
+        if data['flat'] is not None:
+            data['flat'].removeNode()
+            data['flat'] = None
+            for part in data.pop('flat_parts',()):
+                part.unstash()
+        data['articulated'] = False
+        data.pop('flat_levels',None)
+        
+        # Set the initial position of the arm module
+        if data['key'][0] == 'exo':
+            data['prono'].setPosHpr(0.1,1.8,1.5,0,0,0)
+            if data['key'][1] == 'right':
+                data['fthumb'].setPosHpr(-0.5,0.3,0.5,0,0,0)
+                data['fgroup'].setPosHpr(0.6,0.3,0.3,120,0,0)
+                data['findex'].setPosHpr(0.6,0.3,1,120,0,0)
+            else:
+                data['fthumb'].setPosHpr(0.5,0.3,0.5,0,0,0)
+                data['fgroup'].setPosHpr(-0.6,0.3,0.3,120,0,0)
+                data['findex'].setPosHpr(-0.6,0.3,1,120,0,0)
+        
+        # Set the materials (shared by all exos of the same colors, see advassets.MaterialCache). The parts of the arm have the same material, so that they can be merged into one geom (see tskFlattenExo).
+        data['exo'].setMaterial(self.materialCache.get('exo'))
+        armMaterial = self.materialCache.get('arm')
+        if data['key'][0] == 'exo':
+            parts = ('armrest','prono','fthumb','fgroup','findex')
+        else:
+            parts = ('armrest',)
+        for part in parts:
+            data[part].setMaterial(armMaterial)
+        
     def create_mat_model(self,side):
-        ''' Function that loads an exo model without arm. '''
-        # Load models
+        ''' Function that creates the node of a mat, which gets a copy of the model NAME once it has been loaded (see show_mat). '''
         data = {}
         
         if side.lower() == 'left':
-            data['mat'] = loader.loadModel('models/mat_left')
+            data['name'] = 'mat_left'
         elif side.lower() == 'right':
-            data['mat'] = loader.loadModel('models/mat_right')
+            data['name'] = 'mat_right'
+        data['mat'] = NodePath('mat')
         
         return data
         
@@ -1459,16 +2253,16 @@ class ProgramLogic():
         for j in range(len(matrix)):
             dotProd.append(sum( [matrix[j][i]*vector[i] for i in range(len(vector))] ))
         
-        print(dotProd)
+        log.debug('Dot product: %s',dotProd)
         return dotProd
 
     def loadconfig(self,filename):
         ''' Loads a yaml configuration file and returns contents as a dictionary.''' 
         import advvis_config
-        print(advvis_config.cfg)
+        log.debug('Configuration: %s',advvis_config.cfg)
         return advvis_config.cfg
 
     def initializeconfig(self,config_dictionary):
         ''' Sets a configuration dictionary as cfgprofile in the program logic.'''
         self.cfgprofile = config_dictionary
-        print("New profile initialized.")
\ No newline at end of file
+        log.info('New profile initialized.')
\ No newline at end of file
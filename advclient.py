@@ -0,0 +1,362 @@
+# Client library for the command interface of the advanced feedback
+# The commands are explained in adv_command_structure.txt. This module does not depend on Panda3D.
+#
+# Example:
+#     client = CommandClient('127.0.0.1',9900)
+#     exo_id = client.wait(client.addexo('EXOREALTIME','LEFT',[0,0,0,0,0,0,0]))
+#     for sample in samples:
+#         client.data(exo_id,sample)
+#     client.flush()
+#     client.close()
+
+# ### Imports ### #
+import asyncio
+import select
+import socket
+import time
+
+from advprotocol import COMMAND_ENCODING, COMMAND_SEPARATOR, pack_binary_data, split_replies, parse_reply
+
+# ### Begin ### #
+
+# Number of bytes that are collected at most before they are sent (see CommandClient.flush)
+MAX_PENDING = 65536
+
+# ### Command builders ### #
+# Each function returns a command as text (without the separator).
+
+def format_values(values):
+    ''' Returns a list of numbers as comma separated values. '''
+    return ','.join([repr(float(value)) for value in values])
+
+def pad_dofs(dofs):
+    ''' Returns the degrees of freedom DOFS as 7 values. The DATA and DATABATCH commands carry 7 values for bases too, only the first 3 are used. '''
+    if len(dofs) == 3:
+        return list(dofs) + [0.0]*4
+    return dofs
+
+def build_addexo(exotype,handedness,params=None,token=None):
+    ''' "ADDEXO" command. PARAMS are the 7 parameters of EXOSTATIC and EXOREALTIME exos. '''
+    command = 'ADDEXO ' + exotype.upper() + ' ' + handedness.upper()
+    if params is not None:
+        command += ' ' + format_values(params)
+    if token is not None:
+        command += ' ' + token
+    return command
+
+def build_addbase(exotype,params=None,token=None):
+    ''' "ADDBASE" command. PARAMS are the 3 parameters of EXOSTATIC and EXOREALTIME exos. '''
+    command = 'ADDBASE ' + exotype.upper()
+    if params is not None:
+        command += ' ' + format_values(params)
+    if token is not None:
+        command += ' ' + token
+    return command
+
+def build_delete(exo_id):
+    ''' "DELETE" command '''
+    return 'DELETE ' + exo_id
+
+def build_data(exo_id,dofs,sequence=None):
+    ''' "DATA" command. DOFS are the 7 (exo) or 3 (base) degrees of freedom (see pad_dofs). '''
+    command = 'DATA ' + exo_id + ' ' + format_values(pad_dofs(dofs))
+    if sequence is not None:
+        command += ' ' + str(sequence)
+    return command
+
+def build_databatch(samples,sequence=None):
+    ''' "DATABATCH" command. SAMPLES is a list of (exo id, degrees of freedom) or a dict (see build_data). '''
+    if isinstance(samples,dict):
+        samples = samples.items()
+    command = 'DATABATCH ' + ' '.join([exo_id + ' ' + format_values(pad_dofs(dofs)) for exo_id, dofs in samples])
+    if sequence is not None:
+        command += ' ' + str(sequence)
+    return command
+
+def build_resetsequence(exo_id):
+    ''' "RESETSEQUENCE" command '''
+    return 'RESETSEQUENCE ' + exo_id
+
+def build_togglemat(side):
+    ''' "TOGGLEMAT" command '''
+    return 'TOGGLEMAT ' + side.upper()
+
+def build_setcolorbase(exo_id,target,color):
+    ''' "SETCOLORBASE" command. TARGET is "BASE" or "ARMREST", COLOR are RGB values between 0 and 1. '''
+    return 'SETCOLORBASE ' + exo_id + ' ' + target.upper() + ' ' + format_values(color)
+
+def build_setcolorhand(exo_id,target,color):
+    ''' "SETCOLORHAND" command. TARGET is "SUPPRO", "INDEX", "FINGERGROUP" or "THUMB", COLOR are RGB values between 0 and 1. '''
+    return 'SETCOLORHAND ' + exo_id + ' ' + target.upper() + ' ' + format_values(color)
+
+def build_toggletransparency(exo_id,mode=None):
+    ''' "TOGGLETRANSPARENCY" command. MODE is "ALPHA", "DUAL", "MULTISAMPLE" or "BINARY" (None: the mode the exo has). '''
+    command = 'TOGGLETRANSPARENCY ' + exo_id
+    if mode is not None:
+        command += ' ' + mode.upper()
+    return command
+
+def build_setbgcolor(color):
+    ''' "SETBGCOLOR" command '''
+    return 'SETBGCOLOR ' + format_values(color)
+
+def build_setcamera(position,orientation):
+    ''' "SETCAMERA" command. POSITION is x,y,z and ORIENTATION is heading,pitch,roll. '''
+    return 'SETCAMERA ' + format_values(list(position) + list(orientation))
+
+def build_rotatecamera(angle):
+    ''' "ROTATECAMERA" command '''
+    return 'ROTATECAMERA ' + repr(float(angle))
+
+def build_loadconfig(filename):
+    ''' "LOADCONFIG" command '''
+    return 'LOADCONFIG ' + filename
+
+def build_setconfig(exo_id):
+    ''' "SETCONFIG" command '''
+    return 'SETCONFIG ' + exo_id
+
+def build_exit():
+    ''' "EXIT" command '''
+    return 'EXIT'
+
+# ### Clients ### #
+
+class CommandBuilder(object):
+    ''' Methods for all commands of the command interface. Used by CommandClient and AsyncCommandClient, which provide queue(data).
+    The commands are sent with a request number if ACKNOWLEDGE is True. These methods return the request number (or None), which can be passed to wait. ADDEXO and ADDBASE are always sent with a request number, as the reply contains the id of the new exo (followed by the correlation TOKEN, e.g. "@3", if one is given). '''
+
+    def __init__(self,acknowledge=False):
+        self.acknowledge = acknowledge
+        self.next_request = 1
+        # Replies by request number: (True or False for "OK" or "ERR", rest of the reply)
+        self.replies = {}
+        # Ids of the exos added by commands without request number
+        self.exo_ids = []
+        self.received = b''
+
+    def send(self,command):
+        ''' Queues a command (text without the separator) without request number. '''
+        self.queue(command.encode(COMMAND_ENCODING) + COMMAND_SEPARATOR)
+
+    def request(self,command):
+        ''' Queues a command with a request number. Returns the request number. '''
+        request = self.next_request
+        self.next_request += 1
+        self.queue(('#' + str(request) + ' ' + command).encode(COMMAND_ENCODING) + COMMAND_SEPARATOR)
+        return request
+
+    def command(self,command):
+        ''' Queues a command. It gets a request number if ACKNOWLEDGE is True. Returns the request number or None. '''
+        if self.acknowledge:
+            return self.request(command)
+        self.queue(command.encode(COMMAND_ENCODING) + COMMAND_SEPARATOR)
+        return None
+
+    def handle_data(self,data):
+        ''' Adds received data to the replies. Returns the list of the complete replies. '''
+        replies, self.received = split_replies(self.received + data)
+        for reply in replies:
+            request, ok, message = parse_reply(reply)
+            if request is None:
+                self.exo_ids.append(message)
+            else:
+                self.handle_reply(request,ok,message)
+        return replies
+
+    def handle_reply(self,request,ok,message):
+        ''' Stores the reply to a request. '''
+        self.replies[request] = (ok, message)
+
+    def addexo(self,exotype,handedness,params=None,token=None):
+        return self.request(build_addexo(exotype,handedness,params,token))
+
+    def addbase(self,exotype,params=None,token=None):
+        return self.request(build_addbase(exotype,params,token))
+
+    def delete(self,exo_id):
+        return self.command(build_delete(exo_id))
+
+    def data(self,exo_id,dofs,sequence=None):
+        return self.command(build_data(exo_id,dofs,sequence))
+
+    def data_binary(self,exo_id,dofs,sequence=None):
+        ''' Queues a binary DATA frame. Binary frames are never acknowledged. '''
+        self.queue(pack_binary_data(exo_id,dofs,sequence))
+
+    def databatch(self,samples,sequence=None):
+        return self.command(build_databatch(samples,sequence))
+
+    def resetsequence(self,exo_id):
+        return self.command(build_resetsequence(exo_id))
+
+    def togglemat(self,side):
+        return self.command(build_togglemat(side))
+
+    def setcolorbase(self,exo_id,target,color):
+        return self.command(build_setcolorbase(exo_id,target,color))
+
+    def setcolorhand(self,exo_id,target,color):
+        return self.command(build_setcolorhand(exo_id,target,color))
+
+    def toggletransparency(self,exo_id,mode=None):
+        return self.command(build_toggletransparency(exo_id,mode))
+
+    def setbgcolor(self,color):
+        return self.command(build_setbgcolor(color))
+
+    def setcamera(self,position,orientation):
+        return self.command(build_setcamera(position,orientation))
+
+    def rotatecamera(self,angle):
+        return self.command(build_rotatecamera(angle))
+
+    def loadconfig(self,filename):
+        return self.command(build_loadconfig(filename))
+
+    def setconfig(self,exo_id):
+        return self.command(build_setconfig(exo_id))
+
+    def exit(self):
+        return self.command(build_exit())
+
+class CommandClient(CommandBuilder):
+    ''' Client that keeps one TCP connection to the program. The commands are collected and sent together by flush (or when MAX_PENDING bytes are collected), i.e. with one system call for many commands. '''
+
+    def __init__(self,host='127.0.0.1',port=9900,acknowledge=False,max_pending=MAX_PENDING):
+        super().__init__(acknowledge)
+        self.max_pending = max_pending
+        self.pending = []
+        self.pending_size = 0
+
+        self.sock = socket.create_connection((host,port))
+        self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def queue(self,data):
+        ''' Queues DATA (bytes). '''
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        ''' Sends all queued commands. '''
+        if self.pending:
+            self.sock.sendall(b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def receive_replies(self,timeout=0.0):
+        ''' Reads the replies that arrive within TIMEOUT seconds. Returns the list of the replies (text). '''
+        readable, writable, failed = select.select([self.sock],[],[],timeout)
+        if not(readable):
+            return []
+        data = self.sock.recv(65536)
+        if not(data):
+            raise ConnectionError('Connection closed by the program.')
+        return self.handle_data(data)
+
+    def wait(self,request,timeout=5.0):
+        ''' Sends the queued commands and waits for the reply to REQUEST. Returns the rest of the reply (e.g. the id of an exo added by ADDEXO, otherwise an empty string). Raises a RuntimeError if the command failed. '''
+        self.flush()
+        deadline = time.monotonic() + timeout
+        while not(request in self.replies):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('No reply to request ' + str(request) + ' received.')
+            self.receive_replies(remaining)
+
+        ok, message = self.replies.pop(request)
+        if not(ok):
+            raise RuntimeError('Request ' + str(request) + ' failed: ' + message)
+        return message
+
+    def close(self):
+        ''' Sends the queued commands and closes the connection. '''
+        try:
+            self.flush()
+        finally:
+            self.sock.close()
+
+class AsyncCommandClient(CommandBuilder):
+    ''' Client for asyncio. It is created with "await AsyncCommandClient.connect(...)". The commands are collected and written together by flush, the replies are read by a background task. '''
+
+    def __init__(self,reader,writer,acknowledge=False):
+        super().__init__(acknowledge)
+        self.reader = reader
+        self.writer = writer
+        self.pending = []
+        # Futures of the requests that are waited for
+        self.futures = {}
+        self.receiver = asyncio.ensure_future(self.receive_replies())
+
+    @classmethod
+    async def connect(cls,host='127.0.0.1',port=9900,acknowledge=False):
+        ''' Opens the connection and returns the client. '''
+        reader, writer = await asyncio.open_connection(host,port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        return cls(reader,writer,acknowledge)
+
+    def queue(self,data):
+        ''' Queues DATA (bytes). '''
+        self.pending.append(data)
+
+    async def flush(self):
+        ''' Writes all queued commands and waits until the transport buffer has been drained. '''
+        if self.pending:
+            self.writer.write(b''.join(self.pending))
+            self.pending = []
+        await self.writer.drain()
+
+    async def receive_replies(self):
+        ''' Task that reads the replies. '''
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not(data):
+                    break
+                self.handle_data(data)
+        finally:
+            for future in self.futures.values():
+                if not(future.done()):
+                    future.set_exception(ConnectionError('Connection closed by the program.'))
+
+    def handle_reply(self,request,ok,message):
+        ''' Resolves the future of the request (if it is waited for) or stores the reply. '''
+        future = self.futures.pop(request,None)
+        if future is None:
+            self.replies[request] = (ok, message)
+        elif ok:
+            future.set_result(message)
+        else:
+            future.set_exception(RuntimeError('Request ' + str(request) + ' failed: ' + message))
+
+    async def wait(self,request,timeout=5.0):
+        ''' Writes the queued commands and waits for the reply to REQUEST (see CommandClient.wait). '''
+        await self.flush()
+        if request in self.replies:
+            ok, message = self.replies.pop(request)
+            if not(ok):
+                raise RuntimeError('Request ' + str(request) + ' failed: ' + message)
+            return message
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request] = future
+        try:
+            return await asyncio.wait_for(future,timeout)
+        except asyncio.TimeoutError:
+            self.futures.pop(request,None)
+            raise TimeoutError('No reply to request ' + str(request) + ' received.')
+
+    async def close(self):
+        ''' Writes the queued commands and closes the connection. '''
+        try:
+            await self.flush()
+        finally:
+            self.writer.close()
+            self.receiver.cancel()
@@ -0,0 +1,181 @@
+# Hardware instancing of static exos
+# Static exos (e.g. the targets of a reaching task) never move, so all static exos can share the geometry of their parts.
+# All instances of a model are drawn together with one draw call per geom (see InstancedModel). The transform and the
+# colors of each instance are packed into a buffer texture, which the vertex shader reads with the number of the
+# instance. Only the instances that have changed are packed again and the buffer is uploaded at most once per frame.
+# Needs OpenGL 3.1 (GLSL 1.40, buffer textures and instancing, see supports_instancing).
+
+# ### Imports ### #
+from array import array
+
+from panda3d.core import GeomEnums, OmniBoundingVolume, Shader, Texture, TransparencyAttrib
+
+# ### Begin ### #
+
+# Texels (4 floats) per instance: the first three rows of the transform, the ambient and diffuse color and the color scale
+INSTANCE_TEXELS = 6
+INSTANCE_FLOATS = 4*INSTANCE_TEXELS
+# Maximum number of lights (other than ambient lights) that light the instances
+INSTANCE_MAX_LIGHTS = 4
+
+# The lighting is computed per vertex like the fixed-function lighting of Panda3D (ambient and diffuse, the materials of
+# the exos have no specular color)
+INSTANCE_VERTEX_SHADER = '''#version 140
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+uniform struct p3d_LightSourceParameters {
+    vec4 diffuse;
+    vec4 position;
+    vec3 attenuation;
+} p3d_LightSource[''' + str(INSTANCE_MAX_LIGHTS) + '''];
+uniform samplerBuffer instances;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+
+out vec4 color;
+
+void main() {
+    int offset = gl_InstanceID * ''' + str(INSTANCE_TEXELS) + ''';
+    vec4 x = texelFetch(instances, offset);
+    vec4 y = texelFetch(instances, offset + 1);
+    vec4 z = texelFetch(instances, offset + 2);
+    vec4 ambient = texelFetch(instances, offset + 3);
+    vec4 diffuse = texelFetch(instances, offset + 4);
+    vec4 scale = texelFetch(instances, offset + 5);
+
+    vec4 vertex = vec4(dot(x, p3d_Vertex), dot(y, p3d_Vertex), dot(z, p3d_Vertex), 1.0);
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    vec3 position = vec3(p3d_ModelViewMatrix * vertex);
+    vec3 normal = normalize(p3d_NormalMatrix * vec3(dot(x.xyz, p3d_Normal), dot(y.xyz, p3d_Normal), dot(z.xyz, p3d_Normal)));
+
+    vec3 light = p3d_LightModel.ambient.rgb * ambient.rgb;
+    for (int i = 0; i < ''' + str(INSTANCE_MAX_LIGHTS) + '''; ++i) {
+        vec4 source = p3d_LightSource[i].position;
+        vec3 direction = source.xyz - position * source.w;
+        float distance = length(direction);
+        float attenuation = dot(p3d_LightSource[i].attenuation, vec3(1.0, distance, distance * distance));
+        if (attenuation > 0.0) {
+            light += p3d_LightSource[i].diffuse.rgb * diffuse.rgb * max(dot(normal, direction / distance), 0.0) / attenuation;
+        }
+    }
+    color = vec4(light, diffuse.a) * scale;
+}
+'''
+
+INSTANCE_FRAGMENT_SHADER = '''#version 140
+in vec4 color;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    p3d_FragColor = color;
+}
+'''
+
+# Shader of the instances (compiled once, see instance_shader)
+_shader = None
+
+def supports_instancing(gsg):
+    ''' Returns True if the graphics state guardian GSG (None without a window) can draw instanced models. '''
+    return gsg is not None and gsg.getSupportsGlsl() and gsg.getSupportsGeometryInstancing() and gsg.getSupportsBufferTexture()
+
+def instance_shader():
+    ''' Returns the shader that draws the instances of an InstancedModel. '''
+    global _shader
+    if _shader is None:
+        _shader = Shader.make(Shader.SL_GLSL,INSTANCE_VERTEX_SHADER,INSTANCE_FRAGMENT_SHADER)
+    return _shader
+
+class Instance(object):
+    ''' An instance of an InstancedModel. SLOT is its position in the buffer of the model, which changes when other instances are removed. '''
+    __slots__ = ('slot','transparent')
+
+    def __init__(self,slot):
+        self.slot = slot
+        self.transparent = False
+
+class InstancedModel(object):
+    ''' Draws all instances of MODEL (NodePath without LOD nodes) with one draw call per geom. The model is reparented to a new node NAME below PARENT.
+    The instances are added and removed with add and remove and get their transform and colors with set_instance. The changes are uploaded to the graphics card by flush. The instances are transparent (TransparencyAttrib.MDual) if one of them is. '''
+
+    def __init__(self,name,model,parent,capacity=16):
+        self.name = name
+        self.node = parent.attachNewNode(name)
+        model.reparentTo(self.node)
+        # The instances are spread over the scene, so the bounds of the model must not cull them
+        self.node.node().setBounds(OmniBoundingVolume())
+        self.node.node().setFinal(True)
+        self.node.setShader(instance_shader())
+        self.node.stash()
+
+        self.instances = []
+        self.transparent = 0
+        self.data = array('f')
+        self.capacity = 0
+        self.texture = None
+        self.reserve(capacity)
+        self.changed = False
+
+    def reserve(self,capacity):
+        ''' Enlarges the buffer to CAPACITY instances. '''
+        if capacity <= self.capacity:
+            return
+        self.data.extend([0.0]*(INSTANCE_FLOATS*(capacity - self.capacity)))
+        self.capacity = capacity
+        self.texture = Texture(self.name)
+        self.texture.setupBufferTexture(capacity*INSTANCE_TEXELS,Texture.T_float,Texture.F_rgba32,GeomEnums.UH_dynamic)
+        self.node.setShaderInput('instances',self.texture)
+        self.changed = True
+
+    def add(self):
+        ''' Adds an instance (with a zero transform, i.e. invisible until set_instance is called) and returns it (Instance). '''
+        instance = Instance(len(self.instances))
+        self.instances.append(instance)
+        if len(self.instances) > self.capacity:
+            self.reserve(2*self.capacity)
+        offset = INSTANCE_FLOATS*instance.slot
+        self.data[offset:offset + INSTANCE_FLOATS] = array('f',[0.0]*INSTANCE_FLOATS)
+        self.changed = True
+        return instance
+
+    def remove(self,instance):
+        ''' Removes INSTANCE. The last instance takes its slot. '''
+        last = self.instances.pop()
+        if last is not instance:
+            offset = INSTANCE_FLOATS*instance.slot
+            last_offset = INSTANCE_FLOATS*last.slot
+            self.data[offset:offset + INSTANCE_FLOATS] = self.data[last_offset:last_offset + INSTANCE_FLOATS]
+            self.instances[instance.slot] = last
+            last.slot = instance.slot
+        if instance.transparent:
+            self.transparent -= 1
+        instance.slot = None
+        self.changed = True
+
+    def set_instance(self,instance,mat,ambient,diffuse,scale=(1,1,1,1),transparent=False):
+        ''' Sets the transform MAT (LMatrix4, relative to the parent of the model), the AMBIENT and DIFFUSE color of the material and the color SCALE of INSTANCE. '''
+        offset = INSTANCE_FLOATS*instance.slot
+        self.data[offset:offset + INSTANCE_FLOATS] = array('f',(*mat.getCol(0),*mat.getCol(1),*mat.getCol(2),*ambient,*diffuse,*scale))
+        if transparent != instance.transparent:
+            instance.transparent = transparent
+            self.transparent += 1 if transparent else -1
+        self.changed = True
+
+    def flush(self):
+        ''' Uploads the instances to the graphics card if they have changed since the last call. '''
+        if not(self.changed):
+            return
+        self.changed = False
+        if not(self.instances):
+            # An instance count of 0 would draw the model once
+            self.node.stash()
+            return
+        self.texture.setRamImage(self.data.tobytes())
+        self.node.setInstanceCount(len(self.instances))
+        self.node.setTransparency(TransparencyAttrib.MDual if self.transparent else TransparencyAttrib.MNone)
+        self.node.unstash()
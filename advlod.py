@@ -0,0 +1,155 @@
+# Levels of detail (LOD) of the exo models
+# The parts of the exo models have thousands of triangles each. simplify_model reduces the triangles of a model by
+# vertex clustering: the vertices within a cell of a grid are merged into one vertex and the triangles that collapse are
+# removed. The asset cache stores simplified levels of the exo models (see AssetCache.build_lods) and the prototypes of
+# the exos are LOD nodes that show a level depending on the distance from the camera (see make_lod).
+# The models are simplified offline ("python advassets.py"), never while the program runs.
+
+# ### Imports ### #
+from math import floor, sqrt
+
+from panda3d.core import Geom, GeomTriangles, GeomVertexData, GeomVertexReader, GeomVertexWriter, LODNode, LPoint3, NodePath
+
+# ### Begin ### #
+
+# Number of cells of the grid along the largest extent of a model for each simplified level (level 0 is the model itself)
+LOD_RESOLUTIONS = (64,24)
+# Position of the default camera (see advmain.py) and its distance from the mat, at which the exos are viewed unless the camera is moved (SETCAMERA)
+DEFAULT_CAMERA_POS = (5.0,-13.0,10.0)
+DEFAULT_VIEW_DISTANCE = sqrt(sum(c*c for c in DEFAULT_CAMERA_POS))
+# Distances from the camera beyond which the simplified levels are shown (one distance per simplified level). The exos at the default viewing distance are shown at full detail.
+LOD_DISTANCES = (2.0*DEFAULT_VIEW_DISTANCE,4.0*DEFAULT_VIEW_DISTANCE)
+# Distance beyond which nothing is shown
+LOD_FAR_DISTANCE = 100000.0
+
+def count_triangles(model):
+    ''' Returns the number of triangles of all geometry below MODEL (NodePath). If MODEL contains LOD nodes, all levels are counted. '''
+    triangles = 0
+    for node in model.findAllMatches('**/+GeomNode'):
+        for geom in node.node().getGeoms():
+            for primitive in geom.getPrimitives():
+                triangles += primitive.getNumFaces()
+    return triangles
+
+def _normal_direction(normal):
+    ''' Returns the index (0-5) of the axis direction that is closest to NORMAL. Vertices whose normals point in different directions are not merged, so sharp edges keep their shading. '''
+    axis = max(range(3),key=lambda i: abs(normal[i]))
+    return 2*axis + (normal[axis] < 0)
+
+def simplify_geom(geom,cell_size,mat=None):
+    ''' Returns a copy of GEOM whose vertices within each cell of a grid with the cell size CELL_SIZE (and with similar normals) are merged into their mean. Triangles that collapse to a line or a point and duplicated triangles are removed.
+    MAT is the transformation (LMatrix4) from the coordinates of GEOM into those of the grid (e.g. the exported models have scaled nodes). '''
+    geom = geom.decompose()
+    vdata = geom.getVertexData()
+    data_format = vdata.getFormat()
+    columns = [data_format.getColumn(i) for i in range(data_format.getNumColumns())]
+    names = [column.getName().getName() for column in columns]
+    rows = vdata.getNumRows()
+
+    # Values of all columns by row
+    values = []
+    for column in columns:
+        reader = GeomVertexReader(vdata,column.getName())
+        values.append([tuple(reader.getData4()) for row in range(rows)])
+    positions = values[names.index('vertex')]
+    normals = values[names.index('normal')] if 'normal' in names else None
+
+    # Assign the vertices to the clusters
+    clusters = {}
+    cluster_of_row = []
+    for row in range(rows):
+        x, y, z = positions[row][:3]
+        if mat is not None:
+            x, y, z = mat.xformPoint(LPoint3(x,y,z))
+        key = (floor(x/cell_size),floor(y/cell_size),floor(z/cell_size),_normal_direction(normals[row]) if normals is not None else 0)
+        cluster_of_row.append(clusters.setdefault(key,len(clusters)))
+
+    # Mean of the values of the vertices of each cluster
+    sums = [[[0.0]*4 for cluster in range(len(clusters))] for column in columns]
+    counts = [0]*len(clusters)
+    for row in range(rows):
+        cluster = cluster_of_row[row]
+        counts[cluster] += 1
+        for column_values, column_sums in zip(values,sums):
+            total = column_sums[cluster]
+            value = column_values[row]
+            for i in range(4):
+                total[i] += value[i]
+
+    simplified = GeomVertexData(vdata.getName(),data_format,Geom.UHStatic)
+    simplified.setNumRows(len(clusters))
+    for column, column_sums in zip(columns,sums):
+        writer = GeomVertexWriter(simplified,column.getName())
+        components = column.getNumComponents()
+        for cluster, total in enumerate(column_sums):
+            mean = [value/counts[cluster] for value in total[:components]]
+            if column.getName().getName() == 'normal':
+                length = sqrt(sum(value*value for value in mean)) or 1.0
+                mean = [value/length for value in mean]
+            if components == 1:
+                writer.setData1(mean[0])
+            elif components == 2:
+                writer.setData2(*mean)
+            elif components == 3:
+                writer.setData3(*mean)
+            else:
+                writer.setData4(*mean)
+
+    # Triangles between the clusters
+    triangles = GeomTriangles(Geom.UHStatic)
+    added = set()
+    for primitive in geom.getPrimitives():
+        vertices = primitive.getVertexList()
+        for start in range(0,len(vertices) - 2,3):
+            a, b, c = cluster_of_row[vertices[start]], cluster_of_row[vertices[start+1]], cluster_of_row[vertices[start+2]]
+            if a == b or b == c or a == c:
+                continue
+            # The same triangle with the same winding (a triangle with the opposite winding faces the other side)
+            key = min((a,b,c),(b,c,a),(c,a,b))
+            if key in added:
+                continue
+            added.add(key)
+            triangles.addVertices(a,b,c)
+            triangles.closePrimitive()
+
+    result = Geom(simplified)
+    result.addPrimitive(triangles)
+    return result
+
+def simplify_model(model,resolution):
+    ''' Returns a copy of MODEL (NodePath) whose geometry is simplified with a grid of RESOLUTION cells along the largest extent of the model (see simplify_geom). '''
+    bounds = model.getTightBounds()
+    if bounds is None:
+        return model.copyTo(NodePath())
+    size = max(bounds[1] - bounds[0])
+    cell_size = size/resolution
+
+    simplified = model.copyTo(NodePath())
+    for path in simplified.findAllMatches('**/+GeomNode'):
+        node = path.node()
+        mat = path.getMat(simplified)
+        for i in range(node.getNumGeoms()):
+            node.setGeom(i,simplify_geom(node.getGeom(i),cell_size,mat))
+    return simplified
+
+def select_level(model,level):
+    ''' Replaces each LOD node below MODEL (NodePath) by its level LEVEL (or its last level if it has fewer), so that MODEL only contains the geometry of that level and can be flattened. Returns MODEL. '''
+    for lod in model.findAllMatches('**/+LODNode'):
+        children = lod.getChildren()
+        if not(children.isEmpty()):
+            children[min(level,children.getNumPaths() - 1)].wrtReparentTo(lod.getParent())
+        lod.removeNode()
+    return model
+
+def make_lod(name,levels,distances=LOD_DISTANCES):
+    ''' Returns a NodePath with an LOD node named NAME that shows the models LEVELS (full detail first) depending on the distance from the camera. Level N+1 is shown beyond DISTANCES[N]. The models are reparented to the LOD node. '''
+    if len(distances) < len(levels) - 1:
+        raise ValueError('A switching distance is needed for each simplified level.')
+    lod = NodePath(LODNode(name))
+    near = 0.0
+    for level, model in enumerate(levels):
+        far = distances[level] if level < len(levels) - 1 else LOD_FAR_DISTANCE
+        lod.node().addSwitch(far,near)
+        model.reparentTo(lod)
+        near = far
+    return lod
@@ -0,0 +1,165 @@
+# Logging of the advanced feedback
+# All messages of the program go through the logger "adv" (see get_logger). setup_logging installs a handler that only
+# puts the records into a queue; they are written to the console (and optionally a file) by a background thread, so the
+# render loop never blocks on console output. Messages of the same type are rate-limited (see RateLimitFilter) and
+# frequent events are counted instead of logged one by one (see MessageCounter).
+# This module does not depend on Panda3D.
+
+# ### Imports ### #
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# ### Begin ### #
+
+# Name of the logger of the program. The modules use child loggers (e.g. "adv.network").
+LOGGER_NAME = 'adv'
+
+# Prefixes of the console output (the program used to print "MESSAGE: ..." and "ERROR: ...")
+LEVEL_PREFIXES = {logging.DEBUG: 'DEBUG', logging.INFO: 'MESSAGE', logging.WARNING: 'WARNING', logging.ERROR: 'ERROR', logging.CRITICAL: 'ERROR'}
+
+# Listener of the running background writer (see setup_logging)
+_listener = None
+
+def get_logger(name=None):
+    ''' Returns the logger of the program or of one of its parts (NAME, e.g. "network"). '''
+    if name is None:
+        return logging.getLogger(LOGGER_NAME)
+    return logging.getLogger(LOGGER_NAME + '.' + name)
+
+class PrefixFormatter(logging.Formatter):
+    ''' Formats a record as "PREFIX: MESSAGE" (see LEVEL_PREFIXES). If TIMESTAMPS is True, the time is prepended (used for log files). '''
+
+    def __init__(self,timestamps=False):
+        super().__init__()
+        self.timestamps = timestamps
+
+    def format(self,record):
+        text = LEVEL_PREFIXES.get(record.levelno,record.levelname) + ': ' + record.getMessage()
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        if self.timestamps:
+            text = self.formatTime(record) + ' ' + text
+        return text
+
+class ConsoleHandler(logging.StreamHandler):
+    ''' Writes to the current sys.stdout (not the one at the time the handler was created), so that redirections of the output also apply to the log. '''
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    def emit(self,record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+class RateLimitFilter(logging.Filter):
+    ''' Passes at most RATE records of the same type per INTERVAL seconds. The type of a record is its logger, level, call site and message template (the format string before the arguments are inserted), plus the classes of exceptions passed as arguments, so that e.g. the different errors logged with '%s' are limited separately. The number of suppressed records is appended to the next record of the type that passes.
+    The types whose interval has ended without suppressed records are forgotten once per INTERVAL, so records with varying message templates do not accumulate. '''
+
+    def __init__(self,rate=10,interval=1.0):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        # Type of record -> [start of the interval, records passed in the interval, records suppressed]
+        self.windows = {}
+        self.last_prune = 0.0
+        self.lock = threading.Lock()
+
+    def filter(self,record):
+        key = (record.name,record.levelno,record.pathname,record.lineno,record.msg,self.exception_classes(record))
+        with self.lock:
+            if record.created - self.last_prune >= self.interval:
+                self.prune(record.created)
+            window = self.windows.get(key)
+            if window is None:
+                self.windows[key] = [record.created,1,0]
+                return True
+            if record.created - window[0] >= self.interval:
+                window[0] = record.created
+                window[1] = 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            suppressed = window[2]
+            window[2] = 0
+        if suppressed:
+            record.msg = str(record.msg) + ' (' + str(suppressed) + ' similar message(s) suppressed)'
+        return True
+
+    def prune(self,now):
+        ''' Forgets the types of records whose interval has ended before NOW without suppressed records. '''
+        self.windows = {key: window for key, window in self.windows.items() if window[2] or now - window[0] < self.interval}
+        self.last_prune = now
+
+    def exception_classes(self,record):
+        ''' Returns the classes of the exceptions among the arguments of RECORD. '''
+        args = record.args if isinstance(record.args,tuple) else ()
+        return tuple(type(arg) for arg in args if isinstance(arg,BaseException))
+
+class MessageCounter(object):
+    ''' Counts frequent events (e.g. the received commands by name) instead of logging each of them. report logs the counts of the last interval, e.g. "1234 DATA commands in the last 1.0 s.". TEMPLATE is a format string of the logging module that gets the count, the key and the interval.
+    count is meant for the render loop and is not thread-safe. ENABLED is False if the counts would not be logged anyway, the callers then skip counting. '''
+
+    def __init__(self,logger,template='%d %s commands in the last %.1f s.',level=logging.INFO):
+        self.logger = logger
+        self.template = template
+        self.level = level
+        self.counts = {}
+        self.start = time.perf_counter()
+        self.enabled = logger.isEnabledFor(level)
+
+    def count(self,key,number=1):
+        counts = self.counts
+        counts[key] = counts.get(key,0) + number
+
+    def report(self):
+        ''' Logs and resets the counts. '''
+        now = time.perf_counter()
+        interval = now - self.start
+        for key, count in sorted(self.counts.items()):
+            self.logger.log(self.level,self.template,count,key,interval)
+        self.counts.clear()
+        self.start = now
+        self.enabled = self.logger.isEnabledFor(self.level)
+
+def setup_logging(level=logging.INFO,filename=None,rate=10,interval=1.0):
+    ''' Configures the logger of the program: records of LEVEL and above are rate-limited (see RateLimitFilter, RATE 0 disables the limit) and written to the console and, if FILENAME is given, to a log file by a background thread.
+    Replaces a previous configuration. The background thread writes the remaining records when the program exits. '''
+    global _listener
+    shutdown_logging()
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if rate > 0:
+        handler.addFilter(RateLimitFilter(rate,interval))
+
+    outputs = [ConsoleHandler()]
+    outputs[0].setFormatter(PrefixFormatter())
+    if filename is not None:
+        outputs.append(logging.FileHandler(filename))
+        outputs[1].setFormatter(PrefixFormatter(timestamps=True))
+
+    logger = get_logger()
+    logger.setLevel(level)
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records,*outputs)
+    _listener.start()
+    return logger
+
+def shutdown_logging():
+    ''' Stops the background writer after it has written the queued records. '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for output in _listener.handlers:
+            output.close()
+        _listener = None
+
+atexit.register(shutdown_logging)
@@ -3,6 +3,8 @@
 import advclasses as advclass
 import sys
 
+from advlod import DEFAULT_CAMERA_POS
+
 from math import pi, sin, cos, sqrt
 
 from direct.showbase.ShowBase import ShowBase
@@ -11,6 +13,12 @@ from direct.interval.IntervalGlobal import Sequence
 from direct.actor.Actor import Actor
 from panda3d.core import *
 
+def option_value(name,default=None):
+	''' Returns the value that follows the command-line option NAME (e.g. "--udp-port 9901") or DEFAULT if the option is not given. '''
+	if name in sys.argv[:-1]:
+		return sys.argv[sys.argv.index(name)+1]
+	return default
+
 class MyApp(ShowBase):
 
 	def __init__(self):
@@ -20,7 +28,20 @@ class MyApp(ShowBase):
 		base.disableMouse()
 		
 		# Initialise program logic
-		pl = advclass.ProgramLogic(self.render)
+		# TCP port of the command interface: advmain.py --port PORT
+		# Network thread that reads and parses the commands (see advnetwork.py): advmain.py --network-thread
+		# Recording of all received data to a session log (see advrecorder.py): advmain.py --record SESSIONLOG
+		# UDP channel for DATA samples: advmain.py --udp [--udp-port PORT]
+		# Shared-memory ring buffer for DATA samples (see advsharedmemory.py): advmain.py --shared-memory [--shm-path PATH] [--shm-slots SLOTS]
+		pl = advclass.ProgramLogic(self.render,
+			port_address = int(option_value('--port',9900)),
+			network_thread = '--network-thread' in sys.argv,
+			record_file = option_value('--record'),
+			udp_enabled = '--udp' in sys.argv,
+			udp_port_address = int(option_value('--udp-port',9900)),
+			shm_enabled = '--shared-memory' in sys.argv,
+			shm_path = option_value('--shm-path',advclass.DEFAULT_POSE_BUFFER_PATH),
+			shm_slots = int(option_value('--shm-slots',1024)))
 		
 		# Initialise scene
 		self.build_scene()
@@ -36,8 +57,23 @@ class MyApp(ShowBase):
 		self.accept('f12',self.removeExoTask,[pl])
 		self.accept('escape', self.exit_feedback, [pl])
 		
-		taskMgr.add(pl.tskListenerPolling, "tcp_establish")
-		taskMgr.add(pl.tskReaderPolling, "tcp_poll")
+		if pl.networkThread is not None:
+			# Connections are read by the network thread, only the parsed commands are executed here
+			taskMgr.add(pl.tskActionPolling, "tcp_actions")
+		else:
+			taskMgr.add(pl.tskListenerPolling, "tcp_establish")
+			taskMgr.add(pl.tskReaderPolling, "tcp_poll")
+		taskMgr.add(pl.tskUdpPolling, "udp_poll")
+		taskMgr.add(pl.tskSharedMemoryPolling, "shm_poll")
+		taskMgr.add(pl.tskSendReplies, "tcp_replies", sort = advclass.REPLY_TASK_SORT)
+		if pl.reader_stats_interval > 0:
+			taskMgr.doMethodLater(pl.reader_stats_interval, pl.tskReaderStatistics, "tcp_stats")
+		if pl.command_log_interval > 0:
+			taskMgr.doMethodLater(pl.command_log_interval, pl.tskCommandLog, "command_log")
+		
+		# Replay of a recorded session (see advrecorder.py): advmain.py --replay SESSIONLOG [--fast]
+		if '--replay' in sys.argv:
+			pl.start_replay(sys.argv[sys.argv.index('--replay')+1], realtime = not('--fast' in sys.argv))
 		
 	def addExoTask(self,pl,handedness):
 		### Temporary function for testing ###
@@ -68,7 +104,7 @@ class MyApp(ShowBase):
 		plnp.setPos(0, 0, 10)
 	
 		# Define the camera
-		self.camera.setPos(5,-13,10)
+		self.camera.setPos(*DEFAULT_CAMERA_POS)
 		self.camera.setHpr(0,-30,0)
 		
 		# Reparent objects
@@ -78,7 +114,7 @@ class MyApp(ShowBase):
 		
 	def exit_feedback(self,pl):
 		taskMgr.add(pl.tskTerminateConnections, "tcp_disconnect")
-		print('Good bye!')
+		advclass.log.info('Good bye!')
 		sys.exit()
 		
 app = MyApp()
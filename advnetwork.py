@@ -0,0 +1,293 @@
+# Network thread of the command interface of the advanced feedback
+# This module does not depend on Panda3D. The render loop only gets the parsed commands (see NetworkThread).
+
+# ### Imports ### #
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from advprotocol import CommandStreamBuffer, split_request, BINARY_DATA_FRAMES, BINARY_SEQDATA_MARKER, COMMAND_SEPARATOR
+from advlog import get_logger
+from advrecorder import RECORD_TCP
+
+# ### Begin ### #
+
+log = get_logger('network')
+
+# Size of the binary DATA frames by sequence number (None or not) and number of degrees of freedom
+_BINARY_FRAME_SIZES = {(marker == BINARY_SEQDATA_MARKER,dofs): frame.size for (marker,dofs), frame in BINARY_DATA_FRAMES.items()}
+
+def command_size(command):
+    ''' Returns the number of bytes of a command returned by CommandStreamBuffer.feed (text command or binary DATA frame) as it was received. '''
+    if isinstance(command,tuple):
+        return _BINARY_FRAME_SIZES[(command[2] is not None,len(command[1]))]
+    return len(command) + len(COMMAND_SEPARATOR)
+
+class ConnectionStatistics(object):
+    ''' Number of bytes and commands received from a client connection. NAME identifies the connection in the log (e.g. its address). '''
+
+    def __init__(self,name):
+        self.name = name
+        self.bytes = 0
+        self.commands = 0
+        # Number of times the connection has been paused because it exceeded its budget (network thread only)
+        self.paused = 0
+        self.last = (time.perf_counter(),0,0)
+
+    def rates(self):
+        ''' Returns the bytes and commands received per second since the last call. '''
+        now = time.perf_counter()
+        last_time, last_bytes, last_commands = self.last
+        self.last = (now,self.bytes,self.commands)
+        interval = now - last_time
+        if interval <= 0:
+            return 0.0, 0.0
+        return (self.bytes - last_bytes)/interval, (self.commands - last_commands)/interval
+
+class NetworkConnection(object):
+    ''' A client connection of the network thread. It is passed to the command handlers instead of the Panda3D connection. Replies are queued and sent by the network thread.
+    The parsed commands of the connection wait in ACTIONS until the render loop executes them (see NetworkThread.drain). '''
+
+    def __init__(self,sock,address):
+        self.sock = sock
+        self.address = address
+        # Receive buffer (the commands arrive as a stream)
+        self.buffer = CommandStreamBuffer()
+        # Replies that have not been sent yet. Filled by the render thread, emptied by the network thread.
+        self.replies = collections.deque()
+        self.unsent = b''
+        self.closed = False
+        # Parsed commands waiting for the render loop
+        self.actions = collections.deque()
+        # Bytes of the queued and of the executed commands. Each counter is only changed by one thread (queued: network thread, executed: render thread), their difference are the bytes in flight.
+        self.bytes_queued = 0
+        self.bytes_executed = 0
+        # True while the connection is not read because it exceeded its budget
+        self.paused = False
+        self.stats = ConnectionStatistics(address[0] + ':' + str(address[1]))
+
+    def bytes_in_flight(self):
+        ''' Returns the number of bytes of the commands that have been received but not executed yet. '''
+        return self.bytes_queued - self.bytes_executed
+
+    def send(self,data):
+        ''' Queues DATA (bytes) to be sent to the client. Can be called from any thread. '''
+        if not(self.closed):
+            self.replies.append(data)
+
+class NetworkThread(threading.Thread):
+    ''' Thread that accepts the connections of the command interface, reads the commands and parses them.
+    PARSE is called with each text command and returns the declaration of the command and the parsed values (see advprotocol.CommandRegistry.parse).
+    The parsed commands are appended to the deque ACTIONS of their connection as tuples (time received, connection, command, declaration, values, request number, size in bytes). Binary DATA frames have the command None and the values (exo id, degrees of freedom, sequence number). Commands that cannot be parsed have the declaration None and the error message as values, so that the error is reported (and acknowledged) in the order of the commands.
+    The render loop takes the actions of all connections round-robin (see drain), so a client that sends many commands (e.g. DATA samples) cannot delay the commands of the other clients. Deques are used because appending and popping are atomic, i.e. no lock is needed.
+    CONNECTIONS is a tuple that only the network thread replaces (it is never changed in place), so the render thread can iterate the tuple it has read without a lock.
+    A connection is not read any more while the commands it sent that have not been executed yet exceed MAX_CONNECTION_BYTES (plus at most one read of RECEIVE_SIZE bytes). It is read again once they have fallen to half of the budget. The client is thus slowed down by TCP instead of commands being dropped.
+    If a RECORDER is given (see advrecorder.SessionRecorder), all received data is recorded. '''
+
+    # Maximum number of bytes read from a connection at once
+    RECEIVE_SIZE = 65536
+
+    def __init__(self,port_address,backlog,parse,max_connection_bytes=262144,poll_interval=0.002,recorder=None):
+        super().__init__(name='NetworkThread')
+        self.daemon = True
+
+        self.parse = parse
+        self.recorder = recorder
+        self.max_connection_bytes = max_connection_bytes
+        # Maximum time in seconds the thread waits for data. Queued replies are sent at the latest after this time.
+        self.poll_interval = poll_interval
+
+        # The connections, including closed connections whose commands have not all been executed yet (a tuple, see above)
+        self.connections = ()
+        self.running = False
+        # Statistics of the thread. The 'interval' values are reset by the statistics task of the program logic. 'queue' is the number of queued commands of all connections.
+        self.stats = {'connections': 0, 'datagrams': 0, 'bytes': 0, 'commands': 0, 'errors': 0,
+                      'queue_peak': 0, 'queue_peak_interval': 0, 'paused': 0}
+
+        # The socket is opened here so that errors (e.g. the port is in use) are raised in the render thread
+        self.server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.server.bind(('',port_address))
+        self.server.listen(backlog)
+        self.server.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server,selectors.EVENT_READ)
+
+    def start(self):
+        ''' Starts the thread. '''
+        self.running = True
+        super().start()
+
+    def stop(self):
+        ''' Stops the thread and closes all connections. '''
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        for connection in self.connections:
+            self.close_connection(connection)
+        self.selector.close()
+        self.server.close()
+
+    def run(self):
+        stats = self.stats
+
+        while self.running:
+            self.send_replies()
+            self.update_connections()
+
+            for key, events in self.selector.select(self.poll_interval):
+                if key.data is None:
+                    self.accept_connection()
+                else:
+                    self.read_connection(key.data)
+
+            queue_length = sum(len(connection.actions) for connection in self.connections)
+            if queue_length > stats['queue_peak_interval']:
+                stats['queue_peak_interval'] = queue_length
+                stats['queue_peak'] = max(stats['queue_peak'],queue_length)
+
+    def accept_connection(self):
+        ''' Accepts a new client connection. '''
+        try:
+            sock, address = self.server.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        connection = NetworkConnection(sock,address)
+        self.connections += (connection,)
+        self.selector.register(sock,selectors.EVENT_READ,connection)
+        self.stats['connections'] += 1
+        log.info('Client connected (%s).',connection.stats.name)
+
+    def read_connection(self,connection):
+        ''' Reads the available data of a connection and parses the complete commands. '''
+        try:
+            data = connection.sock.recv(self.RECEIVE_SIZE)
+        except (BlockingIOError,InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not(data):
+            self.close_connection(connection)
+            log.info('Client disconnected (%s).',connection.stats.name)
+            return
+
+        received = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record(RECORD_TCP,connection,data)
+        self.stats['datagrams'] += 1
+        self.stats['bytes'] += len(data)
+
+        buffer = connection.buffer
+        commands = buffer.feed(data)
+
+        if buffer.overflows:
+            log.error('No command separator received within %d bytes. Data discarded.',buffer.max_size)
+            buffer.overflows = 0
+
+        if buffer.invalid_frames:
+            log.error('%d binary DATA frame(s) with invalid number of degrees of freedom received.',buffer.invalid_frames)
+            buffer.invalid_frames = 0
+
+        append = connection.actions.append
+        parse = self.parse
+        queued = 0
+        for command in commands:
+            if command == '':
+                continue
+            size = command_size(command)
+            queued += size
+            # Binary DATA frame (exo id, degrees of freedom, sequence number)
+            if isinstance(command,tuple):
+                append((received,connection,None,None,command,None,size))
+                continue
+            request = None
+            try:
+                request, text = split_request(command)
+                spec, values = parse(text)
+            except TypeError as t:
+                self.add_error(received,connection,command,str(t),request,size)
+            except ValueError as v:
+                self.add_error(received,connection,command,str(v),request,size)
+            except KeyError as k:
+                self.add_error(received,connection,command,str(k),request,size)
+            except IndexError:
+                self.add_error(received,connection,command,'Not enough command parameters supplied.',request,size)
+            else:
+                append((received,connection,command,spec,values,request,size))
+        self.stats['commands'] += len(commands)
+        connection.stats.bytes += len(data)
+        connection.stats.commands += len(commands)
+
+        connection.bytes_queued += queued
+        if connection.bytes_in_flight() > self.max_connection_bytes:
+            self.pause_connection(connection)
+
+    def add_error(self,received,connection,command,message,request,size):
+        ''' Hands a command that could not be parsed to the render loop, which reports the error. '''
+        self.stats['errors'] += 1
+        connection.actions.append((received,connection,command,None,message,request,size))
+
+    def pause_connection(self,connection):
+        ''' Stops reading a connection that exceeds its budget. '''
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError,ValueError):
+            return
+        connection.paused = True
+        connection.stats.paused += 1
+        self.stats['paused'] += 1
+
+    def update_connections(self):
+        ''' Resumes reading the paused connections whose commands have been executed (down to half of the budget) and removes the closed connections whose commands have all been executed. '''
+        connections = self.connections
+        if any(connection.closed and not(connection.actions) for connection in connections):
+            self.connections = tuple(connection for connection in connections if not(connection.closed and not(connection.actions)))
+        for connection in self.connections:
+            if connection.paused and not(connection.closed) and connection.bytes_in_flight() <= self.max_connection_bytes // 2:
+                connection.paused = False
+                self.selector.register(connection.sock,selectors.EVENT_READ,connection)
+
+    def drain(self):
+        ''' Yields the queued actions of all connections round-robin, one action of each connection per round. Called by the render loop, which stops iterating when its time budget is used up. '''
+        while True:
+            connections = [connection for connection in self.connections if connection.actions]
+            if not(connections):
+                return
+            for connection in connections:
+                if connection.actions:
+                    action = connection.actions.popleft()
+                    connection.bytes_executed += action[6]
+                    yield action
+
+    def send_replies(self):
+        ''' Sends the queued replies of all connections. Replies that do not fit into the send buffer of the socket are sent in the next iteration. '''
+        for connection in self.connections:
+            if connection.closed or not(connection.replies or connection.unsent):
+                continue
+            while connection.replies:
+                connection.unsent += connection.replies.popleft()
+            try:
+                sent = connection.sock.send(connection.unsent)
+            except (BlockingIOError,InterruptedError):
+                continue
+            except OSError:
+                connection.unsent = b''
+                continue
+            connection.unsent = connection.unsent[sent:]
+
+    def close_connection(self,connection):
+        ''' Closes a client connection. Replies that have not been sent yet are discarded. The commands that have been received are still executed, the connection is removed afterwards (see update_connections). '''
+        if connection.closed:
+            return
+        connection.closed = True
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError,ValueError):
+            pass
+        connection.sock.close()
@@ -0,0 +1,332 @@
+# Protocol definitions for the command interface of the advanced feedback
+# This module does not depend on Panda3D so that it can be used by clients as well.
+
+# ### Imports ### #
+import struct
+
+# ### Begin ### #
+
+# Separator that terminates every command of the text protocol
+COMMAND_SEPARATOR = b'::'
+# Encoding of the commands of the text protocol
+COMMAND_ENCODING = 'utf-8'
+
+# ### Binary DATA frames ### #
+# A binary DATA frame is an alternative to the text DATA command. It has a fixed size and is not followed by the separator.
+# Layout (little endian): marker (1 byte), number of degrees of freedom (1 byte), exo id (5 ASCII characters), [sequence number (uint32)], degrees of freedom (float32 each)
+# The sequence number is only present in frames with the marker BINARY_SEQDATA_MARKER.
+# The values have the same units as the parameters of the text DATA command.
+
+# First byte of a binary DATA frame. These bytes cannot occur at the beginning of a text command (they are not valid first bytes in UTF-8).
+BINARY_DATA_MARKER = 0xA5
+BINARY_SEQDATA_MARKER = 0xA6
+# Length of the exo ids
+EXO_ID_LENGTH = 5
+# Frame layouts by marker and number of degrees of freedom (7 for exos, 3 for bases). The marker and the number of degrees of freedom are skipped when unpacking.
+BINARY_DATA_FRAMES = {
+    (BINARY_DATA_MARKER,7): struct.Struct('<2x5s7f'),
+    (BINARY_DATA_MARKER,3): struct.Struct('<2x5s3f'),
+    (BINARY_SEQDATA_MARKER,7): struct.Struct('<2x5sI7f'),
+    (BINARY_SEQDATA_MARKER,3): struct.Struct('<2x5sI3f')}
+
+# Range of the sequence numbers
+SEQUENCE_MODULO = 2**32
+# Samples that arrive at most this many sequence numbers late are out of order (reordered datagrams). A larger backward jump means that the client has started a new stream (e.g. after a restart).
+SEQUENCE_REORDER_WINDOW = 64
+
+def pack_binary_data(exo_id,dofs,sequence=None):
+    ''' Returns a binary DATA frame for the exo with the id EXO_ID with the degrees of freedom DOFS (7 for exos, 3 for bases). If SEQUENCE is given the frame carries this sequence number. '''
+    if sequence is None:
+        marker = BINARY_DATA_MARKER
+        values = dofs
+    else:
+        marker = BINARY_SEQDATA_MARKER
+        values = [sequence % SEQUENCE_MODULO] + list(dofs)
+    frame = BINARY_DATA_FRAMES[(marker,len(dofs))]
+    data = bytearray(frame.size)
+    frame.pack_into(data,0,exo_id.encode('ascii'),*values)
+    data[0] = marker
+    data[1] = len(dofs)
+    return bytes(data)
+    
+def is_newer_sequence(sequence,last_sequence):
+    ''' Returns True if SEQUENCE was sent after LAST_SEQUENCE. The sequence numbers wrap around at SEQUENCE_MODULO. '''
+    difference = (sequence - last_sequence) % SEQUENCE_MODULO
+    return 0 < difference < SEQUENCE_MODULO // 2
+
+def is_restarted_sequence(sequence,last_sequence,window=SEQUENCE_REORDER_WINDOW):
+    ''' Returns True if SEQUENCE is more than WINDOW sequence numbers older than LAST_SEQUENCE, i.e. if the client has numbered its samples from the start again rather than a sample arrived late. '''
+    return window < (last_sequence - sequence) % SEQUENCE_MODULO <= SEQUENCE_MODULO // 2
+
+# ### Stream reassembly ### #
+
+class CommandStreamBuffer(object):
+    ''' Receive buffer of a single connection. TCP does not preserve the boundaries of the messages sent by the client, so a command can be split between two chunks. The buffer keeps the incomplete command at the end of a chunk until the rest arrives.
+    Binary DATA frames can be mixed with the text commands. The buffer can also be used for UDP datagrams, which are self-contained (see reset). '''
+    
+    def __init__(self,max_size=1048576):
+        self.buffer = bytearray()
+        # Position from which the search for the next separator continues. Everything before it has already been scanned.
+        self.scan_pos = 0
+        # Maximum number of bytes of an incomplete command before the buffer is discarded
+        self.max_size = max_size
+        # Number of times the buffer has been discarded because no separator was found
+        self.overflows = 0
+        # Number of binary frames with an unknown number of degrees of freedom
+        self.invalid_frames = 0
+        
+    def feed(self,chunk):
+        ''' Appends a chunk to the buffer and returns the list of complete commands in the order they were received. Text commands are returned as strings, binary DATA frames as tuples (exo id, degrees of freedom, sequence number or None). Each byte is scanned only once. '''
+        if isinstance(chunk,str):
+            chunk = chunk.encode(COMMAND_ENCODING)
+        
+        buf = self.buffer
+        buf += chunk
+        end = len(buf)
+        
+        commands = []
+        start = 0
+        scan_pos = self.scan_pos
+        while start < end:
+            # Binary DATA frame
+            if buf[start] == BINARY_DATA_MARKER or buf[start] == BINARY_SEQDATA_MARKER:
+                if end - start < 2:
+                    break
+                frame = BINARY_DATA_FRAMES.get((buf[start],buf[start+1]))
+                if frame is None:
+                    # The frame cannot be skipped without knowing its size. Continue after the next separator.
+                    self.invalid_frames += 1
+                    buf[start] = 0
+                    scan_pos = start
+                    continue
+                if end - start < frame.size:
+                    break
+                values = frame.unpack_from(buf,start)
+                if buf[start] == BINARY_SEQDATA_MARKER:
+                    commands.append((values[0].decode('ascii','replace'),values[2:],values[1]))
+                else:
+                    commands.append((values[0].decode('ascii','replace'),values[1:],None))
+                start += frame.size
+                continue
+            
+            # Text command
+            pos = buf.find(COMMAND_SEPARATOR,max(start,scan_pos))
+            if pos == -1:
+                # The last byte might be the first half of a separator
+                scan_pos = max(start,end - len(COMMAND_SEPARATOR) + 1)
+                break
+            if pos > start:
+                commands.append(buf[start:pos].decode(COMMAND_ENCODING,'replace'))
+            start = pos + len(COMMAND_SEPARATOR)
+        
+        # Remove the complete commands from the buffer
+        if start:
+            del buf[:start]
+        self.scan_pos = max(0,scan_pos - start)
+            
+        if len(buf) > self.max_size:
+            del buf[:]
+            self.scan_pos = 0
+            self.overflows += 1
+        
+        return commands
+        
+    def reset(self):
+        ''' Discards the incomplete command held in the buffer. '''
+        del self.buffer[:]
+        self.scan_pos = 0
+        
+    def pending(self):
+        ''' Returns the number of bytes of the incomplete command that is held in the buffer. '''
+        return len(self.buffer)
+
+# ### Command parsing ### #
+# Parsers convert a single argument (string) of a text command. They raise a TypeError or ValueError if the argument is invalid.
+
+def parse_string(text):
+    ''' Parser for arguments that are used as they are (e.g. exo ids). '''
+    return text
+    
+def parse_int(text):
+    ''' Parser for integer arguments. '''
+    return int(text)
+
+def parse_float(text):
+    ''' Parser for float arguments. '''
+    return float(text)
+
+def parse_choice(choices,message):
+    ''' Returns a parser for arguments that must be one of CHOICES. MESSAGE is the text of the error and may contain {0} for the argument. '''
+    choices = frozenset(choices)
+    def parser(text):
+        if text not in choices:
+            raise ValueError(message.format(text))
+        return text
+    return parser
+    
+def parse_floats(count,message,scale_xy=False):
+    ''' Returns a parser for arguments that consist of COUNT comma separated numbers. MESSAGE is the text of the error if the number of values is wrong.
+    If SCALE_XY is True the first two values (x and y) are divided by 10. '''
+    def parser(text):
+        values = text.split(",")
+        if len(values) != count:
+            raise TypeError(message)
+        values = list(map(float,values))
+        if scale_xy:
+            values[0] /= 10
+            values[1] /= 10
+        return values
+    return parser
+    
+def parse_color(message):
+    ''' Returns a parser for RGB colors (three comma separated values from 0 to 1). MESSAGE is the text of the error if the number of values is wrong. '''
+    def parser(text):
+        values = text.split(",")
+        if len(values) != 3:
+            raise TypeError(message)
+        values = list(map(float,values))
+        for number in values:
+            if number < 0 or number > 1:
+                raise ValueError('RGB values are only allowed between 0 and 1')
+        return values
+    return parser
+    
+def parse_token(text):
+    ''' Parser for the correlation token of a request (e.g. "@17"). The token is sent back with the reply, so that the client can match the reply to the request. '''
+    if len(text) < 2 or text[0] != '@':
+        raise ValueError('Invalid token '+text+'. Tokens have to start with "@".')
+    return text
+    
+class CommandSpec(object):
+    ''' Declaration of a command: the handler that executes it and the parsers of its arguments.
+    The handler is called with the connection the command was received from followed by the parsed arguments. Missing optional arguments are not passed, so the handler has to declare default values for them. Arguments exceeding the declaration are ignored.
+    If REST is given, it is called with the list of all remaining arguments (after the required and the optional ones) and its result is passed as the last value. '''
+    
+    def __init__(self,name,handler,arguments=(),optional_arguments=(),rest=None):
+        self.name = name
+        self.handler = handler
+        self.arguments = tuple(arguments)
+        self.optional_arguments = tuple(optional_arguments)
+        self.rest = rest
+        # Index of the first argument in the split command (2 for subcommands, set by CommandRegistry.register)
+        self.offset = 1
+        
+    def parse(self,comm_parts):
+        ''' Parses the arguments of the split command COMM_PARTS. Returns the list of values for the handler. '''
+        index = self.offset
+        if len(comm_parts) < index + len(self.arguments):
+            raise TypeError('Not enough command parameters supplied.')
+        values = []
+        for parser in self.arguments:
+            values.append(parser(comm_parts[index]))
+            index += 1
+        for parser in self.optional_arguments:
+            if index >= len(comm_parts):
+                break
+            values.append(parser(comm_parts[index]))
+            index += 1
+        if self.rest is not None:
+            values.append(self.rest(comm_parts[index:]))
+        return values
+        
+    def invoke(self,connection,comm_parts):
+        ''' Parses the arguments of the split command COMM_PARTS and calls the handler. '''
+        return self.handler(connection,*self.parse(comm_parts))
+        
+class SubcommandTable(object):
+    ''' Declarations of a command whose first argument selects the declaration (e.g. the exotype of ADDEXO). '''
+    
+    def __init__(self,name):
+        self.name = name
+        self.specs = {}
+        
+    def lookup(self,comm_parts):
+        ''' Returns the declaration that is selected by the first argument of the command. '''
+        if len(comm_parts) < 2:
+            raise TypeError('Not enough command parameters supplied.')
+        spec = self.specs.get(comm_parts[1])
+        if spec is None:
+            raise ValueError('"'+comm_parts[1]+'"'+' is an exo unknown type.')
+        return spec
+        
+    def invoke(self,connection,comm_parts):
+        ''' Parses the arguments and calls the handler of the selected declaration. '''
+        if len(comm_parts) < 2:
+            raise TypeError('Not enough command parameters supplied.')
+        spec = self.specs.get(comm_parts[1])
+        if spec is None:
+            raise ValueError('"'+comm_parts[1]+'"'+' is an exo unknown type.')
+        return spec.invoke(connection,comm_parts)
+        
+class CommandRegistry(object):
+    ''' Table that maps the names of the commands to their declarations. A command can have subcommands (e.g. the exotype of ADDEXO), which are selected by its first argument. '''
+    
+    def __init__(self):
+        self.specs = {}
+        
+    def register(self,spec,subcommand=None):
+        ''' Adds a command declaration. An existing declaration with the same name is replaced. '''
+        if subcommand is None:
+            spec.offset = 1
+            self.specs[spec.name] = spec
+        else:
+            spec.offset = 2
+            table = self.specs.get(spec.name)
+            if not(isinstance(table,SubcommandTable)):
+                table = SubcommandTable(spec.name)
+                self.specs[spec.name] = table
+            table.specs[subcommand] = spec
+            
+    def lookup(self,command):
+        ''' Splits a text command and looks up its declaration. Returns the declaration and the parts of the command. '''
+        comm_parts = command.split(" ")
+        spec = self.specs.get(comm_parts[0])
+        if spec is None:
+            raise TypeError('Invalid command '+command+'.')
+        if isinstance(spec,SubcommandTable):
+            spec = spec.lookup(comm_parts)
+        return spec, comm_parts
+            
+    def parse(self,command):
+        ''' Looks up the declaration of a text command and parses its arguments. Returns the declaration and the values for the handler. '''
+        spec, comm_parts = self.lookup(command)
+        return spec, spec.parse(comm_parts)
+        
+    def dispatch(self,command,connection):
+        ''' Looks up the declaration of a text command, parses its arguments and calls its handler. '''
+        comm_parts = command.split(" ")
+        spec = self.specs.get(comm_parts[0])
+        if spec is None:
+            raise TypeError('Invalid command '+command+'.')
+        return spec.invoke(connection,comm_parts)
+            
+# ### Requests and replies ### #
+# A command can be prefixed with a request number ("#17 DELETE ABCDE"). The program then acknowledges the command with ":OK 17::" or ":ERR 17 MESSAGE::".
+
+def split_request(command):
+    ''' Splits the optional request number off a command. Returns the request number (or None) and the command without the prefix. '''
+    if command[:1] != '#':
+        return None, command
+    prefix, separator, command = command.partition(' ')
+    try:
+        return int(prefix[1:]), command
+    except ValueError:
+        raise ValueError('Invalid request number '+prefix+'.')
+        
+def format_reply(message):
+    ''' Returns a reply of the program as bytes (":MESSAGE::"). '''
+    return (':'+message).encode(COMMAND_ENCODING) + COMMAND_SEPARATOR
+        
+def split_replies(data):
+    ''' Splits received data (bytes) into replies. Returns the list of the replies (str, without the leading ":") and the rest of the data, i.e. the beginning of an incomplete reply. '''
+    parts = data.split(COMMAND_SEPARATOR)
+    rest = parts.pop()
+    return [part[1:].decode(COMMAND_ENCODING) for part in parts if part], rest
+    
+def parse_reply(reply):
+    ''' Parses a reply (see split_replies). Returns the request number, True or False for "OK" or "ERR" and the rest of the reply (e.g. the id of an exo or the error message). Replies without request number (e.g. the id of an exo added by a command without request number) are returned as (None, True, REPLY). '''
+    status, separator, rest = reply.partition(' ')
+    if status == 'OK' or status == 'ERR':
+        request, separator, message = rest.partition(' ')
+        return int(request), status == 'OK', message
+    return None, True, reply
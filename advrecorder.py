@@ -0,0 +1,179 @@
+# Session recorder for the command interface of the advanced feedback
+# Records everything that is received through the network, so that a session can be replayed (see SessionReplay).
+# This module does not depend on Panda3D.
+
+# ### Imports ### #
+import collections
+import struct
+import threading
+import time
+
+# ### Begin ### #
+
+# First bytes of a session log
+SESSION_LOG_MAGIC = b'ADVSESSION1\n'
+# Header of a record (little endian): time in seconds since the start of the recording (float64), frame number (uint32), connection id (uint32), kind (uint8), length of the data (uint32)
+RECORD_HEADER = struct.Struct('<dIIBI')
+
+# Kinds of records
+RECORD_TCP = 0
+RECORD_UDP = 1
+# Id of an exo that has been added (the data is the id). Used to assign the same ids when the session is replayed.
+RECORD_EXO_ID = 2
+
+# ### Recording ### #
+
+class SessionRecorder(object):
+    ''' Appends the data received through the network to a session log.
+    record only appends the data to a deque, the log is written by a background thread every FLUSH_INTERVAL seconds. record can be called from any thread (e.g. the network thread).
+    FRAME is the number of the current frame, it is set by the program logic. '''
+
+    def __init__(self,filename,flush_interval=0.5):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.frame = 0
+        self.records = collections.deque()
+        self.connection_ids = {}
+        self.start = time.perf_counter()
+        self.stats = {'records': 0, 'bytes': 0}
+
+        self.file = open(filename,'wb',buffering=1048576)
+        self.file.write(SESSION_LOG_MAGIC)
+
+        self.running = True
+        self.wakeup = threading.Event()
+        self.writer = threading.Thread(target=self.write_records,name='SessionRecorder')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def connection_id(self,connection):
+        ''' Returns the number of a connection (starting with 1). '''
+        try:
+            return self.connection_ids[connection]
+        except KeyError:
+            return self.connection_ids.setdefault(connection,len(self.connection_ids)+1)
+
+    def record(self,kind,connection,data):
+        ''' Records DATA (bytes) received from CONNECTION. '''
+        self.records.append((time.perf_counter() - self.start,self.frame,self.connection_id(connection) if connection is not None else 0,kind,data))
+
+    def record_exo_id(self,id):
+        ''' Records the id of an exo that has been added. '''
+        self.records.append((time.perf_counter() - self.start,self.frame,0,RECORD_EXO_ID,id.encode()))
+
+    def write_records(self):
+        ''' Background thread that writes the records to the log. '''
+        records = self.records
+        pack = RECORD_HEADER.pack
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            running = self.running
+            while records:
+                timestamp, frame, connection, kind, data = records.popleft()
+                self.file.write(pack(timestamp,frame,connection,kind,len(data)))
+                self.file.write(data)
+                self.stats['records'] += 1
+                self.stats['bytes'] += len(data)
+            self.file.flush()
+            if not(running):
+                break
+
+    def close(self):
+        ''' Writes the remaining records and closes the log. '''
+        if not(self.running):
+            return
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        self.file.close()
+
+def read_session(filename,data=True):
+    ''' Yields the records of a session log as tuples (time, frame, connection id, kind, data). If DATA is False, the data is skipped (None) except for the exo ids. '''
+    with open(filename,'rb') as f:
+        if f.read(len(SESSION_LOG_MAGIC)) != SESSION_LOG_MAGIC:
+            raise ValueError(filename + ' is not a session log.')
+        header_size = RECORD_HEADER.size
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                return
+            timestamp, frame, connection, kind, length = RECORD_HEADER.unpack(header)
+            if data or kind == RECORD_EXO_ID:
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+            else:
+                f.seek(length,1)
+                payload = None
+            yield timestamp, frame, connection, kind, payload
+
+# ### Replay ### #
+
+class ReplayConnection(object):
+    ''' Connection of a replayed session. Replies are counted and discarded. '''
+
+    def __init__(self,id):
+        self.id = id
+        self.replies = 0
+
+    def send(self,data):
+        self.replies += 1
+
+class SessionReplay(object):
+    ''' Feeds a session log into the program logic PL. The data that was received in the same frame is fed in the same frame, so the commands are executed in the same order and grouping as in the recorded session.
+    If REALTIME is True the frames are fed at the recorded times (for reproducing bugs), otherwise one recorded frame is fed per frame (as fast as possible, for benchmarks).
+    The exos get the ids of the recorded session, so that the recorded commands refer to the right exos. '''
+
+    def __init__(self,pl,filename,realtime=True):
+        self.pl = pl
+        self.filename = filename
+        self.realtime = realtime
+        self.connections = {}
+        self.stats = {'frames': 0, 'records': 0, 'bytes': 0}
+
+        # The ids of the exos are read first, as an exo can be added in a later frame than the command was received
+        pl.replay_ids.extend(record[4].decode() for record in read_session(filename,False) if record[3] == RECORD_EXO_ID)
+
+        self.records = read_session(filename)
+        self.next_record = next(self.records,None)
+        self.start = None
+
+    def feed_frame(self):
+        ''' Feeds the records of the next recorded frame. Returns False if the end of the log has been reached. '''
+        record = self.next_record
+        if record is None:
+            return False
+        frame = record[1]
+        while record is not None and record[1] == frame:
+            self.feed_record(record)
+            record = next(self.records,None)
+        self.next_record = record
+        self.stats['frames'] += 1
+        return True
+
+    def feed(self):
+        ''' Feeds the next recorded frame, or in realtime mode all recorded frames that are due. Returns False if the end of the log has been reached. '''
+        if not(self.realtime):
+            return self.feed_frame()
+
+        now = time.perf_counter()
+        if self.start is None and self.next_record is not None:
+            self.start = now - self.next_record[0]
+        while self.next_record is not None and self.start + self.next_record[0] <= now:
+            self.feed_frame()
+        return self.next_record is not None
+
+    def feed_record(self,record):
+        ''' Passes a record to the program logic. '''
+        timestamp, frame, connection_id, kind, data = record
+        if kind == RECORD_TCP:
+            connection = self.connections.get(connection_id)
+            if connection is None:
+                connection = self.connections[connection_id] = ReplayConnection(connection_id)
+            self.pl.receive_data(connection,data)
+        elif kind == RECORD_UDP:
+            self.pl.parse_udp_datagram(data)
+        else:
+            return
+        self.stats['records'] += 1
+        self.stats['bytes'] += len(data)
@@ -0,0 +1,189 @@
+# Shared-memory channel for DATA samples of the advanced feedback
+# A controller that runs on the same machine as the visualisation can write the degrees of freedom of the real-time exos
+# into a ring buffer in shared memory (PoseWriter) instead of sending DATA commands. The visualisation reads the new
+# samples once per frame (PoseRingBuffer, enabled with "python advmain.py --shared-memory"). No socket, no formatting and no parsing is
+# involved. The exos are still added through the command interface, which returns their ids.
+# This module does not depend on Panda3D.
+
+# ### Imports ### #
+import mmap
+import os
+import struct
+import tempfile
+
+from advprotocol import EXO_ID_LENGTH
+
+# ### Begin ### #
+
+# Default file of the ring buffer. On Linux /dev/shm is memory-backed, elsewhere the file is only written back by the
+# operating system.
+if os.path.isdir('/dev/shm'):
+    DEFAULT_POSE_BUFFER_PATH = '/dev/shm/advvis_poses'
+else:
+    DEFAULT_POSE_BUFFER_PATH = os.path.join(tempfile.gettempdir(),'advvis_poses')
+
+# ### Layout ### #
+# Header (little endian): magic (8 bytes), number of slots (uint32), size of a slot (uint32), number of samples written (uint64)
+# The header is followed by the slots. Sample number N is written to the slot N modulo the number of slots.
+# Slot: lock (uint32), exo id (5 ASCII characters), number of degrees of freedom (uint8), 2 bytes padding, 7 degrees of freedom (float32, same units as the parameters of the DATA command; bases only use the first 3)
+# The lock of a slot is a sequence lock: while sample N is written it is 2*LAP+1, afterwards 2*LAP+2, LAP being N divided by the number of slots. The reader
+# checks the lock before and after reading a slot, so it never uses a sample that is being written or has been overwritten in the meantime.
+
+POSE_BUFFER_MAGIC = b'ADVPOSE1'
+POSE_BUFFER_HEADER = struct.Struct('<8sIIQ')
+# Offset of the number of samples written
+POSE_BUFFER_COUNTER = struct.Struct('<Q')
+POSE_BUFFER_COUNTER_OFFSET = 16
+POSE_SLOT = struct.Struct('<I' + str(EXO_ID_LENGTH) + 'sB2x7f')
+POSE_SLOT_LOCK = struct.Struct('<I')
+# The data of a slot (after the lock). It is packed separately, as packing the whole slot would overwrite the lock.
+POSE_SLOT_DATA = struct.Struct('<' + str(EXO_ID_LENGTH) + 'sB2x7f')
+# Range of the lock values
+POSE_SLOT_LOCK_MODULO = 2**32
+
+def pose_buffer_size(slots):
+    ''' Returns the size in bytes of a ring buffer with SLOTS slots. '''
+    return POSE_BUFFER_HEADER.size + slots*POSE_SLOT.size
+
+def _open_mapping(path,size):
+    ''' Opens the file PATH and maps SIZE bytes of it. '''
+    f = open(path,'r+b')
+    try:
+        return mmap.mmap(f.fileno(),size)
+    finally:
+        f.close()
+
+# ### Reading (visualisation) ### #
+
+class PoseRingBuffer(object):
+    ''' Ring buffer with SLOTS slots in the file PATH, read by the visualisation. The file is created if it does not exist or has a different layout.
+    A file with the same layout is reused, so that a producer that is still running can go on writing after the visualisation has been restarted. Samples written before the buffer was opened are skipped. '''
+
+    def __init__(self,path=DEFAULT_POSE_BUFFER_PATH,slots=1024):
+        self.path = path
+        self.slots = slots
+        size = pose_buffer_size(slots)
+
+        if not(self.has_layout(path,slots)):
+            with open(path,'wb') as f:
+                f.write(POSE_BUFFER_HEADER.pack(POSE_BUFFER_MAGIC,slots,POSE_SLOT.size,0))
+                f.truncate(size)
+        self.buffer = _open_mapping(path,size)
+
+        self.position = self.written()
+        self.stats = {'samples': 0, 'lost': 0}
+
+    @staticmethod
+    def has_layout(path,slots):
+        ''' Returns True if PATH is a ring buffer with SLOTS slots. '''
+        try:
+            with open(path,'rb') as f:
+                header = f.read(POSE_BUFFER_HEADER.size)
+                f.seek(0,os.SEEK_END)
+                size = f.tell()
+        except OSError:
+            return False
+        if len(header) < POSE_BUFFER_HEADER.size or size != pose_buffer_size(slots):
+            return False
+        magic, header_slots, slot_size, written = POSE_BUFFER_HEADER.unpack(header)
+        return magic == POSE_BUFFER_MAGIC and header_slots == slots and slot_size == POSE_SLOT.size
+
+    def written(self):
+        ''' Returns the number of samples written so far. '''
+        return POSE_BUFFER_COUNTER.unpack_from(self.buffer,POSE_BUFFER_COUNTER_OFFSET)[0]
+
+    def read(self):
+        ''' Returns the samples written since the last call as a list of tuples (exo id, degrees of freedom). The values are unpacked directly from the shared memory.
+        If the producer has overwritten samples that have not been read yet, they are lost (counted in the statistics). '''
+        written = self.written()
+        position = self.position
+        if written == position:
+            return []
+
+        slots = self.slots
+        stats = self.stats
+        if written - position > slots:
+            stats['lost'] += written - slots - position
+            position = written - slots
+
+        buffer = self.buffer
+        header_size = POSE_BUFFER_HEADER.size
+        slot_size = POSE_SLOT.size
+        unpack_lock = POSE_SLOT_LOCK.unpack_from
+        unpack_data = POSE_SLOT_DATA.unpack_from
+        samples = []
+        for number in range(position,written):
+            offset = header_size + (number % slots)*slot_size
+            lock = (2*(number // slots) + 2) % POSE_SLOT_LOCK_MODULO
+            if unpack_lock(buffer,offset)[0] != lock:
+                stats['lost'] += 1
+                continue
+            id, dofs_count, *dofs = unpack_data(buffer,offset + 4)
+            # The slot has been overwritten while it was read
+            if unpack_lock(buffer,offset)[0] != lock:
+                stats['lost'] += 1
+                continue
+            # A corrupt slot (or one written by another program) yields an id that is not found rather than an exception
+            samples.append((id.decode('ascii',errors='replace'),dofs[:dofs_count]))
+
+        self.position = written
+        stats['samples'] += len(samples)
+        return samples
+
+    def close(self):
+        ''' Unmaps the buffer. The file is kept, so that a producer can go on using it. '''
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+# ### Writing (controller) ### #
+
+class PoseWriter(object):
+    ''' Writes DATA samples into the ring buffer in the file PATH, which is created by the visualisation (see PoseRingBuffer). Only one PoseWriter may write into a buffer. '''
+
+    def __init__(self,path=DEFAULT_POSE_BUFFER_PATH):
+        with open(path,'rb') as f:
+            header = f.read(POSE_BUFFER_HEADER.size)
+        if len(header) < POSE_BUFFER_HEADER.size:
+            raise ValueError(path + ' is not a pose buffer.')
+        magic, slots, slot_size, written = POSE_BUFFER_HEADER.unpack(header)
+        if magic != POSE_BUFFER_MAGIC or slot_size != POSE_SLOT.size:
+            raise ValueError(path + ' is not a pose buffer.')
+
+        self.path = path
+        self.slots = slots
+        self.buffer = _open_mapping(path,pose_buffer_size(slots))
+        self.written = POSE_BUFFER_COUNTER.unpack_from(self.buffer,POSE_BUFFER_COUNTER_OFFSET)[0]
+
+    def write(self,exo_id,dofs):
+        ''' Writes a sample with the degrees of freedom DOFS (7 for exos, 3 for bases) for the exo with the id EXO_ID. Raises a ValueError if EXO_ID is not an id of EXO_ID_LENGTH ASCII characters. '''
+        if len(exo_id) != EXO_ID_LENGTH or not(exo_id.isascii()):
+            raise ValueError('Invalid exo id ' + repr(exo_id) + ', expected ' + str(EXO_ID_LENGTH) + ' ASCII characters.')
+        count = len(dofs)
+        if count != 7 and count != 3:
+            raise ValueError('Wrong number of kinematics parameters supplied.')
+        if count == 3:
+            dofs = list(dofs) + [0.0]*4
+
+        number = self.written
+        buffer = self.buffer
+        offset = POSE_BUFFER_HEADER.size + (number % self.slots)*POSE_SLOT.size
+        lap = number // self.slots
+        # Lock the slot, write the sample, unlock it and publish it
+        POSE_SLOT_LOCK.pack_into(buffer,offset,(2*lap + 1) % POSE_SLOT_LOCK_MODULO)
+        POSE_SLOT_DATA.pack_into(buffer,offset + 4,exo_id.encode('ascii'),count,*dofs)
+        POSE_SLOT_LOCK.pack_into(buffer,offset,(2*lap + 2) % POSE_SLOT_LOCK_MODULO)
+        self.written = number + 1
+        POSE_BUFFER_COUNTER.pack_into(buffer,POSE_BUFFER_COUNTER_OFFSET,self.written)
+
+    def close(self):
+        ''' Unmaps the buffer. '''
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
@@ -0,0 +1,238 @@
+# Trajectory streamer for the advanced feedback
+# Replays recorded kinematics to EXOREALTIME exos at the recorded rate.
+# Usage: python advstreamer.py TRAJECTORY [OPTIONS]
+# Run "python advstreamer.py -h" for the options.
+#
+# A trajectory is either a CSV file or a NumPy file (.npy, needs numpy). Each row contains the time of the sample
+# followed by the degrees of freedom of one or more exos (7 values per exo with hand, 3 values per base, same order
+# and units as the parameters of the DATA command). CSV files may start with a header line, lines starting with "#"
+# are ignored. The files are memory-mapped and read row by row, so long recordings are not loaded into memory.
+
+# ### Imports ### #
+import argparse
+import math
+import mmap
+import os
+import time
+
+from advclient import CommandClient, build_data, build_databatch, build_resetsequence
+from advsharedmemory import PoseWriter, DEFAULT_POSE_BUFFER_PATH
+
+# ### Begin ### #
+
+# Factors that convert the time column to seconds
+TIME_UNITS = {'s': 1.0, 'ms': 1e-3, 'us': 1e-6}
+
+# ### Reading trajectories ### #
+
+def read_csv_trajectory(path):
+    ''' Yields the rows of a CSV trajectory as lists of floats. The file is memory-mapped. '''
+    if os.path.getsize(path) == 0:
+        return
+    with open(path,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        first = True
+        for line in iter(mm.readline,b''):
+            line = line.strip()
+            if not(line) or line[:1] == b'#':
+                continue
+            try:
+                row = [float(value) for value in line.split(b',')]
+            except ValueError:
+                # Header line
+                if first:
+                    first = False
+                    continue
+                raise ValueError('Invalid row in ' + path + ': ' + line.decode(errors='replace'))
+            first = False
+            yield row
+
+def read_npy_trajectory(path):
+    ''' Yields the rows of a NumPy trajectory (2D array) as lists of floats. The file is memory-mapped. '''
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('NumPy is needed to read ' + path + '. Convert the file to CSV or install numpy.')
+    array = numpy.load(path,mmap_mode='r')
+    if array.ndim != 2:
+        raise ValueError('The array in ' + path + ' has to be two-dimensional (samples x values).')
+    for row in array:
+        yield row.tolist()
+
+def read_trajectory(path):
+    ''' Yields the rows of a trajectory file (see read_csv_trajectory and read_npy_trajectory). '''
+    if path.lower().endswith('.npy'):
+        return read_npy_trajectory(path)
+    return read_csv_trajectory(path)
+
+# ### Streaming ### #
+
+class StreamStatistics(object):
+    ''' Achieved rate and timing error (jitter) of a stream. The timing error of a sample is the time at which it is sent minus the time at which it is due. '''
+
+    def __init__(self):
+        self.samples = 0
+        self.skipped = 0
+        self.error_sum = 0.0
+        self.error_square_sum = 0.0
+        self.error_max = 0.0
+        self.late = 0
+        self.start = None
+        self.end = None
+        self.recorded_span = 0.0
+
+    def add(self,error):
+        self.samples += 1
+        self.error_sum += error
+        self.error_square_sum += error*error
+        if error > self.error_max:
+            self.error_max = error
+
+    def report(self,speed=1.0):
+        ''' Returns the statistics as text. '''
+        if self.samples == 0:
+            return 'No samples sent.'
+        duration = self.end - self.start
+        mean = self.error_sum / self.samples
+        deviation = math.sqrt(max(self.error_square_sum / self.samples - mean*mean,0.0))
+        if self.recorded_span > 0:
+            target_rate = (self.samples + self.skipped - 1) / (self.recorded_span / speed)
+        else:
+            target_rate = 0.0
+        achieved_rate = (self.samples - 1) / duration if duration > 0 else 0.0
+        return ('{0} samples in {1:.2f} s ({2} skipped); rate: target {3:.1f} Hz, achieved {4:.1f} Hz; '
+                'timing error: mean {5:.3f} ms, jitter (std) {6:.3f} ms, max. {7:.3f} ms, {8} samples later than 1 ms').format(
+                self.samples,duration,self.skipped,target_rate,achieved_rate,mean*1000,deviation*1000,self.error_max*1000,self.late)
+
+def stream_trajectory(client,exo_ids,rows,dofs=7,speed=1.0,time_unit=1.0,binary=False,skip_late=False,spin=0.0005,report_interval=0,stats=None,writer=None):
+    ''' Sends the ROWS of a trajectory to the exos EXO_IDS at the recorded times. Returns the StreamStatistics.
+    The time at which a row is due is computed from the start of the stream (not from the previous row), so the schedule does not drift. The thread sleeps until SPIN seconds before a row is due and waits actively for the rest, which reduces the jitter.
+    The rows are sent as DATA (one exo) or DATABATCH (several exos) commands or as binary DATA frames, with the row number as sequence number. If SKIP_LATE is True, rows are skipped if the next row is already due.
+    The sequence numbers of the exos are reset (RESETSEQUENCE) before the first row, as the exos may have received samples with higher sequence numbers before (e.g. from an earlier run of the streamer). The reset and the first command of a stream are acknowledged, so a stream that the visualisation rejects (e.g. an unknown exo) raises a RuntimeError instead of failing silently. Binary frames are never acknowledged.
+    If STATS are given (e.g. when a trajectory is replayed repeatedly), the stream is added to them and the sequence numbers continue.
+    If a WRITER is given (see advsharedmemory.PoseWriter), the rows are written to the shared memory of the visualisation instead of being sent. '''
+    if stats is None:
+        stats = StreamStatistics()
+    num_values = 1 + dofs*len(exo_ids)
+    clock = time.perf_counter
+    sleep = time.sleep
+
+    rows = iter(rows)
+    row = next(rows,None)
+    if row is None:
+        return stats
+
+    first_time = row[0]
+    start = clock()
+    if stats.start is None:
+        stats.start = start
+    next_report = start + report_interval
+    sequence = (stats.samples + stats.skipped) % 4294967296
+    if stats.samples + stats.skipped == 0 and writer is None:
+        for request in [client.request(build_resetsequence(exo_id)) for exo_id in exo_ids]:
+            client.wait(request)
+    span_offset = stats.recorded_span
+    while row is not None:
+        if len(row) != num_values:
+            raise ValueError('Row ' + str(sequence) + ' has ' + str(len(row)) + ' values, expected ' + str(num_values) + '.')
+        due = start + (row[0] - first_time)*time_unit/speed
+        next_row = next(rows,None)
+
+        if skip_late and next_row is not None and clock() >= start + (next_row[0] - first_time)*time_unit/speed:
+            stats.skipped += 1
+        else:
+            # Wait until the row is due
+            delay = due - clock()
+            if delay > spin:
+                sleep(delay - spin)
+            while clock() < due:
+                pass
+
+            if writer is not None:
+                for i, exo_id in enumerate(exo_ids):
+                    writer.write(exo_id,row[1+i*dofs:1+(i+1)*dofs])
+            elif binary:
+                for i, exo_id in enumerate(exo_ids):
+                    client.data_binary(exo_id,row[1+i*dofs:1+(i+1)*dofs],sequence)
+            else:
+                if len(exo_ids) == 1:
+                    command = build_data(exo_ids[0],row[1:],sequence)
+                else:
+                    command = build_databatch([(exo_id,row[1+i*dofs:1+(i+1)*dofs]) for i, exo_id in enumerate(exo_ids)],sequence)
+                if stats.samples == 0:
+                    client.wait(client.request(command))
+                else:
+                    client.send(command)
+            if writer is None:
+                client.flush()
+
+            error = clock() - due
+            stats.add(error)
+            if error > 0.001:
+                stats.late += 1
+
+        stats.recorded_span = span_offset + (row[0] - first_time)*time_unit
+        stats.end = clock()
+        if report_interval and stats.end >= next_report:
+            print('MESSAGE: ' + stats.report(speed))
+            next_report += report_interval
+
+        row = next_row
+        sequence = (sequence + 1) % 4294967296
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded kinematics to EXOREALTIME exos of the advanced feedback.')
+    parser.add_argument('trajectory',help='CSV or NumPy (.npy) file: time followed by the degrees of freedom of each exo')
+    parser.add_argument('--host',default='127.0.0.1',help='Host of the visualisation (default: 127.0.0.1)')
+    parser.add_argument('--port',type=int,default=9900,help='TCP port of the visualisation (default: 9900)')
+    parser.add_argument('--exo',action='append',default=[],help='Id of an existing exo that is driven by the trajectory (can be given several times, in the order of the columns)')
+    parser.add_argument('--add',action='append',default=[],choices=['left','right'],help='Add a realtime exo with this handedness (can be given several times, after the exos given with --exo)')
+    parser.add_argument('--base',action='store_true',help='The exos only consist of the base (3 degrees of freedom)')
+    parser.add_argument('--time-unit',choices=sorted(TIME_UNITS),default='s',help='Unit of the time column (default: s)')
+    parser.add_argument('--speed',type=float,default=1.0,help='Playback speed factor (default: 1)')
+    parser.add_argument('--binary',action='store_true',help='Send binary DATA frames instead of text commands')
+    parser.add_argument('--shared-memory',nargs='?',const=DEFAULT_POSE_BUFFER_PATH,metavar='PATH',help='Write the samples to the shared memory of the visualisation (advmain.py --shared-memory, default path: ' + DEFAULT_POSE_BUFFER_PATH + ')')
+    parser.add_argument('--skip-late',action='store_true',help='Skip samples if the next sample is already due')
+    parser.add_argument('--loop',action='store_true',help='Replay the trajectory until interrupted')
+    parser.add_argument('--report-interval',type=float,default=10.0,help='Interval in seconds in which the statistics are printed (0: only at the end, default: 10)')
+    args = parser.parse_args()
+
+    dofs = 3 if args.base else 7
+    client = CommandClient(args.host,args.port)
+    writer = PoseWriter(args.shared_memory) if args.shared_memory else None
+    exo_ids = list(args.exo)
+
+    # Add the exos with the first sample as initial position
+    if args.add:
+        first_row = next(read_trajectory(args.trajectory))
+        for handedness in args.add:
+            start = 1 + dofs*len(exo_ids)
+            params = first_row[start:start+dofs]
+            if args.base:
+                exo_ids.append(client.wait(client.addbase('EXOREALTIME',params)))
+            else:
+                exo_ids.append(client.wait(client.addexo('EXOREALTIME',handedness,params)))
+            print('MESSAGE: Added exo ' + exo_ids[-1] + '.')
+    if not(exo_ids):
+        parser.error('No exos given, use --exo or --add.')
+
+    stats = StreamStatistics()
+    try:
+        while True:
+            stream_trajectory(client,exo_ids,read_trajectory(args.trajectory),dofs,args.speed,TIME_UNITS[args.time_unit],
+                              args.binary,args.skip_late,report_interval=args.report_interval,stats=stats,writer=writer)
+            if not(args.loop):
+                break
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as error:
+        print('ERROR: ' + str(error))
+    finally:
+        client.close()
+        if writer is not None:
+            writer.close()
+    print('MESSAGE: ' + stats.report(args.speed))
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,19 @@
 # TCP connection test
+# Interactive client: each line that is entered is sent as a command (see advclient.py for a client library)
 
 # ### Imports ### #
-import socket
+from advclient import CommandClient
 
 # ### Configuration ### #
 TCP_IP = "127.0.0.1"
 TCP_PORT = 9900
-BUFFER_SIZE = 1024
+# Time in seconds to wait for replies after a command has been sent
+REPLY_TIMEOUT = 0.2
 
 # ### Begin ### #
 
 # Startup TCP interface
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((TCP_IP, TCP_PORT))
+client = CommandClient(TCP_IP, TCP_PORT)
 
 # Send and receive messages
 sendmessage = True
@@ -21,14 +22,17 @@ exit_message = ('q','quit','exit')
 while sendmessage:
 	MESSAGE = input('Send:')
 	if MESSAGE not in exit_message:
-		s.send(MESSAGE.encode())
+		# Several commands can be entered at once, separated by "::"
+		for command in MESSAGE.split("::"):
+			if command != '':
+				client.send(command)
+		client.flush()
+		
+		# Print the replies of the program (e.g. the id of an added exo)
+		for reply in client.receive_replies(REPLY_TIMEOUT):
+			print("Received:", reply)
 	else:
 		sendmessage = False
 
-	# Do not expect feedback message from server if the DATA command was sent
-	#if MESSAGE.split(" ")[0] != 'DATA':
-		#data = s.recv(BUFFER_SIZE)
-		#print("Received:", data.decode().split(":")[1])
-
 # Close connection
-s.close()
\ No newline at end of file
+client.close()
@@ -0,0 +1,250 @@
+# Regression checks of the replies of the command interface ("python -m pytest")
+# The program logic is started without a window on a separate port, the replies are collected instead of being sent.
+
+# ### Imports ### #
+import logging
+import os
+
+import pytest
+
+from panda3d.core import loadPrcFileData, Filename
+
+from advlog import RateLimitFilter
+from advprotocol import CommandStreamBuffer, pack_binary_data, split_request, format_reply, split_replies, parse_reply, is_newer_sequence, is_restarted_sequence, SEQUENCE_MODULO, SEQUENCE_REORDER_WINDOW
+from advrecorder import SessionRecorder, SessionReplay, read_session, RECORD_TCP, RECORD_UDP, RECORD_EXO_ID
+
+# ### Begin ### #
+
+PORT = 9940
+
+@pytest.fixture(scope='module')
+def program():
+    ''' Starts Panda3D without a window and returns the program logic. '''
+    program_dir = os.path.dirname(os.path.abspath(__file__))
+    loadPrcFileData('', 'window-type none\naudio-library-name null\nmodel-path ' + Filename.fromOsSpecific(program_dir).getFullpath())
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    import advclasses
+    pl = advclasses.ProgramLogic(base.render,port_address=PORT)
+    yield pl
+    pl.cManager.closeConnection(pl.tcpSocket)
+
+@pytest.fixture
+def replies(program):
+    ''' Collects the replies of the program logic. '''
+    sent = []
+    program.send_message = lambda message, connection: sent.append(message)
+    yield sent
+    del program.send_message
+
+def add_realtime_exo(program):
+    ''' Adds a real-time exo and returns its id. '''
+    program.addExoTask(('realtime','left'),[0,0,0,0,0,0,0])
+    return program.exo_ids_in_order[-1]
+
+def test_data_non_numeric_is_rejected(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['#1 DATA '+id+' 10,20,3,4,5,6,7','#2 DATA '+id+' a,b,c,d,e,f,g'],None)
+    assert replies[0] == 'OK 1'
+    assert replies[1].startswith('ERR 2 ')
+    # The rejected sample neither replaces the valid one nor is counted
+    assert program.exos[id].dc.pending == [1.0,2.0,3,4,5,6,7]
+
+def test_data_rejected_sequence_is_not_accepted(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['#3 DATA '+id+' a,b,c,d,e,f,g 100','#4 DATA '+id+' 1,2,3,4,5,6,7 5'],None)
+    assert replies[0].startswith('ERR 3 ')
+    assert replies[1] == 'OK 4'
+    assert program.dataSequences[id] == 5
+
+def test_data_stale_sequence_is_rejected(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['#6 DATA '+id+' 10,0,0,0,0,0,0 7','#7 DATA '+id+' 20,0,0,0,0,0,0 7','DATA '+id+' 30,0,0,0,0,0,0 6'],None)
+    assert replies[0] == 'OK 6'
+    assert replies[1].startswith('ERR 7 ')
+    # Samples without request number are discarded silently
+    assert len(replies) == 2
+    assert program.exos[id].dc.pending[0] == 1.0
+
+def test_resetsequence_accepts_new_stream(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['DATA '+id+' 10,0,0,0,0,0,0 5','#8 RESETSEQUENCE '+id,'#9 DATA '+id+' 20,0,0,0,0,0,0 0'],None)
+    assert replies == ['OK 8','OK 9']
+    assert program.exos[id].dc.pending[0] == 2.0
+
+def test_data_reconnected_client_restarts_sequence(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['DATA '+id+' 10,0,0,0,0,0,0 '+str(sequence) for sequence in range(1000)],None)
+    # A new client numbers its samples from 0 again without RESETSEQUENCE
+    program.execute_commands(['#10 DATA '+id+' 20,0,0,0,0,0,0 0','#11 DATA '+id+' 30,0,0,0,0,0,0 1'],object())
+    assert replies == ['OK 10','OK 11']
+    assert program.dataSequences[id] == 1
+    assert program.exos[id].dc.pending[0] == 3.0
+
+def test_sequence_window():
+    assert is_newer_sequence(0,SEQUENCE_MODULO - 1)
+    assert not(is_newer_sequence(SEQUENCE_MODULO - 1,0))
+    assert not(is_restarted_sequence(998,999))
+    assert not(is_restarted_sequence(999 - SEQUENCE_REORDER_WINDOW,999))
+    assert is_restarted_sequence(0,999)
+    assert not(is_restarted_sequence(1000,999))
+    # Across the wrap-around
+    assert not(is_restarted_sequence(SEQUENCE_MODULO - 1,0))
+    assert is_restarted_sequence(SEQUENCE_MODULO - 100,0)
+
+def test_databatch_converts_like_data(program,replies):
+    exo = add_realtime_exo(program)
+    other = add_realtime_exo(program)
+    program.execute_commands(['DATA '+exo+' 15,-25,3,4,5,6,7','DATABATCH '+other+' 15,-25,3,4,5,6,7'],None)
+    assert program.exos[other].dc.pending == program.exos[exo].dc.pending == [1.5,-2.5,3,4,5,6,7]
+    program.execute_commands(['#12 DATA '+exo+' 1,2,3','#13 DATABATCH '+other+' 1,2,3'],None)
+    assert replies[0][len('ERR 12'):] == replies[1][len('ERR 13'):]
+
+def test_databatch_invalid_entry_rejects_batch(program,replies):
+    exo = add_realtime_exo(program)
+    other = add_realtime_exo(program)
+    program.execute_commands(['#5 DATABATCH '+exo+' 1,2,3,4,5,6,x '+other+' 1,2,3,4,5,6,7'],None)
+    assert replies[0].startswith('ERR 5 ')
+    assert program.exos[exo].dc.pending is None
+    assert program.exos[other].dc.pending is None
+
+def test_data_sequence_wraps_around(program,replies):
+    id = add_realtime_exo(program)
+    program.execute_commands(['#14 DATA '+id+' 10,0,0,0,0,0,0 '+str(SEQUENCE_MODULO - 1),'#15 DATA '+id+' 20,0,0,0,0,0,0 0'],None)
+    assert replies == ['OK 14','OK 15']
+    assert program.dataSequences[id] == 0
+    program.execute_commands([(id,(30,0,0,0,0,0,0),1),(id,(40,0,0,0,0,0,0),SEQUENCE_MODULO - 1)],None)
+    assert program.dataSequences[id] == 1
+    assert program.exos[id].dc.pending[0] == 3.0
+
+# ### Stream reassembly ### #
+
+def test_stream_buffer_split_commands():
+    buffer = CommandStreamBuffer()
+    assert buffer.feed(b'DATA ABC') == []
+    assert buffer.feed('DE 1,2,3,4,5,6,7::DELETE ABCDE:') == ['DATA ABCDE 1,2,3,4,5,6,7']
+    # The separator itself is split
+    assert buffer.feed(b':') == ['DELETE ABCDE']
+    assert buffer.pending() == 0
+    assert buffer.feed(b'::RESET::::') == ['RESET']
+
+def test_stream_buffer_binary_frames():
+    frame = pack_binary_data('ABCDE',[1,2,3,4,5,6,7],42)
+    data = b'#1 RESET::' + frame + pack_binary_data('FGHIJ',[1,2,3]) + b'DELETE ABCDE::'
+    buffer = CommandStreamBuffer()
+    # Split inside the first frame
+    commands = buffer.feed(data[:15]) + buffer.feed(data[15:])
+    assert commands == ['#1 RESET',('ABCDE',(1,2,3,4,5,6,7),42),('FGHIJ',(1,2,3),None),'DELETE ABCDE']
+    assert buffer.pending() == 0
+    # A frame with an unknown number of degrees of freedom is skipped up to the next separator
+    commands = buffer.feed(pack_binary_data('ABCDE',[1,2,3])[:1] + b'\x04garbage::RESET::')
+    assert buffer.invalid_frames == 1
+    assert commands[-1] == 'RESET'
+
+# ### Requests and replies ### #
+
+def test_split_request():
+    assert split_request('#17 DELETE ABCDE') == (17,'DELETE ABCDE')
+    assert split_request('DELETE ABCDE') == (None,'DELETE ABCDE')
+    with pytest.raises(ValueError):
+        split_request('#x DELETE ABCDE')
+
+def test_parse_reply_acks_and_tokens():
+    data = format_reply('OK 17 ABCDE @3') + format_reply('ERR 18 Id FGHIJ of Exo not found.') + format_reply('OK 19') + b':KLMNO'
+    replies, rest = split_replies(data)
+    assert rest == b':KLMNO'
+    assert [parse_reply(reply) for reply in replies] == [(17,True,'ABCDE @3'),(18,False,'Id FGHIJ of Exo not found.'),(19,True,'')]
+    # Id of an exo added without request number
+    assert parse_reply('KLMNO') == (None,True,'KLMNO')
+
+def test_addexo_reply_carries_token(program,replies):
+    program.execute_commands(['#20 ADDEXO EXOREALTIME LEFT 0,0,0,0,0,0,0 @7'],object())
+    # The exo is added (and acknowledged) by a task
+    assert replies == []
+    base.taskMgr.step()
+    request, ok, message = parse_reply(replies[0])
+    assert (request,ok) == (20,True)
+    assert message == program.exo_ids_in_order[-1] + ' @7'
+
+# ### UDP channel ### #
+
+def test_udp_datagram_accepts_only_data(program):
+    id = add_realtime_exo(program)
+    rejected = program.udp_stats['rejected']
+    program.parse_udp_datagram(('DATA '+id+' 10,0,0,0,0,0,0::DELETE '+id+'::').encode())
+    assert program.udp_stats['rejected'] == rejected + 1
+    assert id in program.exos
+    assert program.exos[id].dc.pending[0] == 1.0
+    program.parse_udp_datagram(pack_binary_data(id,[20,0,0,0,0,0,0]))
+    assert program.exos[id].dc.pending[0] == 2.0
+    # Datagrams are self-contained, an incomplete command is discarded
+    program.parse_udp_datagram(('DATA '+id+' 30,0,0').encode())
+    assert program.udp_stats['rejected'] == rejected + 2
+    assert program.udpBuffer.pending() == 0
+    assert program.exos[id].dc.pending[0] == 2.0
+
+# ### Session recorder ### #
+
+def test_recorder_round_trip(tmp_path):
+    filename = str(tmp_path / 'session.log')
+    recorder = SessionRecorder(filename)
+    connection = object()
+    recorder.record(RECORD_TCP,connection,b'#1 RESET::')
+    recorder.frame = 1
+    recorder.record_exo_id('ABCDE')
+    recorder.record(RECORD_UDP,None,b'DATA ABCDE 1,2,3,4,5,6,7::')
+    recorder.record(RECORD_TCP,connection,b'DELETE ABCDE::')
+    recorder.close()
+    records = [(frame,connection_id,kind,data) for timestamp, frame, connection_id, kind, data in read_session(filename)]
+    assert records == [(0,1,RECORD_TCP,b'#1 RESET::'),(1,0,RECORD_EXO_ID,b'ABCDE'),(1,0,RECORD_UDP,b'DATA ABCDE 1,2,3,4,5,6,7::'),(1,1,RECORD_TCP,b'DELETE ABCDE::')]
+    # Without data only the exo ids are read
+    assert [record[4] for record in read_session(filename,False)] == [None,b'ABCDE',None,None]
+    assert recorder.stats['records'] == 4
+
+def test_replay_feeds_recorded_frames(program,replies,tmp_path):
+    id = add_realtime_exo(program)
+    filename = str(tmp_path / 'session.log')
+    recorder = SessionRecorder(filename)
+    # The command is split between two receives of the same frame
+    recorder.record(RECORD_TCP,None,('#16 DATA '+id+' 10,0,0').encode())
+    recorder.record(RECORD_TCP,None,',0,0,0,0::'.encode())
+    recorder.frame = 1
+    recorder.record(RECORD_UDP,None,pack_binary_data(id,[20,0,0,0,0,0,0]))
+    recorder.close()
+    replay = SessionReplay(program,filename,realtime=False)
+    assert replay.feed()
+    assert replies == ['OK 16']
+    assert program.exos[id].dc.pending[0] == 1.0
+    assert replay.feed()
+    assert program.exos[id].dc.pending[0] == 2.0
+    assert not(replay.feed())
+    assert replay.stats == {'frames': 2, 'records': 3, 'bytes': recorder.stats['bytes']}
+
+# ### Logging ### #
+
+def test_rate_limit_filter():
+    limit = RateLimitFilter(rate=2,interval=1.0)
+    def record(created,lineno=10,msg='Sample %d dropped.',args=(1,)):
+        record = logging.LogRecord('adv.logic',logging.WARNING,'advclasses.py',lineno,msg,args,None)
+        record.created = created
+        return record
+    assert [limit.filter(record(100.0 + 0.1*i)) for i in range(5)] == [True,True,False,False,False]
+    # Other call sites and other exceptions are limited separately
+    assert limit.filter(record(100.5,lineno=20))
+    assert limit.filter(record(100.5,msg='%s',args=(KeyError('x'),)))
+    assert limit.filter(record(100.5,msg='%s',args=(ValueError('x'),)))
+    # The suppressed records are counted in the next record that passes
+    passed = record(101.5)
+    assert limit.filter(passed)
+    assert passed.getMessage() == 'Sample 1 dropped. (3 similar message(s) suppressed)'
+    assert len(limit.windows) == 1
+
+def test_rate_limit_filter_prunes_windows():
+    limit = RateLimitFilter(rate=2,interval=1.0)
+    for i in range(1000):
+        record = logging.LogRecord('adv.logic',logging.WARNING,'advclasses.py',10,'Exo '+str(i)+' not found.',(),None)
+        record.created = 100.0 + 0.01*i
+        assert limit.filter(record)
+    # The types are forgotten once per interval, so at most those of the last two intervals are kept
+    assert len(limit.windows) <= 200